@@ -0,0 +1,276 @@
+'''
+Import of Leboncoin ads from their URLs (manual add, bulk paste).
+Pages are fetched concurrently under a per-host politeness limit and parsed with
+extractors compiled once at import time; the caller persists the results in one write.
+'''
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Iterator
+from urllib.parse import urlparse
+
+import requests
+from bs4 import BeautifulSoup
+
+import http_cache
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8",
+    "Accept-Language": "fr-FR,fr;q=0.9,en-US;q=0.8,en;q=0.7"
+}
+FETCH_TIMEOUT = 10
+IMPORT_WORKERS = 4 # Pages fetched at once
+HOST_MIN_INTERVAL = 0.5 # Seconds between two requests to the same host
+MAX_IMPORT_URLS = 500
+
+DEFAULT_TITLE = "Annonce Leboncoin"
+DEFAULT_DESCRIPTION = "Pas de description."
+DEFAULT_LOCATION = "France"
+HQ_ZIP_CODES = ('92100', '75000') # Leboncoin's own address shows up on every page
+EXCLUDED_CITY_WORDS = {'prix', 'date', 'offre', 'vendeur', 'annonce', 'toutes', 'peerless', 'focal', 'cabasse',
+                       'denon', 'sony', 'philips', 'samsung', 'rel', 'haut', 'parleur'}
+
+# Extractors, compiled once
+_AD_ID_RE = re.compile(r'/(\d+)(?:\.htm|/|$|\?)')
+_URL_RE = re.compile(r'https?://[^\s"\'<>]+')
+_REDUX_RE = re.compile(r'window\.__REDUX_STATE__\s*=\s*({.*?});', re.DOTALL)
+_SHORT_CITY_ZIP_RE = re.compile(r'([A-Za-zÀ-ÖØ-öø-ÿ\-\s]+)\s+(\d{5})')
+_CITY_ZIP_RE = re.compile(r'([A-ZÀ-Ÿ][a-zà-ÿ\s\-]{3,})\s?\(?(\d{5})\)?')
+_ZIP_RE = re.compile(r'(\d{5})')
+_PRICE_RE = re.compile(r'(\d+[\s]?\d*)\s*€')
+_BREADCRUMB_ATTR_RE = re.compile(r'breadcrumb', re.I)
+_LOCATION_ATTR_RE = re.compile(r'location|city|adview_location', re.I)
+_LOCATION_CLASS_RE = re.compile(r'location', re.I)
+
+
+def extract_ad_id(url: str) -> Optional[str]:
+    match = _AD_ID_RE.search(url or '')
+    return match.group(1) if match else None
+
+
+def extract_urls(text: str) -> List[str]:
+    """URLs found in pasted text, in order, deduplicated by ad id (URLs without one are kept to be reported)."""
+    urls, seen = [], set()
+    for url in _URL_RE.findall(text or ''):
+        key = extract_ad_id(url) or url
+        if key not in seen:
+            seen.add(key)
+            urls.append(url)
+    return urls
+
+
+def _format_location(city, zipcode) -> Optional[str]:
+    if not city:
+        return None
+    return f"{city} ({zipcode})" if zipcode else city
+
+
+def _from_ld_json(soup, parsed: Dict[str, Any]):
+    """Stage 1: schema.org Product blocks (the most reliable, kept for SEO)."""
+    for script in soup.find_all('script', type='application/ld+json'):
+        try:
+            ld_data = json.loads(script.string)
+            items = ld_data if isinstance(ld_data, list) else [ld_data]
+            for item in items:
+                if item.get('@type') != 'Product':
+                    continue
+                parsed['title'] = item.get('name', parsed['title'])
+                images = item.get('image')
+                if images:
+                    parsed['image_url'] = images[0] if isinstance(images, list) else images
+                offers = item.get('offers')
+                if offers:
+                    price = offers.get('price') if isinstance(offers, dict) else offers[0].get('price') if isinstance(offers, list) else 0
+                    parsed['price'] = float(price) if price else parsed['price']
+                parsed['description'] = item.get('description', parsed['description'])
+                loc = item.get('location') or item.get('address')
+                if isinstance(loc, dict) and loc.get('@type') == 'Place':
+                    addr = loc.get('address', {})
+                    parsed['location'] = _format_location(addr.get('addressLocality'), addr.get('postalCode')) or parsed['location']
+        except Exception:
+            continue
+
+
+def _apply_ad_state(ad_data: Dict[str, Any], parsed: Dict[str, Any]):
+    """Fills the still-default fields from Leboncoin's internal ad object."""
+    if parsed['title'] == DEFAULT_TITLE:
+        parsed['title'] = ad_data.get('subject', parsed['title'])
+    if parsed['price'] == 0:
+        price = ad_data.get('price', 0)
+        parsed['price'] = (price[0] if price else 0) if isinstance(price, list) else price or 0
+    if parsed['description'] == DEFAULT_DESCRIPTION:
+        parsed['description'] = ad_data.get('body', parsed['description'])
+    loc = ad_data.get('location') or {}
+    parsed['location'] = _format_location(loc.get('city_label') or loc.get('city'),
+                                          loc.get('zipcode') or loc.get('zip_code')) or parsed['location']
+    if loc.get('lat') is not None and loc.get('lng') is not None:
+        parsed['lat'], parsed['lng'] = loc['lat'], loc['lng']
+    images = (ad_data.get('images') or {}).get('urls', [])
+    if images and not parsed['image_url']:
+        parsed['image_url'] = images[0]
+
+
+def _from_page_state(soup, html: str, parsed: Dict[str, Any]):
+    """Stage 2: the page's embedded state, __NEXT_DATA__ (current site) then window.__REDUX_STATE__."""
+    next_data = soup.find('script', id='__NEXT_DATA__')
+    if next_data and next_data.string:
+        try:
+            ad_data = json.loads(next_data.string).get('props', {}).get('pageProps', {}).get('ad') or {}
+            if ad_data:
+                _apply_ad_state(ad_data, parsed)
+                return
+        except Exception:
+            pass
+    match = _REDUX_RE.search(html)
+    if match:
+        try:
+            state = json.loads(match.group(1))
+            ad_data = state.get('adview', {}).get('adData', {}) or \
+                      state.get('ad', {}).get('adData', {}) or \
+                      state.get('adview', {}).get('data', {})
+            if ad_data:
+                _apply_ad_state(ad_data, parsed)
+        except Exception:
+            pass
+
+
+def _location_fallbacks(soup, html: str) -> Optional[str]:
+    """Stage 3: short 'City 75001' texts, breadcrumbs, location markers, then regexes over the page."""
+    for tag in soup.find_all(['h2', 'p', 'div', 'span']):
+        txt = tag.get_text(" ", strip=True)
+        if len(txt) >= 60:
+            continue
+        match = _SHORT_CITY_ZIP_RE.search(txt)
+        if match and "livraison" not in match.group(1).lower():
+            return f"{match.group(1).strip()} ({match.group(2)})"
+
+    for bc in reversed(soup.find_all(attrs={"data-qa-id": _BREADCRUMB_ATTR_RE})):
+        text = bc.get_text().strip()
+        if _ZIP_RE.search(text):
+            return text
+
+    loc_tag = soup.find(attrs={"data-qa-id": _LOCATION_ATTR_RE}) or soup.find(class_=_LOCATION_CLASS_RE)
+    if loc_tag:
+        cand = loc_tag.get_text().strip()
+        if cand and len(cand) < 100 and HQ_ZIP_CODES[0] not in cand:
+            return cand
+
+    search_space = (soup.title.string if soup.title and soup.title.string else '') + " "
+    meta_desc = soup.find('meta', attrs={'name': 'description'})
+    if meta_desc:
+        search_space += meta_desc.get('content', '') + " "
+    search_space += html[:15000]
+    for match in _CITY_ZIP_RE.finditer(search_space):
+        city, zip_code = match.group(1).strip(), match.group(2)
+        if city.lower() not in EXCLUDED_CITY_WORDS and zip_code not in HQ_ZIP_CODES:
+            return f"{city} ({zip_code})"
+    # Last ditch: any zip code that is not Leboncoin's
+    for code in _ZIP_RE.findall(search_space):
+        if code in HQ_ZIP_CODES:
+            continue
+        surround = re.search(r'([A-ZÀ-Ÿ][a-zà-ÿ\s\-]{3,})\s?\(?' + code + r'\)?', search_space)
+        if surround and surround.group(1).strip().lower() not in EXCLUDED_CITY_WORDS:
+            return f"{surround.group(1).strip()} ({code})"
+        return f"Zone {code}"
+    return None
+
+
+def parse_ad_page(html: str) -> Dict[str, Any]:
+    """Ad fields from a Leboncoin ad page: LD+JSON, embedded state, then meta tags and regex fallbacks."""
+    parsed = {"title": DEFAULT_TITLE, "price": 0, "image_url": None, "description": DEFAULT_DESCRIPTION,
+              "location": DEFAULT_LOCATION, "lat": None, "lng": None}
+    soup = BeautifulSoup(html, 'html.parser')
+    _from_ld_json(soup, parsed)
+    if parsed['location'] == DEFAULT_LOCATION or parsed['price'] == 0:
+        _from_page_state(soup, html, parsed)
+
+    if not parsed['image_url']:
+        for meta_prop in ['og:image', 'twitter:image', 'image']:
+            m = soup.find('meta', property=meta_prop) or soup.find('meta', attrs={"name": meta_prop})
+            if m:
+                parsed['image_url'] = m.get('content')
+                break
+
+    if parsed['location'] == DEFAULT_LOCATION or not parsed['location']:
+        parsed['location'] = _location_fallbacks(soup, html) or DEFAULT_LOCATION
+
+    if parsed['price'] == 0:
+        price_match = _PRICE_RE.search(html)
+        if price_match:
+            parsed['price'] = float(price_match.group(1).replace(' ', '').replace('\xa0', ''))
+    return parsed
+
+
+def build_manual_ad(url: str, ad_id: str, search_name: str, parsed: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": ad_id, "url": url, "search_name": search_name,
+        "title": parsed['title'], "price": parsed['price'], "image_url": parsed['image_url'],
+        "description": parsed['description'], "location": parsed['location'],
+        "lat": parsed.get('lat'), "lng": parsed.get('lng'),
+        "is_pro": 0, "date": datetime.now().isoformat(), "source": "MANUAL", "is_hidden": 0
+    }
+
+
+class HostThrottle:
+    """Spaces out requests to the same host by at least `min_interval` seconds, across threads."""
+    def __init__(self, min_interval: float = HOST_MIN_INTERVAL):
+        self.min_interval = min_interval
+        self._next_slot: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url: str):
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, 0.0))
+            self._next_slot[host] = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def fetch_ad(url: str, search_name: str, session: requests.Session = None,
+             throttle: HostThrottle = None) -> Dict[str, Any]:
+    """
+    Fetches and parses one ad URL: {"url", "id", "status": "parsed"|"error", "ad", "error"}.
+    On a failed fetch the status is "error" but "ad" still holds the defaults, which the
+    single manual add keeps (bulk imports skip them rather than overwrite stored ads).
+    """
+    ad_id = extract_ad_id(url)
+    if not ad_id:
+        return {"url": url, "id": None, "status": "error", "error": "Impossible d'extraire l'ID de l'annonce."}
+    parsed, error = None, None
+    try:
+        if throttle and not http_cache.is_fresh(url): # Cache hits cost the host nothing
+            throttle.wait(url)
+        resp = http_cache.get(url, headers=HEADERS, timeout=FETCH_TIMEOUT, session=session)
+        if resp.status_code == 200:
+            parsed = parse_ad_page(resp.text)
+        else:
+            error = f"HTTP {resp.status_code}"
+    except Exception as e:
+        print(f"[Manual Add] Advanced extraction failed: {e}")
+        error = str(e)
+    result = {"url": url, "id": ad_id, "status": "error" if error else "parsed",
+              "ad": build_manual_ad(url, ad_id, search_name, parsed or parse_ad_page(''))}
+    if error:
+        result["error"] = error
+    return result
+
+
+def fetch_ads(urls: List[str], search_name: str, workers: int = IMPORT_WORKERS,
+              min_interval: float = HOST_MIN_INTERVAL) -> Iterator[Dict[str, Any]]:
+    """Fetches and parses many URLs concurrently; yields each fetch_ad result as it completes."""
+    throttle = HostThrottle(min_interval)
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fetch_ad, url, search_name, session, throttle) for url in urls]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # Client gone: drop what has not started yet
+            for future in futures:
+                future.cancel()
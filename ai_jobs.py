@@ -0,0 +1,180 @@
+'''
+Persistent AI job queue: jobs live in the ai_jobs table and a pool of worker threads
+runs them slice by slice, so priorities and users are interleaved and a restart resumes work.
+Running jobs are leased (jobs.py), so several worker processes can share the queue.
+'''
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Any, List
+
+import database
+import analyzer
+import enrichment
+import events
+import jobs
+import pipeline
+
+AI_WORKERS = int(os.getenv("AI_WORKERS", 2))
+AI_JOB_SLICE = int(os.getenv("AI_JOB_SLICE", 20)) # Ads analyzed before a job goes back to the queue
+
+MANUAL, PEPITE, BACKLOG = database.AI_JOB_MANUAL, database.AI_JOB_PEPITE, database.AI_JOB_BACKLOG
+
+_wakeup = threading.Event()
+_pool = None
+
+
+def enqueue(ad_ids: List[str], user_id: int = 1, priority: int = BACKLOG, custom_context: str = None, notify: bool = True) -> int:
+    """Queues ads for analysis and wakes up an idle worker."""
+    job_id = database.enqueue_ai_job(ad_ids, user_id=user_id, priority=priority, custom_context=custom_context, notify=notify)
+    if job_id:
+        _wakeup.set()
+    return job_id
+
+
+def _update_job(job: Dict[str, Any], **fields) -> bool:
+    """
+    Persists job progress; the web processes push it to the owner's open dashboards.
+    Returns False when this worker lost the job's lease (it was reclaimed): stop working on it.
+    """
+    if not database.update_ai_job(job['id'], worker_id=job.get('lease_owner'), **fields):
+        print(f"[AI Job] Lease lost on job #{job['id']}: left to its new worker.")
+        return False
+    update = {k: v for k, v in fields.items() if k != 'done_ids'}
+    database.add_ai_progress(job['user_id'], events.AI_JOB, {"id": job['id'], "total": len(job['ad_ids']), **update})
+    return True
+
+
+def build_context(search_info: Dict[str, Any], custom_context: str = None) -> str:
+    """Custom prompt > watch AI context > generic context built from the query."""
+    context = custom_context or search_info.get('ai_context')
+    if not context or not context.strip():
+        query = search_info.get('query_text', 'Recherche générale')
+        context = f"L'utilisateur recherche : {query}. Analyse la pertinence par rapport à ce produit."
+    return context
+
+
+def gate_candidates(ads: List[Dict[str, Any]], user_id: int = 1) -> List[Dict[str, Any]]:
+    """
+    Local pre-scoring gate: per watch, keeps only the ads whose vectorized pre-score
+    (price vs. market median, keywords, distance, seller, freshness) justifies an LLM call.
+    """
+    searches = {s['name']: s for s in database.get_active_searches(user_id=user_id)}
+    grouped_ads = defaultdict(list)
+    for ad in ads:
+        grouped_ads[ad.get('search_name')].append(ad)
+
+    home = database.get_user_home(user_id)
+    selected = []
+    for search_name, group in grouped_ads.items():
+        search = searches.get(search_name, {})
+        query = search.get('query_text') or search_name or ''
+        median = analyzer.get_market_stats(user_id=user_id, search_name=search_name).get('median') if search_name else None
+        # Watch center, else the user's home point
+        origin = (search.get('lat'), search.get('lng')) if search.get('lat') is not None else home
+        selected += analyzer.select_for_llm(group, query, reference_price=median or None, origin=origin, radius_km=search.get('radius'))
+    return selected
+
+
+def run_job_slice(job: Dict[str, Any]):
+    """Analyzes the next AI_JOB_SLICE ads of a job, saves progress, then requeues or finishes it."""
+    job_id, user_id = job['id'], job['user_id']
+    should_stop = lambda: database.is_ai_job_cancelled(job_id)
+
+    done = list(job['done_ids'])
+    done_set = set(done)
+    slice_ids = [i for i in job['ad_ids'] if i not in done_set][:AI_JOB_SLICE]
+
+    user_data = database.get_user_by_id(user_id) or {}
+    searches = {s['name']: s for s in database.get_active_searches(user_id=user_id)}
+    ads = database.get_ads_by_ids(slice_ids, user_id=user_id) if slice_ids else []
+    if any(enrichment.needs_details(ad) for ad in ads):
+        if not _update_job(job, message="Récupération des détails des annonces..."):
+            return
+        ads = enrichment.enrich(ads, user_id=user_id)
+    found = {ad['id'] for ad in ads}
+    done += [i for i in slice_ids if i not in found] # Deleted in the meantime
+
+    grouped_ads = defaultdict(list)
+    for ad in ads:
+        grouped_ads[ad['search_name']].append(ad)
+
+    failed = 0
+    for search_name, batch in grouped_ads.items():
+        if should_stop():
+            break
+        search_info = searches.get(search_name, {})
+        if not _update_job(job, message=f"Analyse [{search_name}] : {len(batch)} annonce(s)"):
+            return # Reclaimed: the new worker analyzes these ads, don't send them twice
+        print(f"--- Job IA #{job_id} (user {user_id}) : [{search_name}] ---")
+
+        summaries = analyzer.generate_batch_summaries(batch, user_context=build_context(search_info, job.get('custom_context')),
+                                                      api_key=user_data.get('google_api_key'), should_stop=should_stop,
+                                                      user_id=user_id)
+        processed = [{
+            "id": s.get("id"),
+            "ai_summary": s.get("ai_summary"),
+            "ai_score": s.get("ai_score", 5.0),
+            "ai_tips": s.get("ai_tips", "")
+        } for s in summaries]
+        if processed:
+            database.update_summaries_in_batch(processed, user_id=user_id)
+            pipeline.notify() # Pépites reach Discord through the change log
+
+        if should_stop():
+            # Only keep what was really analyzed, the rest is dropped with the job
+            done += [p['id'] for p in processed]
+            break
+        failed += len(batch) - len(processed)
+        done += [ad['id'] for ad in batch]
+
+    now = datetime.now().isoformat()
+    if should_stop():
+        _update_job(job, status='cancelled', done_ids=done, progress=len(done), message="Annulé", finished_at=now)
+    elif len(done) >= len(job['ad_ids']):
+        msg = f"Terminé : {len(done)} annonce(s)" + (f", {failed} échec(s)" if failed else "")
+        _update_job(job, status='done', done_ids=done, progress=len(done), message=msg, finished_at=now)
+    else:
+        # Back to the queue so other users / higher priorities get a turn
+        _update_job(job, status='queued', done_ids=done, progress=len(done), message=f"{len(done)}/{len(job['ad_ids'])} analysées")
+
+
+class AIJobWorkerPool:
+    def __init__(self, workers: int = AI_WORKERS):
+        self._workers = max(1, workers)
+        self._threads: List[threading.Thread] = []
+
+    def _work(self):
+        while True:
+            job = database.claim_next_ai_job(jobs.WORKER_ID, jobs.LEASE_SECONDS)
+            if not job:
+                _wakeup.wait(timeout=5)
+                _wakeup.clear()
+                continue
+            try:
+                # The lease stays alive while the slice runs; a dead process's job is picked up again
+                with jobs.heartbeat.hold('ai_jobs', job['id']):
+                    run_job_slice(job)
+            except Exception as e:
+                print(f"[AI Job Error] Job #{job['id']} failed: {e}")
+                _update_job(job, status='failed', message=str(e), finished_at=datetime.now().isoformat())
+
+    def start(self):
+        resumed = database.requeue_interrupted_ai_jobs()
+        if resumed:
+            print(f"♻️ {resumed} job(s) IA repris après redémarrage.")
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._work, name=f"ai-worker-{i+1}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print(f"Started {self._workers} AI job worker(s).")
+
+
+def start_workers(workers: int = None) -> AIJobWorkerPool:
+    """Starts the worker pool once per process."""
+    global _pool
+    if _pool is None:
+        _pool = AIJobWorkerPool(workers or AI_WORKERS)
+        _pool.start()
+    return _pool
@@ -2,83 +2,155 @@
 This module provides AI-powered analysis for Leboncoin ads using Google Gemini.
 '''
 import os
+import re
 import json
 import time
-import os
-import json
-import time
+import hashlib
+import numpy as np
 from google import genai
-from datetime import datetime
-from typing import List, Dict, Any
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Optional, Callable, Iterator
 from dotenv import load_dotenv
+from utils import haversine_km
+import events
 
 # Load environment variables
 load_dotenv()
 
-# Rate Limiter for Free Tier (15 RPM)
-class RateLimiter:
-    def __init__(self, requests_per_minute=15):
-        self.rpm_limit = requests_per_minute
-        self.timestamps = []
-        self.daily_count = 0 
-        self.last_reset = time.time()
-    
-    def wait_if_needed(self):
-        now = time.time()
-        
-        # Reset daily count if 24h passed (rough approximation)
-        if now - self.last_reset > 86400:
-            self.daily_count = 0
-            self.last_reset = now
-            
-        # Filter timestamps older than 60s
-        self.timestamps = [t for t in self.timestamps if now - t < 60]
-        
-        # Check RPM
-        if len(self.timestamps) >= self.rpm_limit:
-            wait_time = 60 - (now - self.timestamps[0]) + 1
-            if wait_time > 0:
-                msg = f"⏳ Limite RPM ({self.rpm_limit}) atteinte. Pause de {int(wait_time)}s..."
-                print(msg)
-                set_ai_status(message=msg)
-                time.sleep(wait_time)
-                
-        # Record this request
-        self.timestamps.append(time.time())
-        self.daily_count += 1
-
-_rate_limiter = RateLimiter(requests_per_minute=15)
+# Quota Manager for Free Tier (15 RPM / 250k TPM / 1000 RPD by default)
+@dataclass
+class Reservation:
+    key_id: str
+    model: str
+    tokens: int
+    wait: float = 0.0
+    ok: bool = True
+    reason: Optional[str] = None
+
+class QuotaManager:
+    """
+    Token-bucket quota shared through SQLite: RPM, TPM and daily requests are tracked
+    per API key and model, so restarts and concurrent processes draw from the same budget.
+    Callers get a reservation telling them how long to wait instead of sleeping under a lock.
+    """
+    def __init__(self, requests_per_minute=15, tokens_per_minute=250_000, requests_per_day=1000):
+        self.limits = {"rpm": requests_per_minute, "tpm": tokens_per_minute, "rpd": requests_per_day}
+
+    @staticmethod
+    def key_id(api_key: str) -> str:
+        # Never persist the raw key, a short digest is enough to tell keys apart
+        return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+    def reserve(self, api_key: str, model: str, tokens: int) -> Reservation:
+        from database import reserve_ai_quota
+        key_id = self.key_id(api_key)
+        res = reserve_ai_quota(key_id, model, tokens, self.limits)
+        return Reservation(key_id, model, int(tokens), wait=res['wait'], ok=res['ok'], reason=res['reason'])
+
+    def settle(self, reservation: Reservation, used_tokens: Optional[int]):
+        """Gives back (or charges) the difference between estimated and real token usage."""
+        if used_tokens is None or used_tokens == reservation.tokens:
+            return
+        from database import adjust_ai_quota
+        adjust_ai_quota(reservation.key_id, reservation.model, reservation.tokens - used_tokens, self.limits)
+
+    def penalize(self, api_key: str, model: str, seconds: float):
+        """Blocks the bucket for `seconds` after the server rejected a call (429)."""
+        from database import adjust_ai_quota
+        adjust_ai_quota(self.key_id(api_key), model, 0, self.limits, penalty_seconds=seconds)
+
+    def remaining(self, api_key: str, model: str) -> Dict[str, Any]:
+        from database import get_ai_quota
+        bucket = get_ai_quota(self.key_id(api_key), model, self.limits)
+        return {
+            "model": model,
+            "rpm_limit": self.limits["rpm"],
+            "rpm_remaining": max(0, int(bucket['rpm_tokens'])),
+            "tpm_limit": self.limits["tpm"],
+            "tpm_remaining": max(0, int(bucket['tpm_tokens'])),
+            "daily_limit": self.limits["rpd"],
+            "daily_remaining": max(0, self.limits["rpd"] - bucket['day_requests']),
+            "daily_tokens": bucket['day_tokens']
+        }
+
+QUOTA_RESERVE_ATTEMPTS = 5 # Reservations refused by a database error before giving up
+
+_quota = QuotaManager(
+    requests_per_minute=int(os.getenv("GEMINI_RPM", 15)),
+    tokens_per_minute=int(os.getenv("GEMINI_TPM", 250_000)),
+    requests_per_day=int(os.getenv("GEMINI_RPD", 1000))
+)
+
+# Characters per token, calibrated on the usage reported by the API (starts at ~4 for French text)
+_chars_per_token = 4.0
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate based on the calibrated characters-per-token ratio."""
+    return max(1, int(len(text or "") / _chars_per_token))
+
+def _calibrate_tokens(prompt: str, response):
+    """Moves the characters-per-token ratio towards what the API actually counted."""
+    global _chars_per_token
+    usage = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(usage, "prompt_token_count", None) if usage else None
+    if prompt_tokens and len(prompt) > 200:
+        _chars_per_token = 0.8 * _chars_per_token + 0.2 * (len(prompt) / prompt_tokens)
+
+def _used_tokens(response) -> Optional[int]:
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "total_token_count", None) if usage else None
 
 # Global state for the client
 _current_api_key = None
 _client = None
 _selected_model_name = None 
-_status = {"status": "idle", "progress": 0, "total": 0, "message": "En attente"}
+IDLE_STATUS = {"status": "idle", "progress": 0, "total": 0, "message": "En attente"}
+_statuses: Dict[int, Dict[str, Any]] = {} # Per user
 import threading
 _ai_lock = threading.Lock()
+_status_lock = threading.Lock()
+_context = threading.local() # User whose analysis runs on this thread (see generate_batch_summaries)
 
 
-_stop_requested = False
+_stop_requested = set() # User ids
 
-def get_ai_status():
-    return _status
+def get_ai_status(user_id: int = 1) -> Dict[str, Any]:
+    """The user's last status, written by whichever process runs their analysis."""
+    from database import get_latest_ai_status
+    return get_latest_ai_status(user_id) or dict(IDLE_STATUS)
 
-def stop_analysis():
-    global _stop_requested
-    _stop_requested = True
-    set_ai_status(status="idle", message="🛑 Analyse arrêtée par l'utilisateur.")
+def stop_analysis(user_id: int = 1):
+    _stop_requested.add(user_id)
+    set_ai_status(status="idle", message="🛑 Analyse arrêtée par l'utilisateur.", user_id=user_id)
 
-def set_ai_status(status=None, progress=None, total=None, message=None):
-    global _status, _stop_requested
-    if status is not None: 
-        _status['status'] = status
-        # If starting new analysis, reset stop flag
-        if status == 'loading':
-            _stop_requested = False
-            
-    if progress is not None: _status['progress'] = progress
-    if total is not None: _status['total'] = total
-    if message is not None: _status['message'] = message
+def set_ai_status(status=None, progress=None, total=None, message=None, user_id: int = None, **extra):
+    """
+    Updates a user's analysis status. It goes through the ai_progress table, so the web
+    processes push it to that user's open dashboards only (pipeline.LiveStage). Without
+    `user_id`, the user whose analysis runs on this thread; calls outside any analysis
+    (a chat answer hitting the quota, ...) have no status to update.
+    """
+    if user_id is None:
+        user_id = getattr(_context, 'user_id', None)
+        if user_id is None:
+            return
+    from database import add_ai_progress, get_latest_ai_status
+    with _status_lock:
+        if user_id not in _statuses:
+            _statuses[user_id] = get_latest_ai_status(user_id) or dict(IDLE_STATUS)
+        current = _statuses[user_id]
+        if status is not None:
+            current['status'] = status
+            # If starting new analysis, reset stop flag
+            if status == 'loading':
+                _stop_requested.discard(user_id)
+        if progress is not None: current['progress'] = progress
+        if total is not None: current['total'] = total
+        if message is not None: current['message'] = message
+        current.update(extra)
+        snapshot = dict(current)
+    add_ai_progress(user_id, events.AI_STATUS, snapshot)
 
 
 def _discover_best_model(client):
@@ -140,9 +212,7 @@ def get_client(api_key=None):
     global _current_api_key, _client
     
     # Priority: passed key > DB global setting > Env
-    if not api_key:
-        from database import get_setting
-        api_key = get_setting('google_api_key') or os.getenv("GEMINI_API_KEY")
+    api_key = _resolve_api_key(api_key)
     
     if not api_key:
         return None
@@ -165,48 +235,145 @@ def get_client(api_key=None):
             
     return _client
 
-def safe_generate_content(prompt: str, api_key: str = None, max_retries: int = 3) -> Any:
-    """
-    Calls Gemini API with locking using the new google-genai SDK.
-    """
+def _resolve_api_key(api_key: str = None) -> Optional[str]:
+    if api_key:
+        return api_key
+    from database import get_setting
+    return get_setting('google_api_key') or os.getenv("GEMINI_API_KEY")
+
+def get_quota_status(api_key: str = None) -> Optional[Dict[str, Any]]:
+    """Remaining RPM / TPM / daily budget for the given (or default) key."""
+    key = _resolve_api_key(api_key)
+    if not key:
+        return None
+    model_name = _selected_model_name or os.getenv("GEMINI_MODEL", "gemini-2.5-flash-lite")
+    return _quota.remaining(key, model_name)
+
+def _prepare_call(api_key: str = None):
+    """Resolves (client, api_key, model) under the lock; client is None when not configured."""
     with _ai_lock:
         client = get_client(api_key)
         if not client:
             set_ai_status(message="❌ Client IA non configuré ou clé API invalide.")
-            return None
-        
-        # Determine model
+            return None, None, None
         model_name = _selected_model_name or os.getenv("GEMINI_MODEL", "gemini-2.5-flash-lite")
+        return client, _current_api_key, model_name
 
-        for i in range(max_retries):
-            try:
-                # Rate Limit Check
-                _rate_limiter.wait_if_needed()
-                
-                # New SDK Syntax: client.models.generate_content
-                return client.models.generate_content(
-                    model=model_name, 
-                    contents=prompt
-                )
-            except Exception as e:
-                # Handle Quota / 429 errors generic string check (robust for new SDK)
-                err_str = str(e).lower()
-                if "429" in err_str or "resource exhausted" in err_str or "quota" in err_str:
-                    wait_time = (i + 1) * 20
-                    set_ai_status(message=f"⏳ Quota Gemini (SDK v2). Pause {wait_time}s... ({i+1}/{max_retries})")
-                    time.sleep(wait_time)
-                else:
-                    msg = f"❌ Erreur critique Gemini: {str(e)}"
-                    print(msg)
-                    with open("debug_ai_errors.log", "a", encoding="utf-8") as f:
-                        f.write(f"{datetime.now()} - {msg}\n")
-                    set_ai_status(message=msg)
-                    break
-        
-        set_ai_status(message="❌ Échec après plusieurs tentatives (Quota ou Service HS).")
+
+def _wait_for_quota(key: str, model_name: str, estimated: int) -> Optional[Reservation]:
+    """
+    Reserves quota and sleeps until the reservation is due. None when the daily quota is
+    spent or the quota database stays unavailable (no call is sent without a reservation).
+    """
+    for _ in range(QUOTA_RESERVE_ATTEMPTS):
+        reservation = _quota.reserve(key, model_name, estimated)
+        if reservation.ok or reservation.reason != 'error':
+            break
+        time.sleep(reservation.wait)
+    else:
+        set_ai_status(message="❌ Quota Gemini indisponible (base de données occupée). Réessayez plus tard.")
+        return None
+    if not reservation.ok:
+        set_ai_status(message=f"❌ Quota journalier Gemini épuisé ({_quota.limits['rpd']} requêtes). Reprise dans {int(reservation.wait // 3600)}h.")
+        return None
+    if reservation.wait > 0:
+        msg = f"⏳ Limite {(reservation.reason or 'rpm').upper()} atteinte. Pause de {int(reservation.wait)}s..."
+        print(msg)
+        set_ai_status(message=msg)
+        time.sleep(reservation.wait)
+    return reservation
+
+
+def safe_generate_content(prompt: str, api_key: str = None, max_retries: int = 3, output_tokens: int = 0) -> Any:
+    """
+    Calls Gemini API using the new google-genai SDK.
+    The lock only guards client configuration; pacing is handled by quota reservations,
+    which count the prompt plus the `output_tokens` expected back.
+    """
+    client, key, model_name = _prepare_call(api_key)
+    if not client:
+        return None
+
+    estimated = estimate_tokens(prompt) + output_tokens
+    for i in range(max_retries):
+        reservation = _wait_for_quota(key, model_name, estimated)
+        if not reservation:
+            return None
+
+        try:
+            # New SDK Syntax: client.models.generate_content
+            response = client.models.generate_content(
+                model=model_name,
+                contents=prompt
+            )
+            _quota.settle(reservation, _used_tokens(response))
+            _calibrate_tokens(prompt, response)
+            return response
+        except Exception as e:
+            _quota.settle(reservation, 0) # Rejected or failed: no tokens consumed
+            # Handle Quota / 429 errors generic string check (robust for new SDK)
+            err_str = str(e).lower()
+            if "429" in err_str or "resource exhausted" in err_str or "quota" in err_str:
+                wait_time = (i + 1) * 20
+                set_ai_status(message=f"⏳ Quota Gemini (SDK v2). Pause {wait_time}s... ({i+1}/{max_retries})")
+                # The next reservation (from any process) will wait for the penalty
+                _quota.penalize(key, model_name, wait_time)
+            else:
+                msg = f"❌ Erreur critique Gemini: {str(e)}"
+                print(msg)
+                with open("debug_ai_errors.log", "a", encoding="utf-8") as f:
+                    f.write(f"{datetime.now()} - {msg}\n")
+                set_ai_status(message=msg)
+                break
+
+    set_ai_status(message="❌ Échec après plusieurs tentatives (Quota ou Service HS).")
     return None
 
 
+def stream_generate_content(prompt: str, api_key: str = None, max_retries: int = 3) -> Iterator[str]:
+    """
+    Streaming variant of safe_generate_content: yields text chunks as Gemini produces them.
+    429s are only retried before the first chunk. Closing the generator (client gone)
+    closes the upstream stream, so Gemini stops generating.
+    """
+    client, key, model_name = _prepare_call(api_key)
+    if not client:
+        raise RuntimeError("Client IA non configuré ou clé API invalide.")
+
+    estimated = estimate_tokens(prompt)
+    for i in range(max_retries):
+        reservation = _wait_for_quota(key, model_name, estimated)
+        if not reservation:
+            raise RuntimeError("Quota Gemini épuisé ou indisponible.")
+
+        stream, last_chunk, started = None, None, False
+        try:
+            stream = client.models.generate_content_stream(model=model_name, contents=prompt)
+            for chunk in stream:
+                last_chunk = chunk
+                if chunk.text:
+                    started = True
+                    yield chunk.text
+            if last_chunk:
+                _calibrate_tokens(prompt, last_chunk)
+            return
+        except Exception as e:
+            err_str = str(e).lower()
+            if not started and ("429" in err_str or "resource exhausted" in err_str or "quota" in err_str):
+                wait_time = (i + 1) * 20
+                _quota.penalize(key, model_name, wait_time)
+                continue
+            raise
+        finally:
+            if stream is not None and hasattr(stream, "close"):
+                stream.close()
+            # Finished, failed or cancelled by the client: charge the usage of the last chunk
+            # (only complete on the final one), nothing when no chunk came back
+            _quota.settle(reservation, _used_tokens(last_chunk) if last_chunk else 0)
+
+    raise RuntimeError("Échec après plusieurs tentatives (Quota ou Service HS).")
+
+
 def detect_scam(ad: Dict[str, Any], api_key: str = None) -> Dict[str, Any]:
     """
     Uses AI to detect potential scams based on price, title and description.
@@ -240,86 +407,258 @@ def detect_scam(ad: Dict[str, Any], api_key: str = None) -> Dict[str, Any]:
 
 
 
-def generate_batch_summaries(ads: List[Dict[str, Any]], user_context: str = None, api_key: str = None) -> List[Dict[str, Any]]:
-    """Generates summaries for a list of ads using Gemini."""
+# Batching: pack ads into prompts up to a per-request token budget
+AI_BATCH_TOKEN_BUDGET = int(os.getenv("AI_BATCH_TOKEN_BUDGET", 6000))  # input tokens per request
+AI_AD_TOKEN_CAP = int(os.getenv("AI_AD_TOKEN_CAP", 350))               # max description tokens per ad
+AI_BATCH_MAX_ADS = int(os.getenv("AI_BATCH_MAX_ADS", 25))              # keeps the JSON answer short enough
+OUTPUT_TOKENS_PER_AD = 120                                             # summary + score + tips, reserved on top of the input
+
+def _build_summary_prompt(ads_data: List[Dict[str, Any]], user_context: str = None) -> str:
+    return f"""
+        Objectif : {user_context or "Analyse générale."}
+        Pour chaque annonce JSON, génère un résumé (2 sentences), un score (1-10) et un conseil.
+        Réponds UNIQUEMENT en JSON : [{{"id": "...", "ai_summary": "...", "ai_score": 8, "ai_tips": "..."}}, ...]
+        Données : {json.dumps(ads_data, ensure_ascii=False)}
+        """
+
+def _ad_payload(ad: Dict[str, Any]) -> Dict[str, Any]:
+    """Prompt entry for one ad, with the description cut to the per-ad token cap."""
+    description = ad.get('description') or ''
+    max_chars = int(AI_AD_TOKEN_CAP * _chars_per_token)
+    if len(description) > max_chars:
+        description = description[:max_chars]
+    return {"id": ad['id'], "titre": ad.get('title') or '', "description": description}
+
+def pack_batches(payloads: List[Dict[str, Any]], base_tokens: int, budget: int = None, max_ads: int = None) -> List[List[Dict[str, Any]]]:
+    """
+    Greedily packs ad payloads (in order) so that each prompt stays under `budget` input tokens.
+    An ad larger than the budget on its own still gets a batch of one.
+    """
+    budget = budget or AI_BATCH_TOKEN_BUDGET
+    max_ads = max_ads or AI_BATCH_MAX_ADS
+    batches, current, used = [], [], base_tokens
+    for payload in payloads:
+        cost = estimate_tokens(json.dumps(payload, ensure_ascii=False))
+        if current and (used + cost > budget or len(current) >= max_ads):
+            batches.append(current)
+            current, used = [], base_tokens
+        current.append(payload)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+def _parse_summaries(text: str) -> Optional[List[Dict[str, Any]]]:
+    """Extracts the JSON list from a model answer, None if it is malformed."""
+    text = text.strip()
+    # Remove markdown code blocks if present
+    if text.startswith("```"):
+        text = text.replace("```json", "").replace("```", "")
+    s, e = text.find('['), text.rfind(']')
+    if s == -1 or e == -1:
+        return None
+    try:
+        parsed = json.loads(text[s:e+1])
+    except json.JSONDecodeError:
+        return None
+    return [p for p in parsed if isinstance(p, dict) and p.get('id') is not None] if isinstance(parsed, list) else None
+
+def _summarize_batch(batch: List[Dict[str, Any]], user_context: str, api_key: str, report: Dict[str, Any], retry_missing: bool = True) -> List[Dict[str, Any]]:
+    """
+    Sends one packed batch. When the answer is malformed, the batch is split in two and only
+    the halves are retried; ads missing from a valid answer are retried once on their own.
+    """
+    prompt = _build_summary_prompt(batch, user_context)
+    response = safe_generate_content(prompt, api_key=api_key, output_tokens=len(batch) * OUTPUT_TOKENS_PER_AD)
+    report["requests"] += 1
+    if not response:
+        # Quota or service failure: splitting would not help
+        report["failed"] += len(batch)
+        return []
+
+    usage = getattr(response, "usage_metadata", None)
+    report["prompt_tokens"] += (getattr(usage, "prompt_token_count", None) or estimate_tokens(prompt)) if usage else estimate_tokens(prompt)
+    report["output_tokens"] += (getattr(usage, "candidates_token_count", None) or 0) if usage else 0
+
+    summaries = _parse_summaries(response.text or "")
+    if summaries is None:
+        if len(batch) == 1:
+            report["failed"] += 1
+            return []
+        report["splits"] += 1
+        half = len(batch) // 2
+        set_ai_status(message=f"⚠️ Réponse IA non conforme, nouvel essai en 2 sous-lots ({half} + {len(batch) - half}).")
+        return (_summarize_batch(batch[:half], user_context, api_key, report, retry_missing)
+                + _summarize_batch(batch[half:], user_context, api_key, report, retry_missing))
+
+    expected = {str(p['id']) for p in batch}
+    summaries = [s for s in summaries if str(s['id']) in expected]
+    missing = expected - {str(s['id']) for s in summaries}
+    if missing and retry_missing and len(missing) < len(batch):
+        summaries += _summarize_batch([p for p in batch if str(p['id']) in missing], user_context, api_key, report, retry_missing=False)
+    elif missing:
+        report["failed"] += len(missing)
+    return summaries
+
+def generate_batch_summaries(ads: List[Dict[str, Any]], user_context: str = None, api_key: str = None,
+                             should_stop: Callable[[], bool] = None, user_id: int = 1) -> List[Dict[str, Any]]:
+    """
+    Generates summaries for a list of ads using Gemini.
+    Ads are packed into prompts up to AI_BATCH_TOKEN_BUDGET tokens instead of fixed-size chunks.
+    `should_stop` is checked between batches (per-job cancellation). Progress goes to `user_id`'s
+    status only; the run's token report ends up in that final status (batch_report).
+    """
+    _context.user_id = user_id
+    try:
+        return _generate_batch_summaries(ads, user_context, api_key, should_stop, user_id)
+    finally:
+        _context.user_id = None
+
+def _generate_batch_summaries(ads: List[Dict[str, Any]], user_context: str, api_key: str,
+                              should_stop: Callable[[], bool], user_id: int) -> List[Dict[str, Any]]:
     all_summaries = []
-    chunk_size = 10
-    
+
     total_ads = len(ads)
     set_ai_status(status="loading", progress=0, total=total_ads, message=f"🚀 Démarrage analyse de {total_ads} annonces...")
-    
-    for i in range(0, total_ads, chunk_size):
-        if _stop_requested:
+
+    base_tokens = estimate_tokens(_build_summary_prompt([], user_context))
+    batches = pack_batches([_ad_payload(ad) for ad in ads], base_tokens)
+    report = {"requests": 0, "splits": 0, "failed": 0, "prompt_tokens": 0, "output_tokens": 0, "ads": 0}
+
+    done = 0
+    for batch_num, batch in enumerate(batches, start=1):
+        if user_id in _stop_requested or (should_stop and should_stop()):
             print("Analyze stopped by user")
             break
 
-        chunk = ads[i:i+chunk_size]
-        current_batch_num = (i // chunk_size) + 1
-        total_batches = (total_ads + chunk_size - 1) // chunk_size
-        
         # Log detail
-        msg = f"📦 Lot {current_batch_num}/{total_batches} ({len(chunk)} annonces). Context: {(user_context[:30] + '...') if user_context else 'Standard'}"
-        set_ai_status(progress=i, total=total_ads, message=msg)
-        
-        ads_data = [{"id": ad['id'], "titre": ad['title'], "description": ad['description'][:1000]} for ad in chunk]
-        
-        prompt = f"""
-        Objectif : {user_context or "Analyse générale."}
-        Pour chaque annonce JSON, génère un résumé (2 sentences), un score (1-10) et un conseil.
-        Réponds UNIQUEMENT en JSON : [{{"id": "...", "ai_summary": "...", "ai_score": 8, "ai_tips": "..."}}, ...]
-        Données : {json.dumps(ads_data, ensure_ascii=False)}
-        """
+        msg = f"📦 Lot {batch_num}/{len(batches)} ({len(batch)} annonces). Context: {(user_context[:30] + '...') if user_context else 'Standard'}"
+        set_ai_status(progress=done, total=total_ads, message=msg)
 
         try:
-            response = safe_generate_content(prompt, api_key=api_key)
-            if response and response.text:
-                text = response.text.strip()
-                # Remove markdown code blocks if present
-                if text.startswith("```"):
-                    text = text.replace("```json", "").replace("```", "")
-                
-                s, e = text.find('['), text.rfind(']')
-                if s != -1 and e != -1:
-                    new_sums = json.loads(text[s:e+1])
-                    all_summaries.extend(new_sums)
-                    set_ai_status(message=f"✅ Lot {current_batch_num} validé : {len(new_sums)} analyses reçues.")
-                else:
-                    set_ai_status(message=f"⚠️ Lot {current_batch_num}: Réponse IA non conforme (JSON vide/invalide).")
+            new_sums = _summarize_batch(batch, user_context, api_key, report)
+            all_summaries.extend(new_sums)
+            if new_sums:
+                set_ai_status(message=f"✅ Lot {batch_num} validé : {len(new_sums)} analyses reçues.")
             else:
-                 set_ai_status(message=f"⚠️ Lot {current_batch_num}: Pas de réponse de l'IA (ou vide).")
-
-            time.sleep(1) # Little pause to be nice
+                set_ai_status(message=f"⚠️ Lot {batch_num}: Pas de réponse exploitable de l'IA.")
         except Exception as e:
-            err_msg = f"❌ Erreur technique sur le lot {current_batch_num}: {str(e)}"
+            err_msg = f"❌ Erreur technique sur le lot {batch_num}: {str(e)}"
             print(err_msg)
             set_ai_status(message=err_msg)
+        done += len(batch)
+
+    report["ads"] = len(all_summaries)
+    report["tokens_per_ad"] = round((report["prompt_tokens"] + report["output_tokens"]) / report["ads"], 1) if report["ads"] else 0
+    report["budget"] = AI_BATCH_TOKEN_BUDGET
+    print(f"[AI] {report['requests']} requête(s), {report['splits']} découpage(s), {report['tokens_per_ad']} tokens/annonce")
 
-    set_ai_status(status="idle", message=f"🎉 Terminé ! {len(all_summaries)}/{total_ads} annonces analysées avec succès.")
+    set_ai_status(status="idle", message=f"🎉 Terminé ! {len(all_summaries)}/{total_ads} annonces analysées avec succès ({report['tokens_per_ad']} tokens/annonce).",
+                  batch_report=report)
     return all_summaries
 
 
-def calculate_score(ad: Dict[str, Any], search_text: str, ideal_price: float) -> float:
+# Local pre-scoring: ranks a whole batch with NumPy before deciding what deserves an LLM call
+PRESCORE_WEIGHTS = {"price": 0.40, "keywords": 0.25, "freshness": 0.15, "distance": 0.10, "seller": 0.10}
+PRESCORE_PRICE_GUARD = 0.6 # Always send ads priced under 60% of the market median
+
+def _to_array(values) -> np.ndarray:
+    """Float column, None as NaN; element by element only when a value is not numeric."""
+    try:
+        return np.array(values, dtype=float)
+    except (TypeError, ValueError):
+        out = np.full(len(values), np.nan)
+        for i, v in enumerate(values):
+            try:
+                out[i] = float(v)
+            except (TypeError, ValueError):
+                pass
+        return out
+
+def _prescore_features(ads: List[Dict[str, Any]], search_text: str, reference_price: float = None,
+                       origin: tuple = None, radius_km: float = None, now: datetime = None) -> Dict[str, np.ndarray]:
+    """Per-signal scores in [0, 1] (NaN when the signal is missing) plus the parsed prices."""
+    now = now or datetime.now()
+    prices = _to_array([ad.get('price') for ad in ads])
+    prices[prices <= 0] = np.nan
+    if not reference_price:
+        reference_price = np.nanmedian(prices) if np.any(~np.isnan(prices)) else None
+
+    # Price: 1 at half the reference or less, 0.5 at the reference, 0 at 1.5x and above
+    if reference_price:
+        price_score = np.clip(1.0 - (prices / reference_price - 0.5), 0.0, 1.0)
+    else:
+        price_score = np.full(len(ads), np.nan)
+
+    # Keywords: share of the query words found in the title
+    words = [w for w in (search_text or '').lower().replace(',', ' ').split() if len(w) > 1]
+    if words:
+        titles = np.char.lower(np.array([ad.get('title') or '' for ad in ads], dtype=str))
+        keyword_score = np.sum([np.char.find(titles, w) >= 0 for w in words], axis=0) / len(words)
+    else:
+        keyword_score = np.full(len(ads), np.nan)
+
+    # Freshness: halves every 3 days, from the date_ts epoch column (undated: neutral)
+    age_hours = (now.timestamp() - _to_array([ad.get('date_ts') for ad in ads])) / 3600
+    freshness_score = np.exp2(-np.clip(age_hours, 0, None) / 72.0)
+
+    # Distance: 1 at the origin, 0.5 at the search radius
+    if origin and origin[0] is not None and origin[1] is not None:
+        dist = haversine_km(origin[0], origin[1], _to_array([ad.get('lat') for ad in ads]), _to_array([ad.get('lng') for ad in ads]))
+        distance_score = np.exp2(-dist / float(radius_km or 10))
+    else:
+        distance_score = np.full(len(ads), np.nan)
+
+    seller_score = np.where(_to_array([ad.get('is_pro') for ad in ads]) == 1, 0.4, 1.0)
+
+    return {"price": price_score, "keywords": keyword_score, "freshness": freshness_score,
+            "distance": distance_score, "seller": seller_score, "prices": prices, "reference": reference_price}
+
+def _weighted_score(features: Dict[str, np.ndarray]) -> np.ndarray:
+    keys = ("price", "keywords", "freshness", "distance", "seller")
+    matrix = np.vstack([features[k] for k in keys])
+    weights = np.array([PRESCORE_WEIGHTS[k] for k in keys])[:, None]
+    # Missing signals count as neutral (0.5) so they neither help nor hurt
+    matrix = np.where(np.isnan(matrix), 0.5, matrix)
+    return np.round((matrix * weights).sum(axis=0) * 10, 2)
+
+def prescore_ads(ads: List[Dict[str, Any]], search_text: str, reference_price: float = None,
+                 origin: tuple = None, radius_km: float = None, now: datetime = None) -> np.ndarray:
     """
-    Calcule un score de pertinence (0-10) basé sur le prix et le titre.
+    Scores (0-10) every ad of a batch at once from price vs. reference (market median by default),
+    keyword match, distance to `origin` (lat, lng), seller type and freshness.
     """
-    score = 5.0 # Base score
-    
-    # 1. Analyse du prix
-    try:
-        price = float(ad.get('price', 0))
-        if price > 0:
-            diff = abs(price - ideal_price) / ideal_price
-            if price <= ideal_price:
-                score += (1 - diff) * 4 # Bonus si moins cher
-            else:
-                score -= diff * 5 # Malus si plus cher
-    except: pass
+    if not ads:
+        return np.zeros(0)
+    return _weighted_score(_prescore_features(ads, search_text, reference_price, origin, radius_km, now))
 
-    # 2. Analyse du titre
-    if search_text.lower() in ad.get('title', '').lower():
-        score += 2
-    
-    return max(0, min(10, round(score, 1)))
+def get_prescore_threshold() -> float:
+    from database import get_setting
+    return float(get_setting('ai_prescore_threshold', os.getenv("AI_PRESCORE_THRESHOLD", 6.0)))
+
+def select_for_llm(ads: List[Dict[str, Any]], search_text: str, reference_price: float = None,
+                   origin: tuple = None, radius_km: float = None, threshold: float = None) -> List[Dict[str, Any]]:
+    """
+    Keeps the ads worth an LLM call, best first: pre-score above the threshold, or price far
+    below the reference (a likely pépite even with a poor title match). Each ad gets a 'prescore'.
+    """
+    if not ads:
+        return []
+    threshold = get_prescore_threshold() if threshold is None else threshold
+    features = _prescore_features(ads, search_text, reference_price, origin, radius_km)
+    scores = _weighted_score(features)
+    keep = scores >= threshold
+    if features["reference"]:
+        # Very cheap for the market and at least one query word in the title
+        with np.errstate(invalid='ignore'):
+            cheap = features["prices"] <= features["reference"] * PRESCORE_PRICE_GUARD
+        keep |= cheap & (np.nan_to_num(features["keywords"], nan=1.0) > 0)
+    order = np.argsort(-scores, kind='stable')
+    selected = []
+    for i in order[keep[order]]:
+        ads[i]['prescore'] = float(scores[i])
+        selected.append(ads[i])
+    return selected
 
 def analyze_results(search_text: str, ideal_price: float):
     """
@@ -328,63 +667,137 @@ def analyze_results(search_text: str, ideal_price: float):
     from database import get_all_ads
     ads = get_all_ads()
     
-    scored_ads = []
-    for ad in ads:
-        if search_text.lower() in ad['title'].lower() or search_text.lower() in ad['description'].lower():
-            ad['score'] = calculate_score(ad, search_text, ideal_price)
-            scored_ads.append(ad)
-    
-    scored_ads.sort(key=lambda x: x['score'], reverse=True)
+    needle = search_text.lower()
+    matching = [ad for ad in ads if needle in (ad['title'] or '').lower() or needle in (ad['description'] or '').lower()]
     
     print(f"\n--- Top 10 des annonces pour '{search_text}' (Prix idéal: {ideal_price}€) ---")
-    if not scored_ads:
+    if not matching:
         print("Aucune annonce correspondante trouvée.")
         return
 
-    for i, ad in enumerate(scored_ads[:10]):
-        print(f"#{i+1} [Score: {ad['score']}/10] {ad['title']} - {ad['price']}€")
+    scores = prescore_ads(matching, search_text, reference_price=ideal_price)
+    for rank, i in enumerate(np.argsort(-scores, kind='stable')[:10]):
+        ad = matching[i]
+        print(f"#{rank+1} [Score: {scores[i]}/10] {ad['title']} - {ad['price']}€")
         print(f"   URL: {ad['url']}")
         print(f"   Résumé IA: {ad.get('ai_summary') or 'Non disponible'}")
         print("-" * 50)
 
-def get_market_stats(query_text: str) -> Dict[str, Any]:
+def normalize_market_key(text: str) -> str:
+    return ' '.join((text or '').lower().split())
+
+def _price_bucket(ad: Dict[str, Any]) -> str:
+    """Daily history bucket of an ad (its publication day when known)."""
+    date = str(ad.get('date') or '')
+    return date[:10] if re.match(r'\d{4}-\d{2}-\d{2}', date) else datetime.now().date().isoformat()
+
+def _matches_query(ad: Dict[str, Any], key: str) -> bool:
+    return key in (ad.get('title') or '').lower() or key in (ad.get('description') or '').lower()
+
+def _market_entries(ads: List[Dict[str, Any]]) -> List[tuple]:
+    entries = []
+    for ad in ads:
+        try:
+            price = float(ad.get('price') or 0)
+        except (TypeError, ValueError):
+            continue
+        if price > 0:
+            entries.append((price, _price_bucket(ad)))
+    return entries
+
+def _seed_market_stats(user_id: int, scope: str, key: str):
     """
-    Computes statistical data for a given search query based on saved ads.
+    One-time scan that initializes an aggregate; afterwards it is only updated on ingest.
+    A query matching no ad is not tracked, and each user tracks at most
+    MAX_TRACKED_MARKET_QUERIES queries (least recently read ones are dropped).
     """
-    from database import get_all_ads
-    ads = get_all_ads()
-    
-    # Filtrage par mot-clé (simple)
-    prices = [float(ad['price']) for ad in ads 
-              if ad['price'] and (query_text.lower() in ad['title'].lower() or query_text.lower() in ad['description'].lower())]
-    
-    if not prices:
+    from database import get_all_ads, update_market_stats, prune_market_queries
+    if scope == 'watch':
+        import analytics
+        today = datetime.now().date().isoformat()
+        with analytics.reading(user_id) as cols:
+            mask = cols.mask(search_name=key) & (cols.price[:cols.size] > 0)
+            entries = [(float(price), datetime.fromtimestamp(ts).date().isoformat() if ts == ts else today)
+                       for price, ts in zip(cols.price[:cols.size][mask], cols.date_ts[:cols.size][mask])]
+    else:
+        # Free-text match on titles/descriptions, which the columnar cache does not hold
+        entries = _market_entries([ad for ad in get_all_ads(user_id=user_id) if _matches_query(ad, key)])
+        if not entries:
+            return
+    update_market_stats(user_id, scope, key, entries, seed=True)
+    if scope == 'query':
+        prune_market_queries(user_id)
+
+def record_market_prices(user_id: int, search_name: str, ads: List[Dict[str, Any]]):
+    """
+    Ingest hook: adds newly stored ads to the watch aggregate and to every tracked query
+    aggregate they match, so statistics never need a table rescan.
+    """
+    from database import update_market_stats, get_tracked_market_queries
+    entries = _market_entries(ads)
+    if not entries:
+        return
+    if not update_market_stats(user_id, 'watch', search_name, entries):
+        # First time: the seed scan already includes these ads
+        _seed_market_stats(user_id, 'watch', search_name)
+    for key in get_tracked_market_queries(user_id):
+        matching = _market_entries([ad for ad in ads if _matches_query(ad, key)])
+        if matching:
+            update_market_stats(user_id, 'query', key, matching)
+
+def get_market_stats(query_text: str = None, user_id: int = 1, search_name: str = None) -> Dict[str, Any]:
+    """
+    Market statistics for a query (or a watch) read from the incrementally maintained aggregate.
+    Percentiles come from a persisted t-digest; an unknown query is seeded once by scanning.
+    """
+    from database import get_market_aggregate, touch_market_query
+    scope, key = ('watch', search_name) if search_name else ('query', normalize_market_key(query_text))
+    if not key:
         return {"count": 0, "avg": 0, "median": 0, "min": 0, "max": 0}
-    
-    prices.sort()
-    count = len(prices)
-    avg = sum(prices) / count
-    median = prices[count // 2] if count % 2 != 0 else (prices[count // 2 - 1] + prices[count // 2]) / 2
-    
+
+    stats = get_market_aggregate(user_id, scope, key)
+    if stats is None:
+        _seed_market_stats(user_id, scope, key)
+        stats = get_market_aggregate(user_id, scope, key)
+    elif scope == 'query':
+        touch_market_query(user_id, key)
+    if not stats or not stats['count']:
+        return {"count": 0, "avg": 0, "median": 0, "min": 0, "max": 0}
+
     return {
-        "count": count,
-        "avg": round(avg, 2),
-        "median": round(median, 2),
-        "min": min(prices),
-        "max": max(prices)
+        "count": stats['count'],
+        "avg": round(stats['total'] / stats['count'], 2),
+        "median": round(stats['p50'], 2),
+        "min": stats['min'],
+        "max": stats['max'],
+        "p10": round(stats['p10'], 2),
+        "p25": round(stats['p25'], 2),
+        "p75": round(stats['p75'], 2),
+        "p90": round(stats['p90'], 2),
+        "updated_at": stats['updated_at']
     }
 
-def get_ai_market_analysis(query_text: str, ads: List[Dict[str, Any]]) -> str:
-    """
-    Asks Gemini to analyze the market trends based on a list of ads.
-    """
-    client = get_client()
-    if not client: return "IA non disponible."
-    
+def get_market_history(query_text: str = None, user_id: int = 1, search_name: str = None, days: int = 30) -> List[Dict[str, Any]]:
+    """Daily price trend (count, avg, median, min, max) from the time-bucketed aggregates."""
+    from database import get_market_history as db_history
+    scope, key = ('watch', search_name) if search_name else ('query', normalize_market_key(query_text))
+    if not key:
+        return []
+    get_market_stats(query_text, user_id=user_id, search_name=search_name) # Seeds the aggregate if needed
+    since = (datetime.now() - timedelta(days=days)).date().isoformat()
+    return [{
+        "date": b['bucket'],
+        "count": b['count'],
+        "avg": round(b['total'] / b['count'], 2) if b['count'] else 0,
+        "median": round(b['p50'], 2) if b['p50'] is not None else 0,
+        "min": b['min'],
+        "max": b['max']
+    } for b in db_history(user_id, scope, key, since)]
+
+def build_market_analysis_prompt(query_text: str, ads: List[Dict[str, Any]]) -> str:
     # Prepare data (limit to titles and prices to save tokens if many ads)
     market_data = [{"t": a['title'], "p": a['price']} for a in ads[:100]]
-    
-    prompt = f"""
+    return f"""
     Analyse le marché pour la recherche : "{query_text}"
     Voici les données des 100 dernières annonces (Titre et Prix) :
     {json.dumps(market_data, ensure_ascii=False)}
@@ -396,41 +809,57 @@ def get_ai_market_analysis(query_text: str, ads: List[Dict[str, Any]]) -> str:
     4. Un conseil stratégique pour un acheteur aujourd'hui.
     """
 
+
+def get_ai_market_analysis(query_text: str, ads: List[Dict[str, Any]], api_key: str = None) -> str:
+    """
+    Asks Gemini to analyze the market trends based on a list of ads.
+    """
     try:
-        response = safe_generate_content(prompt)
+        response = safe_generate_content(build_market_analysis_prompt(query_text, ads), api_key=api_key)
         return response.text if response else "Analyse indisponible."
     except Exception as e:
         return f"Erreur d'analyse : {e}"
 
 
+def build_comparison_prompt(ads: List[Dict[str, Any]]) -> str:
+    data = [{"t": a['title'], "p": a['price'], "d": (a.get('description') or '')[:500]} for a in ads]
+    return f"Compare ces annonces et dis laquelle est la meilleure affaire. Réponds en Markdown.\n{json.dumps(data)}"
+
 
 def generate_comparison(ads: List[Dict[str, Any]], api_key: str = None) -> str:
     """Asks Gemini to compare a list of ads and recommend the best one."""
-    data = [{"t": a['title'], "p": a['price'], "d": a.get('description', '')[:500]} for a in ads]
-    prompt = f"Compare ces annonces et dis laquelle est la meilleure affaire. Réponds en Markdown.\n{json.dumps(data)}"
-    res = safe_generate_content(prompt, api_key=api_key)
+    res = safe_generate_content(build_comparison_prompt(ads), api_key=api_key)
     return res.text if res else "Comparaison indisponible."
 
 
+def build_chat_prompt(query: str, ad_data: Dict[str, Any]) -> str:
+    ctx = f"Annonce: {ad_data['title']} ({ad_data['price']}€)\n{(ad_data.get('description') or '')[:1000]}" if ad_data else "Pas d'annonce spécifique."
+    return f"Tu es un expert Leboncoin. Voici le contexte:\n{ctx}\n\nQuestion: {query}"
+
+
 def get_chat_response(query: str, ad_data: Dict[str, Any], history: List[Dict[str, str]] = None, api_key: str = None) -> str:
     """Chat with the AI about an ad or general search."""
-    ctx = f"Annonce: {ad_data['title']} ({ad_data['price']}€)\n{ad_data.get('description', '')[:1000]}" if ad_data else "Pas d'annonce spécifique."
-    prompt = f"Tu es un expert Leboncoin. Voici le contexte:\n{ctx}\n\nQuestion: {query}"
-    res = safe_generate_content(prompt, api_key=api_key)
+    res = safe_generate_content(build_chat_prompt(query, ad_data), api_key=api_key)
     return res.text if res else "Erreur de réponse."
 
 
+def build_gem_prompt(goal: str) -> str:
+    return f"Rédige une instruction de veille Leboncoin experte pour : {goal}"
+
+
 def refine_search_query(goal: str, api_key: str = None) -> str:
     """Refines a search query into technical instructions."""
-    prompt = f"Rédige une instruction de veille Leboncoin experte pour : {goal}"
-    res = safe_generate_content(prompt, api_key=api_key)
+    res = safe_generate_content(build_gem_prompt(goal), api_key=api_key)
     return res.text.strip() if res else "Erreur."
 
 
+def build_negotiation_prompt(ad: Dict[str, Any]) -> str:
+    return f"Rédige un message de négociation poli pour : {ad['title']} à {ad['price']}€."
+
+
 def generate_negotiation_draft(ad: Dict[str, Any], api_key: str = None) -> str:
     """Generates a negotiation message."""
-    prompt = f"Rédige un message de négociation poli pour : {ad['title']} à {ad['price']}€."
-    res = safe_generate_content(prompt, api_key=api_key)
+    res = safe_generate_content(build_negotiation_prompt(ad), api_key=api_key)
     return res.text if res else "Erreur."
 
 
@@ -1,17 +1,24 @@
 import os
 import json
-from flask import Flask, render_template, jsonify, request, session, redirect, url_for
+import hashlib
+from flask import Flask, render_template, jsonify, request, session, redirect, url_for, Response, stream_with_context
 from functools import wraps
 import database
+import ad_import
+import http_cache
 import analyzer
+import ai_jobs
+import analytics
+import events
+import pipeline
 import searcher.search_providers as multi_search
 import notifiers.discord_bot as disc_bot
-import threading
+import queue
 import time
 import random
-from datetime import datetime, timedelta
+from datetime import datetime
 from nlp import parse_sentence
-from utils import get_coordinates
+from utils import get_coordinates, to_epoch, haversine_km, run_blocking
 
 app = Flask(__name__)
 
@@ -30,8 +37,33 @@ def get_current_user_id():
     return session.get('user_id', 1) # Default to 1 for back-compat or background tasks
 
 
+def sse_ai_stream(prompt: str, api_key: str = None) -> Response:
+    """
+    Forwards Gemini chunks as Server-Sent Events: `data: {"text": ...}` per chunk, then
+    `event: done` (or `event: error`). When the browser goes away, the generator is closed
+    and so is the upstream Gemini stream.
+    """
+    def generate():
+        chunks = analyzer.stream_generate_content(prompt, api_key=api_key)
+        try:
+            for text in chunks:
+                yield f"data: {json.dumps({'text': text}, ensure_ascii=False)}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'error': str(e)}, ensure_ascii=False)}\n\n"
+        finally:
+            chunks.close()
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 # Config
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'lbc-finder-super-secret-persistent-key')
+# Run the ingestion worker (refreshes, analysis, pipeline, outbox) inside the web process.
+# Set to false when worker.py processes run separately, so the web tier only serves requests.
+EMBEDDED_WORKER = os.getenv('EMBEDDED_WORKER', 'true').lower() == 'true'
+refresh_scheduler = None # Set when the worker runs in this process
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -87,20 +119,88 @@ def get_metadata():
         "departments": departments
     })
 
+def _annotate_distance(ads, origin):
+    """Adds `distance_km` (None without coordinates) to each ad, in one vectorized pass."""
+    if origin is None or not ads:
+        return
+    lats = [ad['lat'] if ad.get('lat') is not None else float('nan') for ad in ads]
+    lngs = [ad['lng'] if ad.get('lng') is not None else float('nan') for ad in ads]
+    for ad, km in zip(ads, haversine_km(origin[0], origin[1], lats, lngs).tolist()):
+        ad['distance_km'] = None if km != km else round(km, 2)
+
+
 @app.route('/api/ads')
 @login_required
 def get_ads():
-    """API endpoint to get ads, optionally filtered by search name."""
+    """
+    API endpoint to get ads, optionally filtered by search name.
+    Responses carry a strong ETag (304 on If-None-Match) and the sync cursor in X-Ads-Cursor.
+    With `since=<cursor>`, only the changes after that cursor are returned:
+    {"cursor", "changed": [visible ads], "removed": [ids hidden or moved out], "total"}.
+    `date_from` / `date_to` (ISO date or epoch seconds) restrict ads to a publication range.
+    When the user has a home point (or `lat`/`lng` are given), every ad carries `distance_km`;
+    `sort=distance` orders nearest first and `max_km` drops ads farther than that.
+    """
     user_id = get_current_user_id()
     search_name = request.args.get('search_name')
-    ads = database.get_all_ads(user_id=user_id)
-    
-    if search_name:
-        ads = [a for a in ads if a.get('search_name') == search_name]
-        
-    # Sort by date descending
-    ads.sort(key=lambda x: x.get('date') or '', reverse=True)
-    return jsonify(ads)
+    since = request.args.get('since', type=int)
+    date_from = to_epoch(request.args.get('date_from'))
+    date_to = to_epoch(request.args.get('date_to'))
+    sort = request.args.get('sort', 'date')
+    max_km = request.args.get('max_km', type=float)
+    origin = (request.args.get('lat', type=float), request.args.get('lng', type=float))
+    if origin[0] is None or origin[1] is None:
+        origin = database.get_user_home(user_id)
+    if (sort == 'distance' or max_km is not None) and origin is None:
+        return jsonify({"error": "Définissez votre adresse dans les paramètres pour trier par distance"}), 400
+
+    version = database.get_ads_version(user_id=user_id)
+    representation = f"{search_name or ''}|{'' if since is None else since}|{date_from or ''}|{date_to or ''}|{sort}|{max_km or ''}|{origin or ''}"
+    etag = hashlib.sha1(f"{user_id}|{version['cursor']}|{version['count']}|{representation}".encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    if since is not None:
+        delta = database.get_ads_changes(user_id=user_id, since=since, search_name=search_name)
+        _annotate_distance(delta['ads'], origin)
+        changed, removed = [], []
+        for ad in delta['ads']:
+            in_range = (date_from is None or (ad.get('date_ts') or 0) >= date_from) and \
+                       (date_to is None or (ad.get('date_ts') is not None and ad['date_ts'] < date_to)) and \
+                       (max_km is None or (ad['distance_km'] is not None and ad['distance_km'] <= max_km))
+            if ad.get('is_hidden') or (search_name and ad.get('search_name') != search_name) or not in_range:
+                removed.append(ad['id'])
+            else:
+                changed.append(ad)
+        response = jsonify({"cursor": delta['cursor'], "changed": changed, "removed": removed, "total": delta['total']})
+        cursor_value = delta['cursor']
+    elif sort == 'distance' or max_km is not None:
+        # Ranked over the in-memory lat/lng columns, then the rows are fetched in that order
+        ranking = analytics.distance_ranking(user_id, origin, search_name=search_name, max_km=max_km,
+                                             since_ts=date_from, until_ts=date_to)
+        rows = {}
+        ids = [ad_id for ad_id, _ in ranking]
+        for i in range(0, len(ids), 500):
+            rows.update({str(ad['id']): ad for ad in database.get_ads_by_ids(ids[i:i + 500], user_id=user_id)})
+        ads = [{**rows[ad_id], 'distance_km': km} for ad_id, km in ranking if ad_id in rows]
+        if sort != 'distance':
+            # Same order as get_ads: date_ts desc with undated ads last, then id desc
+            ads.sort(key=lambda ad: (ad.get('date_ts') is not None, ad.get('date_ts') or 0, str(ad['id'])), reverse=True)
+        response = jsonify(ads)
+        cursor_value = version['cursor']
+    else:
+        # Newest first from the date_ts index (id breaks ties so the body, hence the ETag, is stable)
+        ads = database.get_ads(user_id=user_id, search_name=search_name, since_ts=date_from, until_ts=date_to)
+        _annotate_distance(ads, origin)
+        response = jsonify(ads)
+        cursor_value = version['cursor']
+
+    response.set_etag(etag)
+    response.headers['X-Ads-Cursor'] = str(cursor_value)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 @app.route('/api/feedback', methods=['POST'])
@@ -130,7 +230,7 @@ def trigger_analysis():
         # Upsert ads if provided (Live Search case)
         if ads_data:
             print(f"📥 Received {len(ads_data)} ads to upsert/analyze.")
-            upserted_ids = []
+            upserted_ids, db_ads = [], []
             for ad in ads_data:
                 # Ensure essential fields
                 if not ad.get('id'): continue
@@ -153,9 +253,11 @@ def trigger_analysis():
                     'source': 'lbc' # Default
                 }
                 
-                # Use database.add_ad (it handles INSERT OR UPDATE)
-                database.add_ad(db_ad, user_id=user_id)
                 upserted_ids.append(db_ad['id'])
+                db_ads.append(db_ad)
+
+            # One transaction for all of them (INSERT OR UPDATE of the changed fields)
+            database.add_ads_bulk(db_ads, user_id=user_id)
             
             # If no manual IDs were requested but we upserted data, use these IDs
             if not ad_ids:
@@ -171,79 +273,29 @@ def trigger_analysis():
         if not ads_to_summarize:
             return jsonify({"status": "no_ads", "message": "Aucune annonce à analyser (DB vide ?)."})
         
-        # User specific API Key
-        user_data = database.get_user_by_id(user_id) or {}
-        user_api_key = user_data.get('google_api_key')
-        
-        # Background task function
-        def run_background_analysis(ads_list, u_id, u_api_key, c_context):
-            with app.app_context():
-                import analyzer
-                
-                # Group ads by search_name
-                from collections import defaultdict
-                grouped_ads = defaultdict(list)
-                for ad in ads_list:
-                    grouped_ads[ad['search_name']].append(ad)
-                
-                all_searches = database.get_active_searches(user_id=u_id)
-                total_summaries = 0
-                
-                processed_count = 0
-                max_batch = 40
-            
-            for search_name, ads in grouped_ads.items():
-                if processed_count >= max_batch: break
-                
-                batch = ads[:max_batch - processed_count]
-                processed_count += len(batch)
-                
-                # Use custom context if provided, else defaults
-                search_info = next((s for s in all_searches if s['name'] == search_name), {})
-                context = c_context
-                if not context:
-                    context = search_info.get('ai_context')
-                if not context or not context.strip():
-                    query = search_info.get('query_text', 'Recherche générale')
-                    context = f"L'utilisateur recherche : {query}. Analyse la pertinence par rapport à ce produit."
-                
-                print(f"--- Analyse background pour [{search_name}] ---")
-                
-                summaries = analyzer.generate_batch_summaries(batch, user_context=context, api_key=u_api_key)
-                if summaries:
-                    processed = []
-                    for s in summaries:
-                        processed.append({
-                            "id": s.get("id"),
-                            "ai_summary": s.get("ai_summary"),
-                            "ai_score": s.get("ai_score", 5.0),
-                            "ai_tips": s.get("ai_tips", "")
-                        })
-                    database.update_summaries_in_batch(processed, user_id=u_id)
-                    total_summaries += len(processed)
-
-                    # Discord Notifications
-                    webhook = search_info.get('discord_webhook') or (user_data.get('discord_webhook') if user_data else None) or database.get_setting('discord_webhook')
-                    if webhook:
-                        notifier = disc_bot.DiscordNotifier(webhook)
-                        for p in processed:
-                            if p.get('ai_score', 0) >= 8:
-                                full_ad = next((ad for ad in batch if ad['id'] == p['id']), None)
-                                if full_ad:
-                                    full_ad.update(p)
-                                    notifier.send_ad_notification(full_ad, is_pepite=True)
-            
-            print(f"--- Fin analyse background ({total_summaries} items) ---")
-
-        # Start thread
-        thread = threading.Thread(target=run_background_analysis, args=(ads_to_summarize, user_id, user_api_key, custom_context))
-        thread.daemon = True
-        thread.start()
-
+        # Selected ads and manually added ones go first, the rest is backlog
+        skipped = 0
+        if ad_ids:
+            jobs = [ai_jobs.enqueue([a['id'] for a in ads_to_summarize], user_id=user_id, priority=ai_jobs.MANUAL, custom_context=custom_context)]
+        else:
+            manual = [a['id'] for a in ads_to_summarize if a.get('source') == 'MANUAL']
+            candidates = [a for a in ads_to_summarize if a.get('source') != 'MANUAL']
+            # Backlog only reaches the LLM if the local pre-score says it is worth it
+            backlog = [a['id'] for a in ai_jobs.gate_candidates(candidates, user_id=user_id)]
+            skipped = len(candidates) - len(backlog)
+            jobs = [ai_jobs.enqueue(ids, user_id=user_id, priority=prio, custom_context=custom_context)
+                    for ids, prio in ((manual, ai_jobs.MANUAL), (backlog, ai_jobs.BACKLOG)) if ids]
+        job_ids = [j for j in jobs if j]
+
+        message = "Analyse ajoutée à la file d'attente." if job_ids else "Aucune nouvelle annonce à mettre en file d'attente."
+        if skipped:
+            message += f" {skipped} annonce(s) écartée(s) par le pré-score local."
         return jsonify({
             "status": "started", 
-            "message": "Analyse lancée en arrière-plan.",
-            "count_prediction": len(ads_to_summarize)
+            "message": message,
+            "count_prediction": len(ads_to_summarize) - skipped,
+            "skipped": skipped,
+            "job_ids": job_ids
         })
 
     except Exception as e:
@@ -266,43 +318,198 @@ def clear_analysis():
 
 
 @app.route('/api/ai-status')
+@login_required
 def get_ai_status():
-    """Returns the current background status of the AI analyzer."""
-    return jsonify(analyzer.get_ai_status())
+    """Returns the current background status of the AI analyzer and the remaining quota."""
+    user_data = database.get_user_by_id(get_current_user_id()) or {}
+    status = analyzer.get_ai_status(get_current_user_id())
+    status['quota'] = analyzer.get_quota_status(user_data.get('google_api_key'))
+    return jsonify(status)
+
+@app.route('/api/events')
+@login_required
+def live_events():
+    """
+    Server-Sent Events stream of the user's live updates (new ads, price drops, AI status
+    and job progress, watch counters). Replaces the dashboard polling loops.
+    """
+    user_id = get_current_user_id()
+    api_key = (database.get_user_by_id(user_id) or {}).get('google_api_key')
+
+    def generate():
+        q = events.subscribe(user_id)
+        try:
+            yield "retry: 5000\n\n"
+            status = analyzer.get_ai_status(user_id)
+            status['quota'] = analyzer.get_quota_status(api_key)
+            yield events.format_sse(events.AI_STATUS, status)
+            while True:
+                try:
+                    kind, data = q.get(timeout=events.HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if kind == events.AI_STATUS:
+                    data = {**data, 'quota': analyzer.get_quota_status(api_key)}
+                yield events.format_sse(kind, data)
+        finally:
+            events.unsubscribe(user_id, q)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/stop-analysis', methods=['POST'])
 @login_required
 def stop_analysis_route():
-    analyzer.stop_analysis()
-    return jsonify({"status": "success", "message": "Arrêt demandé."})
+    """Cancels all queued and running AI jobs of the current user."""
+    user_id = get_current_user_id()
+    cancelled = database.cancel_ai_jobs(user_id)
+    analyzer.set_ai_status(status="idle", message="🛑 Analyse arrêtée par l'utilisateur.", user_id=user_id)
+    return jsonify({"status": "success", "message": "Arrêt demandé.", "cancelled": cancelled})
+
+@app.route('/api/ai-jobs')
+@login_required
+def list_ai_jobs():
+    """Lists the AI jobs of the current user with their progress."""
+    return jsonify(database.get_ai_jobs(user_id=get_current_user_id()))
+
+@app.route('/api/ai-jobs/<int:job_id>')
+@login_required
+def get_ai_job(job_id):
+    job = database.get_ai_job(job_id, user_id=get_current_user_id())
+    return jsonify(job) if job else (jsonify({"error": "Job introuvable"}), 404)
+
+@app.route('/api/ai-jobs/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_ai_job(job_id):
+    if database.cancel_ai_jobs(get_current_user_id(), job_id=job_id):
+        return jsonify({"status": "success", "message": "Annulation demandée."})
+    return jsonify({"error": "Job introuvable ou déjà terminé"}), 404
 
 @app.route('/api/stats')
 @login_required
 def get_stats():
     """Get basic statistics for the dashboard."""
+    # Vectorized over the in-memory columns, no table scan
+    return jsonify(analytics.dashboard_stats(user_id=get_current_user_id()))
+
+
+# --- Map Routes ---
+MAP_CLUSTER_CELL_PX = 60 # Grid cell edge on screen
+MAP_MAX_CLUSTER_ZOOM = 14 # From this zoom on, pins are served unclustered
+MAP_MAX_PINS = 2000
+
+def _parse_bbox(value: str):
+    """Leaflet's toBBoxString() order 'west,south,east,north' -> (south, west, north, east)."""
+    try:
+        west, south, east, north = (float(v) for v in value.split(','))
+    except (AttributeError, ValueError):
+        return None
+    return south, west, north, east
+
+
+@app.route('/api/map/ads')
+@login_required
+def map_ads():
+    """Stored ads inside the bbox (capped by `limit`), with the total number of matches."""
+    bbox = _parse_bbox(request.args.get('bbox'))
+    if bbox is None:
+        return jsonify({"error": "Paramètre bbox invalide (ouest,sud,est,nord)"}), 400
+    limit = min(request.args.get('limit', 500, type=int), 2000)
+    return jsonify(database.get_ads_in_bbox(bbox, user_id=get_current_user_id(),
+                                            search_name=request.args.get('search_name'), limit=limit))
+
+
+@app.route('/api/map/nearby')
+@login_required
+def map_nearby():
+    """Stored ads within `km` of lat/lng, nearest first."""
+    lat, lng = request.args.get('lat', type=float), request.args.get('lng', type=float)
+    km = request.args.get('km', 10, type=float)
+    if lat is None or lng is None or not km or km <= 0:
+        return jsonify({"error": "Paramètres lat, lng et km requis"}), 400
+    limit = min(request.args.get('limit', 500, type=int), 2000)
+    return jsonify(database.get_ads_near(lat, lng, km, user_id=get_current_user_id(),
+                                         search_name=request.args.get('search_name'), limit=limit))
+
+
+@app.route('/api/map/clusters')
+@login_required
+def map_clusters():
+    """
+    Zoom-level aggregates for the map: one cluster per non-empty grid cell of the bbox.
+    Cells holding a single ad come back as that ad's pin instead.
+    """
+    bbox = _parse_bbox(request.args.get('bbox'))
+    zoom = request.args.get('zoom', 6, type=int)
+    if bbox is None:
+        return jsonify({"error": "Paramètre bbox invalide (ouest,sud,est,nord)"}), 400
     user_id = get_current_user_id()
-    all_ads = database.get_all_ads(user_id=user_id)
-    without_summary = len(database.get_ads_without_summary(user_id=user_id))
-    
-    avg_price = 0
-    if all_ads:
-        prices = [float(a['price']) for a in all_ads if a['price']]
-        if prices:
-            avg_price = round(sum(prices) / len(prices), 2)
+    search_name = request.args.get('search_name')
 
-    return jsonify({
-        "total_ads": len(all_ads),
-        "pending_ai": without_summary,
-        "avg_price": avg_price
-    })
+    if zoom >= MAP_MAX_CLUSTER_ZOOM:
+        result = database.get_ads_in_bbox(bbox, user_id=user_id, search_name=search_name, limit=MAP_MAX_PINS)
+        return jsonify({"zoom": zoom, "clusters": [], "pins": [events.ad_brief(ad) | {'lat': ad['lat'], 'lng': ad['lng']} for ad in result['ads']]})
+
+    # Web Mercator: 256 px tiles, the world is 256 * 2^zoom px wide
+    cell_deg = 360.0 * MAP_CLUSTER_CELL_PX / (256 * 2 ** max(zoom, 0))
+    clusters, single_ids = [], []
+    for cluster in database.get_ad_clusters(bbox, cell_deg, user_id=user_id, search_name=search_name):
+        if 'ad_id' in cluster:
+            single_ids.append(cluster['ad_id'])
+        else:
+            clusters.append(cluster)
+    pins = [events.ad_brief(ad) | {'lat': ad['lat'], 'lng': ad['lng']}
+            for ad in database.get_ads_by_ids(single_ids[:MAP_MAX_PINS], user_id=user_id)] if single_ids else []
+    return jsonify({"zoom": zoom, "clusters": clusters, "pins": pins})
+
+
+@app.route('/api/http-cache/stats')
+@login_required
+def http_cache_stats():
+    """Page fetch cache metrics: hits, revalidations (304), misses, evictions, size."""
+    return jsonify(http_cache.stats())
+
+
+@app.route('/api/scheduler/stats')
+@login_required
+def scheduler_stats():
+    """
+    Auto-refresh queue: job counts, live workers and refresh lateness from the jobs table, the
+    elected leader, plus per-watch scheduling debt when the scheduler runs in this process.
+    """
+    user_id = get_current_user_id()
+    stats = {**database.get_job_stats(user_id=user_id), "leaders": database.get_leaders()}
+    if refresh_scheduler is not None:
+        stats["scheduler"] = refresh_scheduler.stats(user_id=user_id)
+    return jsonify(stats)
+
+
+@app.route('/api/notifications/outbox')
+@login_required
+def notification_outbox_stats():
+    """Discord outbox counts for the current user: pending, sending, sent, failed."""
+    return jsonify(database.get_outbox_stats(user_id=get_current_user_id()))
 
 
 # --- Market Analysis Routes ---
 @app.route('/api/market-stats')
+@login_required
 def market_stats():
     query = request.args.get('query', '')
-    if not query: return jsonify({})
-    return jsonify(analyzer.get_market_stats(query))
+    watch = request.args.get('watch')
+    if not query and not watch: return jsonify({})
+    return jsonify(analyzer.get_market_stats(query, user_id=get_current_user_id(), search_name=watch))
+
+@app.route('/api/market-stats/history')
+@login_required
+def market_stats_history():
+    """Daily price trend for a query or a watch, served from the time-bucketed aggregates."""
+    query = request.args.get('query', '')
+    watch = request.args.get('watch')
+    if not query and not watch: return jsonify([])
+    days = request.args.get('days', 30, type=int)
+    return jsonify(analyzer.get_market_history(query, user_id=get_current_user_id(), search_name=watch, days=days))
 
 @app.route('/api/ai-market-analysis')
 def ai_market_analysis():
@@ -316,6 +523,18 @@ def ai_market_analysis():
     analysis = analyzer.get_ai_market_analysis(query, relevant_ads)
     return jsonify({"analysis": analysis})
 
+@app.route('/api/ai-market-analysis/stream')
+@login_required
+def stream_ai_market_analysis():
+    """Streaming variant of /api/ai-market-analysis (SSE, usable with EventSource)."""
+    query = request.args.get('query', '')
+    if not query: return jsonify({"error": "Query required"}), 400
+
+    user_id = get_current_user_id()
+    user_data = database.get_user_by_id(user_id) or {}
+    relevant_ads = [a for a in database.get_all_ads(user_id=user_id) if query.lower() in a['title'].lower()]
+    return sse_ai_stream(analyzer.build_market_analysis_prompt(query, relevant_ads), api_key=user_data.get('google_api_key'))
+
 
 # --- Search Management Routes ---
 @app.route('/api/searches', methods=['GET', 'POST'])
@@ -407,7 +626,7 @@ def manage_searches():
                 if initial_ads:
                     for ad in initial_ads:
                         ad['search_name'] = search_data['name']
-                        database.add_ad(ad, user_id=user_id)
+                    database.add_ads_bulk(initial_ads, user_id=user_id)
                 return jsonify({"status": "success", "search": search_data})
             
             return jsonify({"status": "error", "message": "Erreur base de données lors de la sauvegarde"}), 500
@@ -445,6 +664,16 @@ def update_search(name):
     data = request.json
     if 'platforms' in data:
         data['platforms'] = json.dumps(data['platforms'])
+    # Quiet hours: local hours 0-23, empty to disable
+    for key in ('quiet_start', 'quiet_end'):
+        if key in data:
+            value = data[key]
+            if value in (None, ''):
+                data[key] = None
+            elif not str(value).isdigit() or not 0 <= int(value) <= 23:
+                return jsonify({"status": "error", "message": "Heures calmes : heure entre 0 et 23 attendue"}), 400
+            else:
+                data[key] = int(value)
     
     if database.update_search_settings(name, data, user_id=user_id):
         return jsonify({"status": "success"})
@@ -462,6 +691,10 @@ def manage_settings():
         return jsonify({
             "discord_webhook": user_data.get('discord_webhook', '') if user_data else '',
             "google_api_key": user_data.get('google_api_key', '') if user_data else '',
+            "home_city": user_data.get('home_label') or '' if user_data else '',
+            "home_lat": user_data.get('home_lat') if user_data else None,
+            "home_lng": user_data.get('home_lng') if user_data else None,
+            "digest_hour": user_data.get('digest_hour') if user_data else 8,
             "default_ai_context": database.get_setting('default_ai_context', 'Analyse générale de la qualité et du prix.'),
             "default_refresh_mode": database.get_setting('default_refresh_mode', 'manual'),
             "default_refresh_interval": int(database.get_setting('default_refresh_interval', 60)),
@@ -474,6 +707,25 @@ def manage_settings():
     user_updates = {}
     if 'discord_webhook' in data: user_updates['discord_webhook'] = data['discord_webhook']
     if 'google_api_key' in data: user_updates['google_api_key'] = data['google_api_key']
+    if 'digest_hour' in data:
+        # Local hour of the daily digest, empty to disable it
+        hour = data['digest_hour']
+        if hour in (None, ''):
+            user_updates['digest_hour'] = None
+        elif not str(hour).isdigit() or not 0 <= int(hour) <= 23:
+            return jsonify({"status": "error", "message": "Heure du récapitulatif : heure entre 0 et 23 attendue"}), 400
+        else:
+            user_updates['digest_hour'] = int(hour)
+    if 'home_city' in data:
+        # Home point for distance sorting: geocoded city, or cleared when empty
+        home_city = (data['home_city'] or '').strip()
+        if not home_city:
+            user_updates.update(home_lat=None, home_lng=None, home_label=None)
+        elif home_city != (user_data or {}).get('home_label'):
+            coords = get_coordinates(home_city)
+            if not coords:
+                return jsonify({"status": "error", "message": f"Ville introuvable : {home_city}"}), 400
+            user_updates.update(home_lat=coords[0], home_lng=coords[1], home_label=home_city)
     if user_updates:
         database.update_user_settings(user_id, user_updates)
             
@@ -557,7 +809,7 @@ def quick_search():
             except AttributeError:
                 pass
 
-    client = lbc.Client()
+    client = run_blocking(lbc.Client) # Opens its session with a request
     all_ads = []
     
     lbc_sort = lbc.Sort.NEWEST if sort == 'newest' else lbc.Sort.RELEVANCE
@@ -580,7 +832,7 @@ def quick_search():
                 if page > 1:
                     time.sleep(random.randint(2, 5))
                 
-                res = client.search(
+                res = run_blocking(client.search,
                     text=q,
                     locations=locations if locations else None,
                     category=lbc_category,
@@ -627,7 +879,7 @@ def quick_search():
     
     # Sort ONLY if user asked for newest. If relevance, keep API order as much as possible
     if sort == 'newest':
-        sorted_ads = sorted(unique_ads, key=lambda x: x.get('date') or '', reverse=True)
+        sorted_ads = sorted(unique_ads, key=lambda x: to_epoch(x.get('date')) or 0, reverse=True)
     else:
         # Keep original order but deduplicated
         sorted_ads = list(unique_ads) 
@@ -649,6 +901,16 @@ def compare_ads():
     recommendation = analyzer.generate_comparison(ads, api_key=api_key)
     return jsonify({"recommendation": recommendation})
 
+@app.route('/api/compare/stream', methods=['POST'])
+@login_required
+def stream_compare_ads():
+    """Streaming variant of /api/compare (SSE)."""
+    user_data = database.get_user_by_id(get_current_user_id()) or {}
+    ads = (request.json or {}).get('ads', [])
+    if not ads:
+        return jsonify({"error": "No ads selected"}), 400
+    return sse_ai_stream(analyzer.build_comparison_prompt(ads), api_key=user_data.get('google_api_key'))
+
 @app.route('/api/gem-builder', methods=['POST'])
 @login_required
 def gem_builder():
@@ -661,6 +923,15 @@ def gem_builder():
     instructions = analyzer.refine_search_query(goal, api_key=api_key)
     return jsonify({"instructions": instructions})
 
+@app.route('/api/gem-builder/stream', methods=['POST'])
+@login_required
+def stream_gem_builder():
+    """Streaming variant of /api/gem-builder (SSE)."""
+    user_data = database.get_user_by_id(get_current_user_id()) or {}
+    goal = (request.json or {}).get('goal', '')
+    if not goal: return jsonify({"error": "Empty goal"}), 400
+    return sse_ai_stream(analyzer.build_gem_prompt(goal), api_key=user_data.get('google_api_key'))
+
 
 @app.route('/api/scam-detector', methods=['POST'])
 @login_required
@@ -733,6 +1004,19 @@ def trigger_negotiation():
     draft = analyzer.generate_negotiation_draft(ad[0], api_key=api_key)
     return jsonify({"draft": draft})
 
+@app.route('/api/negotiate/stream', methods=['POST'])
+@login_required
+def stream_negotiation():
+    """Streaming variant of /api/negotiate (SSE)."""
+    user_id = get_current_user_id()
+    user_data = database.get_user_by_id(user_id) or {}
+
+    ad_id = (request.json or {}).get('ad_id')
+    if not ad_id: return jsonify({"error": "ID required"}), 400
+    ad = database.get_ads_by_ids([ad_id], user_id=user_id)
+    if not ad: return jsonify({"error": "Ad not found"}), 404
+    return sse_ai_stream(analyzer.build_negotiation_prompt(ad[0]), api_key=user_data.get('google_api_key'))
+
 @app.route('/api/chat', methods=['POST'])
 @login_required
 def trigger_chat():
@@ -754,6 +1038,23 @@ def trigger_chat():
     response = analyzer.get_chat_response(message, ad_data, history, api_key=api_key)
     return jsonify({"response": response})
 
+@app.route('/api/chat/stream', methods=['POST'])
+@login_required
+def stream_chat():
+    """Streaming variant of /api/chat (SSE)."""
+    user_id = get_current_user_id()
+    user_data = database.get_user_by_id(user_id) or {}
+
+    data = request.json or {}
+    message = data.get('message') or data.get('query', '')
+    if not message: return jsonify({"error": "Empty message"}), 400
+
+    ad_data = None
+    if data.get('ad_id'):
+        ads = database.get_ads_by_ids([data['ad_id']], user_id=user_id)
+        if ads: ad_data = ads[0]
+    return sse_ai_stream(analyzer.build_chat_prompt(message, ad_data), api_key=user_data.get('google_api_key'))
+
 @app.route('/api/ads/manual', methods=['POST'])
 @login_required
 def add_manual_ad():
@@ -765,212 +1066,12 @@ def add_manual_ad():
     
     if not url: return jsonify({"error": "URL required"}), 400
     
-    import requests
-    from bs4 import BeautifulSoup
-    import re
-    import json
-    from datetime import datetime
-    
     try:
-        # Robust ID extraction
-        id_match = re.search(r'/(\d+)(?:\.htm|/|$|\?)', url)
-        if not id_match:
-            return jsonify({"error": "Impossible d'extraire l'ID de l'annonce."}), 400
-        ad_id = id_match.group(1)
-        
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8",
-            "Accept-Language": "fr-FR,fr;q=0.9,en-US;q=0.8,en;q=0.7"
-        }
-        
-        ad_title = "Annonce Leboncoin"
-        ad_price = 0
-        ad_image = None
-        ad_description = "Pas de description."
-        ad_location = "France"
-        
-        try:
-            resp = requests.get(url, headers=headers, timeout=10)
-            if resp.status_code == 200:
-                # STAGE 1: Try application/ld+json (Highly reliable for SEO)
-                soup = BeautifulSoup(resp.text, 'html.parser')
-                ld_scripts = soup.find_all('script', type='application/ld+json')
-                for script in ld_scripts:
-                    try:
-                        ld_data = json.loads(script.string)
-                        # LD+JSON can be a list or a single object
-                        items = ld_data if isinstance(ld_data, list) else [ld_data]
-                        for item in items:
-                                if item.get('@type') == 'Product':
-                                    ad_title = item.get('name', ad_title)
-                                    images = item.get('image')
-                                    if images:
-                                        ad_image = images[0] if isinstance(images, list) else images
-                                    offers = item.get('offers')
-                                    if offers:
-                                        price = offers.get('price') if isinstance(offers, dict) else offers[0].get('price') if isinstance(offers, list) else 0
-                                        ad_price = float(price) if price else ad_price
-                                    ad_description = item.get('description', ad_description)
-                                    
-                                    # Try extracting location from LD+JSON
-                                    loc = item.get('location') or item.get('address')
-                                    if isinstance(loc, dict):
-                                        if '@type' in loc and loc['@type'] == 'Place':
-                                            addr = loc.get('address', {})
-                                            city = addr.get('addressLocality')
-                                            zipcode = addr.get('postalCode')
-                                            if city:
-                                                ad_location = f"{city} ({zipcode})" if zipcode else city
-                    except: continue
-
-                # STAGE 2: Try window.__REDUX_STATE__ (Internal Data)
-                if ad_location == "France": # Only try Redux if location not found yet
-                    match = re.search(r'window\.__REDUX_STATE__\s*=\s*({.*?});', resp.text, re.DOTALL)
-                    if match:
-                        try:
-                            state = json.loads(match.group(1))
-                            
-                            if ad_id in ["3075046375", "3126232591"]:
-                                print(f"DEBUG REDUX: Keys in State: {state.keys()}")
-                                print(f"DEBUG REDUX: adview keys: {state.get('adview', {}).keys()}")
-                            
-                            # Try multiple paths for ad data
-                            ad_data = state.get('adview', {}).get('adData', {}) or \
-                                      state.get('ad', {}).get('adData', {}) or \
-                                      state.get('adview', {}).get('data', {})
-                            
-                            if ad_data:
-                                if ad_title == "Annonce Leboncoin":
-                                    ad_title = ad_data.get('subject', ad_title)
-                                if ad_price == 0:
-                                    ad_price = ad_data.get('price', [0])[0] if isinstance(ad_data.get('price'), list) else ad_data.get('price', 0)
-                                if ad_description == "Pas de description.":
-                                    ad_description = ad_data.get('body', ad_description)
-                                
-                                # Precise location from Redux
-                                loc = ad_data.get('location', {})
-                                city = loc.get('city_label') or loc.get('city')
-                                zipcode = loc.get('zipcode') or loc.get('zip_code')
-                                if city:
-                                    ad_location = f"{city} ({zipcode})" if zipcode else city
-                                
-                                # coordinates
-                                lat = loc.get('lat')
-                                lng = loc.get('lng')
-
-                                images = ad_data.get('images', {}).get('urls', [])
-                                if images and not ad_image: ad_image = images[0]
-
-                        except: pass
-                
-                # STAGE 3: Fallback Regex for Location if still generic (executed only if needed)
-                if ad_location == "France" or not ad_location:
-                    for tag in soup.find_all(['h2', 'p', 'div', 'span']):
-                        txt = tag.get_text(" ", strip=True) # Join with space to avoid glued words
-                        # Regex for City Zipcode (e.g., "Paris 75001" or "Zone 09209")
-                        # We allow "Zone" now as it appears in valid LBC ads.
-                        match = re.search(r'([A-Za-zÀ-ÖØ-öø-ÿ\-\s]+)\s+(\d{5})', txt)
-                        
-                        # Avoid huge texts, looking for short location strings
-                        if match and len(txt) < 60:
-                             candidates_city = match.group(1).strip()
-                             # Filter out common false positives like "depuis le" or "livraison" if they match accidentaly
-                             if "livraison" in candidates_city.lower(): continue
-                             
-                             ad_location = f"{candidates_city} ({match.group(2)})"
-                             break
-
-
-                # STAGE 3: Mega Fallback (Meta Tags & Regex)
-                # Image
-                if not ad_image:
-                    for meta_prop in ['og:image', 'twitter:image', 'image']:
-                        m = soup.find('meta', property=meta_prop) or soup.find('meta', attrs={"name": meta_prop})
-                        if m: 
-                            ad_image = m.get('content')
-                            break
-                
-                # Location (Refined Search)
-                if ad_location == "France":
-                    # 1. Search in breadcrumbs (Very reliable)
-                    breadcrumbs = soup.find_all(attrs={"data-qa-id": re.compile(r'breadcrumb', re.I)})
-                    for bc in reversed(breadcrumbs):
-                        text = bc.get_text().strip()
-                        if re.search(r'\d{5}', text):
-                            ad_location = text
-                            break
-                    
-                    # 2. Search in specific LBC location markers
-                    if ad_location == "France":
-                        loc_tag = soup.find(attrs={"data-qa-id": re.compile(r'location|city|adview_location', re.I)}) or \
-                                  soup.find(class_=re.compile(r'location', re.I))
-                        if loc_tag:
-                            cand = loc_tag.get_text().strip()
-                            if cand and len(cand) < 100:
-                                ad_location = cand
-                    
-                    # 3. Regex Fallback (Stricter: 5 digits zip code)
-                    if ad_location == "France" or "92100" in ad_location:
-                        # Regex for "City (ZipCode)" or "City ZipCode"
-                        # We exclude common brands and technical terms
-                        excluded = ['prix', 'date', 'offre', 'vendeur', 'annonce', 'toutes', 'peerless', 'focal', 'cabasse', 'denon', 'sony', 'philips', 'samsung', 'rel', 'haut', 'parleur']
-                        
-                        # Try searching in title/desc first
-                        search_space = (soup.title.string if soup.title else '') + " "
-                        meta_desc = soup.find('meta', attrs={'name': 'description'})
-                        if meta_desc: search_space += meta_desc.get('content', '') + " "
-                        search_space += resp.text[:15000] # Search first 15k chars
-
-                        loc_matches = re.finditer(r'([A-ZÀ-Ÿ][a-zà-ÿ\s\-]{3,})\s?\(?(\d{5})\)?', search_space)
-                        for match in loc_matches:
-                            cityName = match.group(1).strip()
-                            zipCode = match.group(2)
-                            if cityName.lower() not in excluded and zipCode not in ['92100', '75000']:
-                                ad_location = f"{cityName} ({zipCode})"
-                                break
-
-                        
-                        # Last ditch: any 5 digit code that's not LBC HQ
-                        if ad_location == "France" or "92100" in ad_location:
-                            codes = re.findall(r'(\d{5})', search_space)
-                            for c in codes:
-                                if c not in ['92100', '75000']:
-                                    # Look for a word before it
-                                    surround = re.search(r'([A-ZÀ-Ÿ][a-zà-ÿ\s\-]{3,})\s?\(?' + c + r'\)?', search_space)
-                                    if surround and surround.group(1).strip().lower() not in excluded:
-                                        ad_location = f"{surround.group(1).strip()} ({c})"
-                                        break
-                                    else:
-                                        ad_location = f"Zone {c}"
-                                        break
-
-                # Price fallback regex if still 0
-
-                if ad_price == 0:
-                    price_match = re.search(r'(\d+[\s]?\d*)\s*€', resp.text)
-                    if price_match:
-                        ad_price = float(price_match.group(1).replace(' ', '').replace('\xa0', ''))
-
-        except Exception as scrap_e:
-            print(f"[Manual Add] Advanced extraction failed: {scrap_e}")
-
-        ad = {
-            "id": ad_id,
-
-            "title": ad_title,
-            "url": url,
-            "price": ad_price,
-            "image_url": ad_image,
-            "description": ad_description,
-            "location": ad_location,
-            "search_name": search_name,
-            "is_pro": 0,
-            "date": datetime.now().isoformat(),
-            "source": "MANUAL",
-            "is_hidden": 0
-        }
-        
+        result = ad_import.fetch_ad(url, search_name)
+        if not result['id']:
+            return jsonify({"error": result['error']}), 400
+        ad = result['ad']
+
         # Force add even if exists to update info? OR keep as is
         # Overwrite=True in database.add_ad would be better
         success, _, _ = database.add_ad(ad, user_id=user_id)
@@ -981,6 +1082,51 @@ def add_manual_ad():
         print(f"[Manual Add Error] {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/ads/import', methods=['POST'])
+@login_required
+def import_ads():
+    """
+    Bulk import of ad URLs ({"urls": [...]} or pasted {"text"}), streamed as NDJSON:
+    one {"type": "fetched", "url", "id", "status", "error"?} line per URL as pages come in,
+    then one {"type": "saved", "id", "outcome"} line per ad after a single bulk write,
+    and a final {"type": "summary", ...}.
+    """
+    user_id = get_current_user_id()
+    data = request.get_json(silent=True) or {}
+    search_name = data.get('search_name') or 'Ajout Manuel'
+    urls, text = data.get('urls') or [], data.get('text') or ''
+    if isinstance(urls, str):
+        urls = [urls] # A pasted block sent as urls is read like text
+    if not isinstance(urls, list) or not all(isinstance(u, str) for u in urls) or not isinstance(text, str):
+        return jsonify({"error": "'urls' doit être une liste de chaînes et 'text' une chaîne."}), 400
+    urls = ad_import.extract_urls('\n'.join(urls) + '\n' + text)
+    if not urls:
+        return jsonify({"error": "Aucune URL d'annonce valide."}), 400
+    if len(urls) > ad_import.MAX_IMPORT_URLS:
+        return jsonify({"error": f"{ad_import.MAX_IMPORT_URLS} URLs maximum par import."}), 400
+
+    def generate():
+        ads, failed = [], 0
+        for result in ad_import.fetch_ads(urls, search_name):
+            line = {"type": "fetched", "url": result['url'], "id": result['id'], "status": result['status']}
+            if result['status'] == 'parsed':
+                ads.append(result['ad'])
+            else:
+                failed += 1
+                line["error"] = result.get('error')
+            yield json.dumps(line, ensure_ascii=False) + "\n"
+
+        report = database.add_ads_bulk(ads, user_id=user_id)
+        for ad, outcome, _ in report['outcomes']:
+            yield json.dumps({"type": "saved", "id": ad['id'], "outcome": outcome}) + "\n"
+        if report['new'] or report['changed']:
+            pipeline.notify()
+        yield json.dumps({"type": "summary", "total": len(urls), "new": report['new'], "changed": report['changed'],
+                          "unchanged": report['unchanged'], "failed": failed + report['failed']}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/searches/<path:name>/refresh', methods=['POST'])
 
 @login_required
@@ -1002,7 +1148,7 @@ def refresh_search(name, user_id=1):
     if not search:
         return jsonify({"error": "Recherche introuvable"}), 404
 
-    client = lbc.Client()
+    client = run_blocking(lbc.Client) # Opens its session with a request
     locations = []
     
     # Multi-location support
@@ -1074,7 +1220,7 @@ def refresh_search(name, user_id=1):
                         print(f"  [Stealth] Waiting {delay}s before page {page}...")
                         time.sleep(delay)
 
-                    res = client.search(
+                    res = run_blocking(client.search,
                         text=query,
                         locations=locations if locations else None,
                         category=category,
@@ -1087,6 +1233,8 @@ def refresh_search(name, user_id=1):
                     )
                     
                     for ad in res.ads:
+                        # Details the search payload already carries; the rest is fetched lazily (enrichment.py)
+                        ad_location = getattr(ad, 'location', None)
                         all_new_ads.append({
                             'id': str(ad.id),
                             'search_name': search['name'],
@@ -1097,6 +1245,10 @@ def refresh_search(name, user_id=1):
                             'url': ad.url,
                             'image_url': ad.images[0] if ad.images else None,
                             'is_pro': 1 if getattr(ad, 'owner_type', None) == lbc.OwnerType.PRO else 0,
+                            'description': getattr(ad, 'body', None),
+                            'lat': getattr(ad_location, 'lat', None),
+                            'lng': getattr(ad_location, 'lng', None),
+                            'category': getattr(ad, 'category_name', None),
                             'source': 'LBC'
                         })
                     
@@ -1112,66 +1264,32 @@ def refresh_search(name, user_id=1):
         ad['search_name'] = search['name']
         all_new_ads.append(ad)
 
-    new_count = 0
     pépites = []
     price_drops = []
 
-    for ad in all_new_ads:
-        success, dropped, is_new = database.add_ad(ad, user_id=user_id)
-        if success:
-            if is_new:
-                new_count += 1
-            if dropped:
-                price_drops.append(ad)
-            
-            if ad.get('ai_score') and ad['ai_score'] >= 8:
-                pépites.append(ad)
+    # One transaction for the whole refresh; unchanged ads are not rewritten
+    report = database.add_ads_bulk(all_new_ads, user_id=user_id)
+    for ad, outcome, dropped in report['outcomes']:
+        if outcome == database.AD_FAILED:
+            continue
+        if dropped:
+            price_drops.append(ad)
+        if ad.get('ai_score') and ad['ai_score'] >= 8:
+            pépites.append(ad)
+    new_count = report[database.AD_NEW]
             
     database.update_search_last_run(name, user_id=user_id)
 
     
-    # Discord Notifications
-    # 1. Use search-specific webhook if exists, fallback to global
-    webhook = search.get('discord_webhook') or database.get_setting('discord_webhook')
-    
-    # Auto-analysis for Discord (check the 3 newest ads if they are not already scored)
-    if webhook:
-        to_analyze = [ad for ad in all_new_ads if not ad.get('ai_score')][:3]
-        if to_analyze:
-            # Fallback for context
-            ctx = search.get('ai_context')
-            if not ctx or not ctx.strip():
-                ctx = database.get_setting('default_ai_context', f"Recherche de : {search.get('query_text', 'Produit')}")
-            
-            # User specific API Key
-            user_data = database.get_user_by_id(user_id)
-            api_key = user_data.get('google_api_key') if user_data else None
-
-            processed = analyzer.generate_batch_summaries(to_analyze, ctx, api_key=api_key)
-            database.update_summaries_in_batch(processed, user_id=user_id)
-            # Refresh local data
-            for p in processed:
-                for ad in all_new_ads:
-                    if ad['id'] == p['id']:
-                        ad.update(p)
-                        if ad.get('ai_score', 0) >= 8 and ad not in pépites:
-                            pépites.append(ad)
-
-
-    if webhook and (pépites or price_drops):
-        notifier = disc_bot.DiscordNotifier(webhook)
-        for p in pépites:
-            content = None
-            if p.get('ai_score', 0) >= 9:
-                content = "🚨 **ALERTE PÉPITE EXCEPTIONNELLE !** @everyone"
-            notifier.send_ad_notification(p, is_pepite=True, content=content)
-        for d in price_drops:
-            notifier.send_ad_notification(d, price_drop=True)
+    # Analysis and Discord delivery run in the pipeline stages, which read the ad_events log
+    pipeline.notify()
 
     return jsonify({
         "status": "success", 
-        "message": f"Actualisation terminée : {new_count} nouvelle(s) annonce(s).",
+        "message": f"Actualisation terminée : {new_count} nouvelle(s), {report[database.AD_CHANGED]} modifiée(s), {report[database.AD_UNCHANGED]} inchangée(s).",
         "new_count": new_count,
+        "changed_count": report[database.AD_CHANGED],
+        "unchanged_count": report[database.AD_UNCHANGED],
         "pépites": pépites,
         "price_drops": price_drops
     })
@@ -1232,89 +1350,28 @@ def trigger_auto_refresh():
         
     return jsonify({"status": "success", "refreshed": results})
 
-def send_daily_digest():
-    """Compiles and sends a daily digest of the best 'pépites'."""
-    webhook = database.get_setting('discord_webhook')
-    if not webhook: return
-    
-    last_digest = database.get_setting('last_daily_digest')
-    now = datetime.now()
-    
-    # Send at 8:00 AM once a day
-    if now.hour == 8 and (not last_digest or now.date() > datetime.fromisoformat(last_digest).date()):
-        print("☀️ Generating Daily Digest for Discord...")
-        all_ads = database.get_all_ads()
-        # Last 24h pepites
-        yesterday = now - timedelta(days=1)
-        pepites = [a for a in all_ads if (a.get('ai_score') or 0) >= 8 and a.get('date', '') > yesterday.isoformat()]
-        pepites.sort(key=lambda x: x.get('ai_score', 0), reverse=True)
-        top_5 = pepites[:5]
-        
-        if top_5:
-            notifier = disc_bot.DiscordNotifier(webhook)
-            embeds = []
-            for ad in top_5:
-                embeds.append({
-                    "title": f"🏆 {ad['title']}",
-                    "url": ad['url'],
-                    "description": f"Score: **{ad.get('ai_score')}/10** - {ad.get('price')}€\n{ad.get('ai_summary', '')[:100]}...",
-                    "color": 0xF59E0B
-                })
-            
-            payload = {
-                "content": "📅 **VOTRE RÉCAPITULATIF QUOTIDIEN**\nVoici les 5 meilleures pépites trouvées ces dernières 24h :",
-                "embeds": embeds[:10] # Discord limit
-            }
-            try:
-                import requests
-                requests.post(webhook, json=payload, timeout=10)
-                database.set_setting('last_daily_digest', now.isoformat())
-                print("✅ Daily Digest envoyé.")
-            except Exception as e:
-                print(f"❌ Erreur Digest : {e}")
+def refresh_in_background(name: str, user_id: int):
+    """One scheduled watch refresh, run by the ingestion worker (worker.py)."""
+    with app.app_context():
+        print(f"Periodic auto-refresh for user {user_id}, search: {name}")
+        refresh_search(name, user_id=user_id)
 
-def auto_refresh_loop():
-    """Background loop to refresh searches and send digests across all users."""
-    print("Starting multi-user auto-refresh background thread...")
-    while True:
-        try:
-            # For daily digest, we'd need to iterate over users
-            # For now, let's focus on auto-refresh
-            with app.app_context():
-                searches = database.get_active_searches() # Get ALL active searches from ALL users
-                for s in searches:
-                    if s.get('refresh_mode') == 'auto':
-                        uid = s.get('user_id', 1)
-                        name = s.get('name')
-                        interval = s.get('refresh_interval', 60)
-                        last_run_str = s.get('last_run')
-                        
-                        should_run = False
-                        if not last_run_str:
-                            should_run = True
-                        else:
-                            try:
-                                last_run = datetime.fromisoformat(last_run_str)
-                                if datetime.now() > last_run + timedelta(minutes=interval):
-                                    should_run = True
-                            except:
-                                should_run = True
-                        
-                        if should_run:
-                            print(f"Periodic auto-refresh for user {uid}, search: {name}")
-                            try:
-                                refresh_search(name, user_id=uid)
-                            except Exception as e:
-                                print(f"Error refreshing {name} (UID {uid}): {e}")
-        except Exception as e:
-            print(f"Background refresh error: {e}")
-        time.sleep(60)
+
+def start_background(embedded_worker: bool = EMBEDDED_WORKER):
+    """
+    Background threads of a web process, for the dev server and each gunicorn worker (wsgi.py).
+    The schema is already initialized by the database import.
+    """
+    global refresh_scheduler
+    if embedded_worker:
+        # Single-process setup: this process is also the ingestion worker
+        import worker
+        refresh_scheduler = worker.start_services(refresh_in_background)
+    pipeline.start(pipeline.WEB_STAGES)
 
 
 if __name__ == '__main__':
-    database.initialize_db()
-    # Start background thread
-    threading.Thread(target=auto_refresh_loop, daemon=True).start()
+    start_background()
     # host='0.0.0.0' is required for Docker
     port = int(os.getenv('PORT', 5000))
     debug_mode = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
@@ -0,0 +1,89 @@
+'''
+Benchmark: distance ranking from a home point over a user's ads, per-ad Python loop vs.
+the NumPy-vectorized haversine over the analytics lat/lng columns.
+
+Usage: python benchmarks/distance_rank.py [--ads 100000] [--max-km 30] [--repeat 20]
+'''
+import os
+import sys
+import math
+import time
+import random
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analytics  # noqa: E402
+from utils import haversine_km, EARTH_RADIUS_KM  # noqa: E402
+
+HOME = (45.76, 4.83) # Lyon
+
+
+def make_columns(n: int) -> analytics.UserColumns:
+    """Ads spread over mainland France, 5% without coordinates, 3 watches."""
+    cols = analytics.UserColumns(user_id=1, capacity=n)
+    for i in range(n):
+        located = random.random() > 0.05
+        cols.upsert({
+            'id': f'bench_{i}', 'search_name': f'watch_{i % 3}', 'price': random.randint(10, 2000),
+            'date_ts': 1_760_000_000 + i, 'is_hidden': 0,
+            'lat': random.uniform(42.5, 51.0) if located else None,
+            'lng': random.uniform(-4.5, 8.0) if located else None,
+        })
+    return cols
+
+
+def python_ranking(cols: analytics.UserColumns, max_km: float):
+    """Reference: one math.* haversine per ad, then a sort of the survivors."""
+    lat1, lng1 = math.radians(HOME[0]), math.radians(HOME[1])
+    ranked = []
+    for row in range(cols.size):
+        lat, lng = cols.lat[row], cols.lng[row]
+        if not cols.alive[row] or cols.hidden[row] or math.isnan(lat):
+            continue
+        lat2, lng2 = math.radians(lat), math.radians(lng)
+        a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+        km = 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0)))
+        if km <= max_km:
+            ranked.append((km, cols.ids[row]))
+    ranked.sort()
+    return ranked
+
+
+def timed(fn, repeat: int) -> float:
+    """Median wall time of `repeat` calls, in ms."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--ads', type=int, default=100_000)
+    parser.add_argument('--max-km', type=float, default=30.0)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    random.seed(42)
+
+    cols = make_columns(args.ads)
+    n = cols.size
+    within = len(cols.by_distance(HOME, max_km=args.max_km)[0])
+    scenarios = [
+        ("haversine only", lambda: haversine_km(HOME[0], HOME[1], cols.lat[:n], cols.lng[:n])),
+        (f"filter <= {args.max_km:g} km, sorted", lambda: cols.by_distance(HOME, max_km=args.max_km)),
+        ("full sort by distance", lambda: cols.by_distance(HOME)),
+        ("one watch, full sort", lambda: cols.by_distance(HOME, search_name='watch_0')),
+    ]
+
+    print(f"\nDistance ranking over {n:,} ads ({within:,} within {args.max_km:g} km), median of {args.repeat} runs")
+    print(f"{'python loop':<32}{timed(lambda: python_ranking(cols, args.max_km), max(args.repeat // 5, 1)):>10.1f} ms")
+    for label, fn in scenarios:
+        print(f"{label:<32}{timed(fn, args.repeat):>10.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+'''
+Load test: requests/sec and latency percentiles of one dashboard endpoint under concurrent
+clients, to compare the dev server (python app.py) with gunicorn + gevent (wsgi.py).
+
+Usage: python benchmarks/load_test.py --url http://127.0.0.1:5000/api/quick-search \
+           [--method POST] [--json '{"query": "velo"}'] [--username admin --password admin] \
+           [--concurrency 50] [--requests 1000]
+'''
+import sys
+import json
+import time
+import argparse
+import threading
+import statistics
+from urllib.parse import urljoin
+
+import requests
+
+
+def login(base_url: str, username: str, password: str) -> requests.Session:
+    session = requests.Session()
+    if username:
+        resp = session.post(urljoin(base_url, '/login'), json={"username": username, "password": password}, timeout=10)
+        if resp.status_code != 200:
+            sys.exit(f"Login failed ({resp.status_code}): {resp.text[:200]}")
+    return session
+
+
+def percentile(samples, p: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def run(args) -> dict:
+    """Each client thread has its own session and sends requests until the shared budget is spent."""
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    remaining = [args.requests]
+    body = json.loads(args.json) if args.json else None
+
+    def client():
+        session = login(args.url, args.username, args.password)
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            try:
+                resp = session.request(args.method, args.url, json=body, timeout=args.timeout)
+                resp.content # Reads the whole body, SSE streams included
+                outcome = resp.status_code
+            except requests.RequestException as e:
+                outcome = type(e).__name__
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+                statuses[outcome] = statuses.get(outcome, 0) + 1
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(args.concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+    return {"wall": wall, "latencies": latencies, "statuses": statuses}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', required=True)
+    parser.add_argument('--method', default='GET')
+    parser.add_argument('--json', default=None, help="JSON request body")
+    parser.add_argument('--username', default=None)
+    parser.add_argument('--password', default=None)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    result = run(args)
+    lat = result["latencies"]
+    if not lat:
+        sys.exit("No request completed.")
+    print(f"\n{args.method} {args.url}: {len(lat):,} requests, {args.concurrency} concurrent clients")
+    print(f"{'throughput':<16}{len(lat) / result['wall']:>10.1f} req/s")
+    print(f"{'p50':<16}{statistics.median(lat):>10.1f} ms")
+    print(f"{'p95':<16}{percentile(lat, 95):>10.1f} ms")
+    print(f"{'p99':<16}{percentile(lat, 99):>10.1f} ms")
+    print(f"{'max':<16}{max(lat):>10.1f} ms")
+    print(f"{'responses':<16}{', '.join(f'{k}: {v}' for k, v in sorted(result['statuses'].items(), key=str))}")
+
+
+if __name__ == '__main__':
+    main()
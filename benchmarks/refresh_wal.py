@@ -0,0 +1,105 @@
+'''
+Benchmark: WAL bytes written by one watch refresh, legacy add_ad (every column rewritten,
+one commit per ad) vs. add_ads_bulk (content hash, changed columns only, one commit).
+
+Usage: python benchmarks/refresh_wal.py [--ads 300] [--changed 0.1]
+'''
+import os
+import sys
+import random
+import sqlite3
+import argparse
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DB_PATH', os.path.join(tempfile.gettempdir(), 'lbc_bench.db'))
+
+import database  # noqa: E402  (DB_PATH must be set first; each run uses its own file)
+
+LEGACY_COLUMNS = ["search_name", "title", "price", "location", "date", "url", "description",
+                  "is_pro", "lat", "lng", "category", "source"]
+
+
+def make_ads(n: int):
+    return [{
+        'id': f'bench_{i}', 'search_name': 'bench', 'title': f'Vélo route carbone taille {i % 7}',
+        'price': float(random.randint(200, 2000)), 'location': 'Lyon', 'date': datetime.now().isoformat(),
+        'url': f'https://www.leboncoin.fr/ad/velos/{i}', 'description': 'Très bon état, peu servi. ' * 20,
+        'is_pro': 0, 'lat': 45.76, 'lng': 4.83, 'category': 'VELOS', 'source': 'LBC'
+    } for i in range(n)]
+
+
+def legacy_refresh(ads):
+    """The pre-content-hash add_ad: SELECT price, full UPDATE, commit, for every ad (new ads inserted)."""
+    conn = sqlite3.connect(database.DB_FILE)
+    conn.execute('PRAGMA wal_autocheckpoint=0') # Keep every frame in the WAL for measuring
+    sets = ', '.join(f'{c} = :{c}' for c in LEGACY_COLUMNS)
+    for ad in ads:
+        existing = conn.execute('SELECT price FROM ads WHERE id = ? AND user_id = 1', (ad['id'],)).fetchone()
+        if existing:
+            if ad['price'] and existing[0] and ad['price'] < existing[0]:
+                conn.execute('INSERT INTO price_history (ad_id, user_id, price, date) VALUES (?, 1, ?, ?)',
+                             (ad['id'], existing[0], datetime.now().isoformat()))
+            conn.execute(f'UPDATE ads SET {sets} WHERE id = :id AND user_id = 1', ad)
+        else:
+            conn.execute(f"INSERT INTO ads (id, user_id, {', '.join(LEGACY_COLUMNS)}) "
+                         f"VALUES (:id, 1, {', '.join(':' + c for c in LEGACY_COLUMNS)})", ad)
+        conn.commit()
+    conn.close()
+
+
+def hashed_refresh(ads):
+    """add_ad with content hashing, still one call (and commit) per ad."""
+    for ad in ads:
+        database.add_ad(ad)
+
+
+def bulk_refresh(ads):
+    return database.add_ads_bulk(ads)
+
+
+def wal_bytes(ads, refresh, batch) -> tuple:
+    """Seeds a fresh database with `ads`, then returns the WAL size after refreshing with `batch`."""
+    database.DB_FILE = os.path.join(tempfile.mkdtemp(prefix='lbc_bench_'), 'bench.db')
+    database.initialize_db()
+    database.add_ads_bulk(ads)
+    conn = sqlite3.connect(database.DB_FILE)
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    result = refresh(batch)
+    size = os.path.getsize(database.DB_FILE + '-wal')
+    conn.close()
+    return size, result
+
+
+def mutate(ads, ratio: float):
+    out = [dict(ad) for ad in ads]
+    for ad in random.sample(out, int(len(out) * ratio)):
+        ad['price'] = ad['price'] - 10
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--ads', type=int, default=300)
+    parser.add_argument('--changed', type=float, default=0.1, help="Share of ads whose price changed")
+    args = parser.parse_args()
+    random.seed(42)
+
+    ads = make_ads(args.ads)
+    scenarios = [("nothing changed", ads),
+                 (f"{int(args.changed * 100)}% prices changed", mutate(ads, args.changed)),
+                 ("10 new ads", ads + make_ads(args.ads + 10)[args.ads:])]
+
+    print(f"\nWAL bytes written by a refresh of {args.ads} stored ads")
+    print(f"{'scenario':<24}{'legacy add_ad':>16}{'hashed add_ad':>16}{'add_ads_bulk':>16}")
+    for label, batch in scenarios:
+        legacy, _ = wal_bytes(ads, legacy_refresh, batch)
+        hashed, _ = wal_bytes(ads, hashed_refresh, batch)
+        bulk, report = wal_bytes(ads, bulk_refresh, batch)
+        print(f"{label:<24}{legacy:>14,} B{hashed:>14,} B{bulk:>14,} B   "
+              f"(new {report['new']}, changed {report['changed']}, unchanged {report['unchanged']})")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,15 @@
 This module handles all interactions with the SQLite database.
 '''
 import os
+import json
+import math
+import time
+import hashlib
 import sqlite3
-from datetime import datetime
-from typing import List, Dict, Any
+from datetime import datetime, timedelta, timezone
+from typing import Callable, List, Dict, Any, Tuple
+from sketches import TDigest
+from utils import to_epoch, haversine_km
 
 DB_FILE = os.getenv('DB_PATH', 'leboncoin_ads.db')
 
@@ -26,7 +32,12 @@ def initialize_db():
                     password_hash TEXT,
                     google_api_key TEXT,
                     discord_webhook TEXT,
-                    created_at TEXT
+                    created_at TEXT,
+                    home_lat REAL,
+                    home_lng REAL,
+                    home_label TEXT,
+                    digest_hour INTEGER DEFAULT 8,
+                    last_digest_date TEXT
                 )
             ''')
 
@@ -52,6 +63,10 @@ def initialize_db():
                     category TEXT,
                     source TEXT DEFAULT 'LBC',
                     is_hidden INTEGER DEFAULT 0,
+                    change_seq INTEGER DEFAULT 0,
+                    content_hash TEXT,
+                    date_ts INTEGER,
+                    details_at INTEGER,
                     PRIMARY KEY (id, user_id)
                 )
             ''')
@@ -92,6 +107,10 @@ def initialize_db():
                     last_viewed TEXT,
                     discord_webhook TEXT,
                     deep_search INTEGER DEFAULT 0,
+                    last_run_ts INTEGER,
+                    last_viewed_ts INTEGER,
+                    quiet_start INTEGER,
+                    quiet_end INTEGER,
                     PRIMARY KEY (name, user_id)
                 )
             ''')
@@ -104,6 +123,7 @@ def initialize_db():
                     user_id INTEGER,
                     price REAL,
                     date TEXT,
+                    date_ts INTEGER,
                     FOREIGN KEY(ad_id, user_id) REFERENCES ads(id, user_id)
                 )
             ''')
@@ -115,6 +135,185 @@ def initialize_db():
                     value TEXT
                 )
             ''')
+
+            # Table des quotas IA (token buckets par clé API et modèle)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS ai_quota (
+                    key_id TEXT,
+                    model TEXT,
+                    rpm_tokens REAL,
+                    tpm_tokens REAL,
+                    updated_at REAL,
+                    day TEXT,
+                    day_requests INTEGER DEFAULT 0,
+                    day_tokens INTEGER DEFAULT 0,
+                    PRIMARY KEY (key_id, model)
+                )
+            ''')
+
+            # File des travaux IA (persistante, reprise après crash)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS ai_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    priority INTEGER DEFAULT 2,
+                    status TEXT DEFAULT 'queued',
+                    ad_ids TEXT,
+                    done_ids TEXT DEFAULT '[]',
+                    custom_context TEXT,
+                    notify INTEGER DEFAULT 1,
+                    total INTEGER DEFAULT 0,
+                    progress INTEGER DEFAULT 0,
+                    message TEXT,
+                    cancel_requested INTEGER DEFAULT 0,
+                    created_at TEXT,
+                    started_at TEXT,
+                    finished_at TEXT
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_ai_jobs_queue ON ai_jobs (status, priority, id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_ai_jobs_user ON ai_jobs (user_id, status)')
+            # Baux des workers d'analyse (voir jobs.py)
+            for column in ('lease_owner TEXT', 'lease_expires_at REAL', 'heartbeat_at REAL'):
+                try: cursor.execute(f"ALTER TABLE ai_jobs ADD COLUMN {column}")
+                except: pass
+
+            # Journal de progression IA (statut et jobs), relayé aux dashboards par chaque processus web
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS ai_progress (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    kind TEXT,
+                    payload TEXT,
+                    created_at REAL
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_ai_progress_user ON ai_progress (user_id, kind, seq)')
+
+            # File des jobs d'ingestion partagée par les processus worker (bail + heartbeat)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    user_id INTEGER,
+                    payload TEXT,
+                    dedup_key TEXT,
+                    priority INTEGER DEFAULT 0,
+                    status TEXT DEFAULT 'queued',
+                    attempts INTEGER DEFAULT 0,
+                    max_attempts INTEGER DEFAULT 3,
+                    run_after REAL,
+                    scheduled_for REAL,
+                    lease_owner TEXT,
+                    lease_expires_at REAL,
+                    heartbeat_at REAL,
+                    last_error TEXT,
+                    created_at REAL,
+                    started_at REAL,
+                    finished_at REAL
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (status, kind, priority, run_after)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs (kind, user_id, status)')
+            # At most one unfinished job per dedup key
+            cursor.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_dedup ON jobs (dedup_key)
+                WHERE dedup_key IS NOT NULL AND status IN ('queued', 'running')
+            ''')
+
+            # Bail du processus leader (boucles de fond exécutées une seule fois)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS leader_leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT,
+                    token INTEGER DEFAULT 1,
+                    acquired_at REAL,
+                    expires_at REAL
+                )
+            ''')
+
+            # File d'envoi des notifications Discord (un embed par ligne)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS notification_outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    webhook TEXT NOT NULL,
+                    content TEXT,
+                    embed TEXT NOT NULL,
+                    status TEXT DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at REAL DEFAULT 0,
+                    claimed_at REAL,
+                    last_error TEXT,
+                    created_at TEXT,
+                    sent_at TEXT
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_outbox_due ON notification_outbox (status, webhook, next_attempt_at)')
+
+            # Alertes déjà envoyées (une par annonce, type et prix)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS notifications_sent (
+                    user_id INTEGER,
+                    ad_id TEXT,
+                    kind TEXT,
+                    price REAL,
+                    sent_at REAL,
+                    PRIMARY KEY (user_id, ad_id, kind, price)
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_notifications_sent_at ON notifications_sent (sent_at)')
+
+            # Meilleures pépites du jour en attente du récapitulatif quotidien
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS digest_candidates (
+                    user_id INTEGER,
+                    ad_id TEXT,
+                    score REAL,
+                    added_at REAL,
+                    PRIMARY KEY (user_id, ad_id)
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_digest_candidates_score ON digest_candidates (user_id, score DESC)')
+
+            # Statistiques de marché incrémentales (scope 'query' ou 'watch')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS market_stats (
+                    user_id INTEGER,
+                    scope TEXT,
+                    key TEXT,
+                    count INTEGER DEFAULT 0,
+                    total REAL DEFAULT 0,
+                    min REAL,
+                    max REAL,
+                    p10 REAL,
+                    p25 REAL,
+                    p50 REAL,
+                    p75 REAL,
+                    p90 REAL,
+                    digest TEXT,
+                    updated_at TEXT,
+                    PRIMARY KEY (user_id, scope, key)
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS market_stats_history (
+                    user_id INTEGER,
+                    scope TEXT,
+                    key TEXT,
+                    bucket TEXT,
+                    count INTEGER DEFAULT 0,
+                    total REAL DEFAULT 0,
+                    min REAL,
+                    max REAL,
+                    p50 REAL,
+                    digest TEXT,
+                    PRIMARY KEY (user_id, scope, key, bucket)
+                )
+            ''')
+            # Dernière consultation d'un agrégat 'query' (les requêtes inutilisées expirent)
+            try: cursor.execute("ALTER TABLE market_stats ADD COLUMN accessed_at TEXT")
+            except: pass
             conn.commit()
 
 
@@ -156,9 +355,29 @@ def initialize_db():
             
             try: cursor.execute("ALTER TABLE searches ADD COLUMN deep_search INTEGER DEFAULT 0")
             except: pass
+            # Quiet hours of a watch (local hours 0-23, end excluded); alerts wait until the end
+            try: cursor.execute("ALTER TABLE searches ADD COLUMN quiet_start INTEGER")
+            except: pass
+            try: cursor.execute("ALTER TABLE searches ADD COLUMN quiet_end INTEGER")
+            except: pass
             
             try: cursor.execute("ALTER TABLE ads ADD COLUMN is_hidden INTEGER DEFAULT 0")
             except: pass
+
+            try: cursor.execute("ALTER TABLE ads ADD COLUMN change_seq INTEGER DEFAULT 0")
+            except: pass
+            try: cursor.execute("ALTER TABLE ads ADD COLUMN content_hash TEXT")
+            except: pass
+            try: cursor.execute("ALTER TABLE ads ADD COLUMN details_at INTEGER")
+            except: pass
+            for column in ('home_lat REAL', 'home_lng REAL', 'home_label TEXT', 'digest_hour INTEGER DEFAULT 8',
+                           'last_digest_date TEXT'):
+                try: cursor.execute(f"ALTER TABLE users ADD COLUMN {column}")
+                except: pass
+            _init_ads_change_tracking(cursor)
+            _init_ad_events(cursor)
+            _init_epoch_columns(cursor)
+            _init_ads_geo(cursor)
             
             conn.commit()
 
@@ -168,6 +387,101 @@ def initialize_db():
         import traceback
         traceback.print_exc()
 
+# Columns whose change makes an ad "changed" for delta sync (inserted, updated, hidden, rescored, moved)
+_TRACKED_AD_COLUMNS = ['search_name', 'title', 'price', 'location', 'date', 'url', 'description', 'ai_summary',
+                       'ai_score', 'ai_tips', 'image_url', 'is_pro', 'lat', 'lng', 'category', 'source', 'is_hidden']
+
+
+def _init_ads_change_tracking(cursor):
+    """
+    Monotonic change sequence on ads: a single counter row bumped by triggers, so every
+    write path (add_ad, hide, move, AI summaries...) is tracked without touching its SQL.
+    """
+    # Compteur global des modifications d'annonces
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    if cursor.execute("SELECT 1 FROM change_counters WHERE name = 'ads'").fetchone() is None:
+        # Backfill existing ads with distinct sequence numbers
+        cursor.execute("UPDATE ads SET change_seq = rowid WHERE change_seq IS NULL OR change_seq = 0")
+        cursor.execute("INSERT INTO change_counters (name, value) SELECT 'ads', COALESCE(MAX(change_seq), 0) FROM ads")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ads_user_seq ON ads (user_id, change_seq)')
+
+    bump = '''
+        UPDATE change_counters SET value = value + 1 WHERE name = 'ads';
+        UPDATE ads SET change_seq = (SELECT value FROM change_counters WHERE name = 'ads') WHERE rowid = NEW.rowid;
+    '''
+    changed = ' OR '.join(f'NEW.{c} IS NOT OLD.{c}' for c in _TRACKED_AD_COLUMNS)
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_ads_seq_insert AFTER INSERT ON ads BEGIN {bump} END")
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_ads_seq_update AFTER UPDATE ON ads WHEN {changed} BEGIN {bump} END")
+
+
+# Kinds of rows in the ad_events change log
+AD_EVENT_INSERT, AD_EVENT_PRICE, AD_EVENT_HIDE, AD_EVENT_MOVE, AD_EVENT_ANALYSIS = 'insert', 'price_change', 'hide', 'move', 'analysis'
+AD_EVENT_DELETE, AD_EVENT_UPDATE = 'delete', 'update'
+
+# Trigger name -> (timing clause, kind, old value, new value)
+_AD_EVENT_TRIGGERS = {
+    'trg_ad_events_insert': ("AFTER INSERT ON ads", AD_EVENT_INSERT, "NULL", "NEW.price"),
+    'trg_ad_events_price': ("AFTER UPDATE OF price ON ads WHEN NEW.price IS NOT OLD.price", AD_EVENT_PRICE, "OLD.price", "NEW.price"),
+    'trg_ad_events_hide': ("AFTER UPDATE OF is_hidden ON ads WHEN NEW.is_hidden = 1 AND OLD.is_hidden IS NOT 1", AD_EVENT_HIDE, "NULL", "NULL"),
+    'trg_ad_events_move': ("AFTER UPDATE OF search_name ON ads WHEN NEW.search_name IS NOT OLD.search_name", AD_EVENT_MOVE, "OLD.search_name", "NEW.search_name"),
+    'trg_ad_events_analysis': ("AFTER UPDATE OF ai_score, ai_summary ON ads WHEN NEW.ai_score IS NOT OLD.ai_score OR NEW.ai_summary IS NOT OLD.ai_summary",
+                               AD_EVENT_ANALYSIS, "OLD.ai_score", "NEW.ai_score"),
+    # Other columns read by in-memory caches (publication date, position, seller, un-hiding)
+    'trg_ad_events_update': ("AFTER UPDATE OF date, lat, lng, is_pro, source, is_hidden ON ads WHEN NEW.date IS NOT OLD.date "
+                             "OR NEW.lat IS NOT OLD.lat OR NEW.lng IS NOT OLD.lng OR NEW.is_pro IS NOT OLD.is_pro "
+                             "OR NEW.source IS NOT OLD.source OR (NEW.is_hidden = 0 AND OLD.is_hidden = 1)",
+                             AD_EVENT_UPDATE, "NULL", "NULL"),
+}
+
+
+def _init_ad_events(cursor):
+    """
+    Append-only change log of ads, written by triggers inside the same transaction as the
+    change itself. Consumers read it incrementally from their own offset.
+    """
+    # Journal des modifications d'annonces
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ad_events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            ad_id TEXT NOT NULL,
+            search_name TEXT,
+            kind TEXT NOT NULL,
+            old_value TEXT,
+            new_value TEXT,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    # Position de lecture de chaque consommateur du journal
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS consumer_offsets (
+            consumer TEXT PRIMARY KEY,
+            seq INTEGER NOT NULL,
+            updated_at TEXT
+        )
+    ''')
+    for name, (timing, kind, old_value, new_value) in _AD_EVENT_TRIGGERS.items():
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {name} {timing}
+            BEGIN
+                INSERT INTO ad_events (user_id, ad_id, search_name, kind, old_value, new_value, created_at)
+                VALUES (NEW.user_id, NEW.id, NEW.search_name, '{kind}', {old_value}, {new_value}, strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime'));
+            END
+        ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_ad_events_delete AFTER DELETE ON ads
+        BEGIN
+            INSERT INTO ad_events (user_id, ad_id, search_name, kind, old_value, new_value, created_at)
+            VALUES (OLD.user_id, OLD.id, OLD.search_name, '{AD_EVENT_DELETE}', NULL, NULL, strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime'));
+        END
+    ''')
+
+
 import werkzeug.security as security
 
 def create_user(username, password):
@@ -213,12 +527,19 @@ def get_user_by_id(user_id):
         print(f"[Database Error] get_user_by_id failed: {e}")
         return None
 
+def get_user_home(user_id) -> Tuple[float, float]:
+    """(lat, lng) of a user's home point, or None when not set."""
+    user = get_user_by_id(user_id) or {}
+    if user.get('home_lat') is None or user.get('home_lng') is None:
+        return None
+    return user['home_lat'], user['home_lng']
+
 def update_user_settings(user_id, settings: Dict[str, Any]):
-    """Updates user-specific settings (API key, Webhook)."""
+    """Updates user-specific settings (API key, Webhook, home point, digest hour)."""
     try:
         with sqlite3.connect(DB_FILE) as conn:
             cursor = conn.cursor()
-            allowed = ['google_api_key', 'discord_webhook']
+            allowed = ['google_api_key', 'discord_webhook', 'home_lat', 'home_lng', 'home_label', 'digest_hour']
             for k, v in settings.items():
                 if k in allowed:
                     cursor.execute(f"UPDATE users SET {k} = ? WHERE id = ?", (v, user_id))
@@ -228,89 +549,257 @@ def update_user_settings(user_id, settings: Dict[str, Any]):
         print(f"[Database Error] update_user_settings failed: {e}")
         return False
 
-def add_ad(ad_data: Dict[str, Any], user_id: int = 1):
+# (table, text column, epoch column) pairs kept in sync by the write paths
+_EPOCH_COLUMNS = [('ads', 'date', 'date_ts'), ('searches', 'last_run', 'last_run_ts'),
+                  ('searches', 'last_viewed', 'last_viewed_ts'), ('price_history', 'date', 'date_ts')]
+
+
+def _init_epoch_columns(cursor):
     """
-    Inserts a new ad into the database. Robust with defaults.
-    """
-    # Force defaults for missing keys to avoid SQL errors
-    defaults = {
-        'id': 'unknown_' + str(datetime.now().timestamp()),
-        'user_id': user_id,
-        'search_name': 'Unknown',
-        'title': 'No Title',
-        'price': 0,
-        'location': 'Unknown',
-        'date': '',
-        'url': '',
-        'description': '',
-        'ai_summary': None,
-        'ai_score': None,
-        'ai_tips': None,
-        'image_url': None,
-        'is_pro': 0,
-        'lat': None,
-        'lng': None,
-        'category': None,
-        'source': 'LBC'
-    }
-    data = {**defaults, **ad_data}
+    Integer epoch twins of the text date columns (mixed isoformat()/str(datetime) strings
+    that only compare correctly by luck), backfilled once and indexed for range queries.
+    """
+    for table, text_column, epoch_column in _EPOCH_COLUMNS:
+        try: cursor.execute(f"ALTER TABLE {table} ADD COLUMN {epoch_column} INTEGER")
+        except: pass
+        rows = cursor.execute(f"SELECT rowid, {text_column} FROM {table} WHERE {epoch_column} IS NULL AND {text_column} IS NOT NULL AND {text_column} != ''").fetchall()
+        updates = [(to_epoch(value), rowid) for rowid, value in rows]
+        cursor.executemany(f"UPDATE {table} SET {epoch_column} = ? WHERE rowid = ?", [u for u in updates if u[0] is not None])
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ads_user_date ON ads (user_id, date_ts)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ads_user_search_date ON ads (user_id, search_name, date_ts)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_price_history_ad ON price_history (user_id, ad_id, date_ts)')
+
+
+def _init_ads_geo(cursor):
+    """
+    R*Tree over ads.lat/lng keyed by ads.rowid, maintained by triggers so every write path
+    is indexed. Rebuilt from ads whenever it drifts (first run, or rowids renumbered).
+    """
+    # Index spatial des annonces géolocalisées
+    cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS ads_geo USING rtree(id, min_lat, max_lat, min_lng, max_lng)')
+    located = "NEW.lat IS NOT NULL AND NEW.lng IS NOT NULL"
+    insert = "INSERT OR REPLACE INTO ads_geo VALUES (NEW.rowid, NEW.lat, NEW.lat, NEW.lng, NEW.lng);"
+    cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_ads_geo_insert AFTER INSERT ON ads WHEN {located} BEGIN {insert} END")
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_ads_geo_update AFTER UPDATE OF lat, lng ON ads
+        BEGIN
+            DELETE FROM ads_geo WHERE id = OLD.rowid;
+            INSERT INTO ads_geo SELECT NEW.rowid, NEW.lat, NEW.lat, NEW.lng, NEW.lng WHERE {located};
+        END
+    ''')
+    cursor.execute("CREATE TRIGGER IF NOT EXISTS trg_ads_geo_delete AFTER DELETE ON ads BEGIN DELETE FROM ads_geo WHERE id = OLD.rowid; END")
+
+    indexed = cursor.execute('SELECT COUNT(*) FROM ads_geo').fetchone()[0]
+    # R*Tree bounds are float32 rounded outward: compare within ~10 m, not for equality
+    matched = cursor.execute('''
+        SELECT COUNT(*) FROM ads_geo g JOIN ads a ON a.rowid = g.id
+        AND ABS(a.lat - g.min_lat) < 1e-4 AND ABS(a.lng - g.min_lng) < 1e-4
+    ''').fetchone()[0]
+    located_ads = cursor.execute('SELECT COUNT(*) FROM ads WHERE lat IS NOT NULL AND lng IS NOT NULL').fetchone()[0]
+    if not (indexed == matched == located_ads):
+        cursor.execute('DELETE FROM ads_geo')
+        cursor.execute('INSERT INTO ads_geo SELECT rowid, lat, lat, lng, lng FROM ads WHERE lat IS NOT NULL AND lng IS NOT NULL')
+
+
+# Scraped columns refreshed by add_ad (AI fields are only written by the analysis)
+_AD_CONTENT_COLUMNS = ['search_name', 'title', 'price', 'location', 'date', 'url', 'description',
+                       'is_pro', 'lat', 'lng', 'category', 'source']
+
+# Filled by detail enrichment; kept when a later write (search results) does not carry them
+_AD_DETAIL_COLUMNS = ['description', 'lat', 'lng', 'category']
+
+_AD_DEFAULTS = {
+    'search_name': 'Unknown',
+    'title': 'No Title',
+    'price': 0,
+    'location': 'Unknown',
+    'date': '',
+    'url': '',
+    'description': '',
+    'ai_summary': None,
+    'ai_score': None,
+    'ai_tips': None,
+    'image_url': None,
+    'is_pro': 0,
+    'lat': None,
+    'lng': None,
+    'category': None,
+    'source': 'LBC'
+}
+
+AD_NEW, AD_CHANGED, AD_UNCHANGED, AD_FAILED = 'new', 'changed', 'unchanged', 'failed'
+
+
+def _normalize_ad_value(column: str, value):
+    """Same representation as SQLite gives back, so fresh and stored values compare equal."""
+    if value is None:
+        return None
+    if column in ('price', 'lat', 'lng'):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return value
+    if column == 'is_pro':
+        return int(bool(value))
+    return str(value) if not isinstance(value, str) else value
+
+
+def ad_content_hash(data: Dict[str, Any]) -> str:
+    """Fingerprint of the scraped columns of an ad."""
+    payload = json.dumps([_normalize_ad_value(c, data.get(c)) for c in _AD_CONTENT_COLUMNS], ensure_ascii=False)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _upsert_ad(cursor, ad_data: Dict[str, Any], user_id: int):
+    """
+    Inserts an ad or updates only the columns that changed; an unchanged ad (same content
+    hash) costs one indexed read and no write. Returns (outcome, price_dropped).
+    """
+    data = {**_AD_DEFAULTS, 'id': 'unknown_' + str(datetime.now().timestamp()), **ad_data}
     data['user_id'] = user_id
-    
+    for column in _AD_CONTENT_COLUMNS:
+        data[column] = _normalize_ad_value(column, data.get(column))
+    data['content_hash'] = ad_content_hash(data)
+    data['date_ts'] = to_epoch(data['date'])
+
+    columns = ', '.join(_AD_CONTENT_COLUMNS)
+    cursor.execute(f"SELECT {columns}, content_hash, is_hidden FROM ads WHERE id = ? AND user_id = ?", (data['id'], user_id))
+    existing = cursor.fetchone()
+
+    if existing is None:
+        cursor.execute('''
+            INSERT INTO ads (id, user_id, search_name, title, price, location, date, date_ts, url, description, ai_summary, ai_score, ai_tips, image_url, is_pro, lat, lng, category, source, content_hash)
+            VALUES (:id, :user_id, :search_name, :title, :price, :location, :date, :date_ts, :url, :description, :ai_summary, :ai_score, :ai_tips, :image_url, :is_pro, :lat, :lng, :category, :source, :content_hash)
+        ''', data)
+        return AD_NEW, False
+
+    current = dict(zip(_AD_CONTENT_COLUMNS + ['content_hash', 'is_hidden'], existing))
+    missing_details = [c for c in _AD_DETAIL_COLUMNS if ad_data.get(c) in (None, '') and current[c] not in (None, '')]
+    # Manual ads are dated by their import (the page has no date): a re-import keeps the first one
+    if data['source'] == 'MANUAL' and current['source'] == 'MANUAL' and current['date']:
+        missing_details.append('date')
+    if missing_details:
+        for column in missing_details:
+            data[column] = _normalize_ad_value(column, current[column])
+        data['content_hash'] = ad_content_hash(data)
+        data['date_ts'] = to_epoch(data['date'])
+    # Only update is_hidden if explicitly provided (to avoid unhiding on auto-scrape)
+    hidden_changed = 'is_hidden' in ad_data and int(bool(data['is_hidden'])) != (current['is_hidden'] or 0)
+    if current['content_hash'] == data['content_hash'] and not hidden_changed:
+        return AD_UNCHANGED, False
+
+    changed = [c for c in _AD_CONTENT_COLUMNS if _normalize_ad_value(c, current[c]) != data[c]]
+    if hidden_changed:
+        changed.append('is_hidden')
+        data['is_hidden'] = int(bool(data['is_hidden']))
+
+    old_price, new_price = current['price'], data['price']
+    price_dropped = bool(new_price and old_price and new_price < old_price)
+    if price_dropped:
+        # Record in history
+        now = datetime.now()
+        cursor.execute("INSERT INTO price_history (ad_id, user_id, price, date, date_ts) VALUES (?, ?, ?, ?, ?)",
+                       (data['id'], user_id, old_price, now.isoformat(), int(now.timestamp())))
+
+    # Rows written before content hashing only get their fingerprint filled in
+    derived = ['content_hash'] + (['date_ts'] if 'date' in changed else [])
+    assignments = ', '.join(f"{c} = :{c}" for c in changed + derived)
+    cursor.execute(f"UPDATE ads SET {assignments} WHERE id = :id AND user_id = :user_id", data)
+    return (AD_CHANGED if changed else AD_UNCHANGED), price_dropped
+
+
+def save_ad_details(details: List[Dict[str, Any]], user_id: int = 1) -> int:
+    """
+    Stores fetched ad details in one transaction: fills the empty description / lat / lng /
+    category columns (never overwrites) and stamps details_at. Each item: {"id", ...fields};
+    an item with only an id just marks the ad as done. Returns the number of ads updated.
+    """
+    if not details:
+        return 0
     try:
+        now = int(time.time())
+        columns = ', '.join(_AD_CONTENT_COLUMNS)
+        updated = 0
         with sqlite3.connect(DB_FILE) as conn:
             cursor = conn.cursor()
-            
-            # Check for price change (specific to this user)
-            ad_id = data.get('id', 'unknown')
-            cursor.execute("SELECT price FROM ads WHERE id = ? AND user_id = ?", (ad_id, user_id))
-            existing = cursor.fetchone()
-            price_dropped = False
-            
-            if existing:
-                old_price = existing[0]
-                new_price = data.get('price', 0)
-                if new_price and old_price and new_price < old_price:
-                    price_dropped = True
-                    # Record in history
-                    cursor.execute("INSERT INTO price_history (ad_id, user_id, price, date) VALUES (?, ?, ?, ?)", 
-                                 (ad_id, user_id, old_price, datetime.now().isoformat()))
-                
-                # Update existing ad
-                # Dynamically build UPDATE to allow optional fields like is_hidden
-                update_fields = [
-                    "search_name = :search_name", "title = :title", "price = :price",
-                    "location = :location", "date = :date", "url = :url", "description = :description",
-                    "is_pro = :is_pro", "lat = :lat", "lng = :lng", "category = :category", "source = :source"
-                ]
-                
-                # Only update is_hidden if explicitly provided (to avoid unhiding on auto-scrape)
-                if 'is_hidden' in data:
-                    update_fields.append("is_hidden = :is_hidden")
-
-                sql = f"UPDATE ads SET {', '.join(update_fields)} WHERE id = :id AND user_id = :user_id"
-                cursor.execute(sql, data)
-                is_new = False
-            else:
-                # Insert new ad
+            for item in details:
+                cursor.execute(f"SELECT {columns} FROM ads WHERE id = ? AND user_id = ?", (item['id'], user_id))
+                row = cursor.fetchone()
+                if row is None:
+                    continue
+                data = dict(zip(_AD_CONTENT_COLUMNS, row))
+                for column in _AD_DETAIL_COLUMNS:
+                    if data[column] in (None, '') and item.get(column) not in (None, ''):
+                        data[column] = _normalize_ad_value(column, item[column])
+                data.update(id=item['id'], user_id=user_id, details_at=now, content_hash=ad_content_hash(data))
                 cursor.execute('''
-                    INSERT INTO ads (id, user_id, search_name, title, price, location, date, url, description, ai_summary, ai_score, ai_tips, image_url, is_pro, lat, lng, category, source)
-                    VALUES (:id, :user_id, :search_name, :title, :price, :location, :date, :url, :description, :ai_summary, :ai_score, :ai_tips, :image_url, :is_pro, :lat, :lng, :category, :source)
+                    UPDATE ads SET description = :description, lat = :lat, lng = :lng, category = :category,
+                                   content_hash = :content_hash, details_at = :details_at
+                    WHERE id = :id AND user_id = :user_id
                 ''', data)
-                is_new = True
-            
+                updated += cursor.rowcount
             conn.commit()
-        return True, price_dropped, is_new
+        return updated
+    except Exception as e:
+        print(f"[Database Error] Failed to save ad details: {e}")
+        return 0
+
+def add_ad(ad_data: Dict[str, Any], user_id: int = 1):
+    """
+    Inserts a new ad into the database, or updates the fields that changed. Robust with defaults.
+    Returns (success, price_dropped, is_new).
+    """
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            outcome, price_dropped = _upsert_ad(conn.cursor(), ad_data, user_id)
+            conn.commit() # No-op (no transaction) when the ad was unchanged
+        return True, price_dropped, outcome == AD_NEW
     except Exception as e:
         print(f"[Database Error] Failed to add/update ad: {e}")
         return False, False, False
 
+
+def add_ads_bulk(ads: List[Dict[str, Any]], user_id: int = 1) -> Dict[str, Any]:
+    """
+    Upserts a whole refresh in one transaction (a single commit / WAL sync).
+    Returns {"new", "changed", "unchanged", "failed"} counts and the per-ad "outcomes"
+    as (ad, outcome, price_dropped) in input order.
+    """
+    report = {AD_NEW: 0, AD_CHANGED: 0, AD_UNCHANGED: 0, AD_FAILED: 0, "outcomes": []}
+    if not ads:
+        return report
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            # Explicit transaction, otherwise releasing the savepoint would commit every ad
+            cursor.execute("BEGIN")
+            for ad in ads:
+                try:
+                    cursor.execute("SAVEPOINT ad_upsert")
+                    outcome, price_dropped = _upsert_ad(cursor, ad, user_id)
+                    cursor.execute("RELEASE ad_upsert")
+                except sqlite3.Error as e:
+                    cursor.execute("ROLLBACK TO ad_upsert")
+                    cursor.execute("RELEASE ad_upsert")
+                    print(f"[Database Error] Failed to add/update ad {ad.get('id')}: {e}")
+                    outcome, price_dropped = AD_FAILED, False
+                report[outcome] += 1
+                report["outcomes"].append((ad, outcome, price_dropped))
+            conn.commit()
+    except Exception as e:
+        print(f"[Database Error] add_ads_bulk failed: {e}")
+        report[AD_FAILED] = len(ads)
+        report[AD_NEW] = report[AD_CHANGED] = report[AD_UNCHANGED] = 0
+        report["outcomes"] = [(ad, AD_FAILED, False) for ad in ads]
+    return report
+
 def get_price_history(ad_id: str, user_id: int = 1) -> List[Dict[str, Any]]:
     """Retrieves the price history for a specific ad."""
     try:
         with sqlite3.connect(DB_FILE) as conn:
             conn.row_factory = sqlite3.Row
             cursor = conn.cursor()
-            cursor.execute('SELECT price, date FROM price_history WHERE ad_id = ? AND user_id = ? ORDER BY date DESC', (ad_id, user_id))
+            cursor.execute('SELECT price, date, date_ts FROM price_history WHERE ad_id = ? AND user_id = ? ORDER BY date_ts DESC', (ad_id, user_id))
             return [dict(row) for row in cursor.fetchall()]
     except Exception as e:
         print(f"[Database Error] Failed to get price history: {e}")
@@ -331,7 +820,7 @@ def get_ads_without_summary(user_id: int = 1) -> List[Dict[str, Any]]:
                 WHERE ads.user_id = ? 
                   AND (ads.ai_summary IS NULL OR ads.ai_summary = "")
                   AND (searches.is_active = 1 OR ads.source = 'MANUAL')
-                ORDER BY CASE WHEN ads.source = 'MANUAL' THEN 0 ELSE 1 END, ads.date DESC
+                ORDER BY CASE WHEN ads.source = 'MANUAL' THEN 0 ELSE 1 END, ads.date_ts DESC
             ''', (user_id,))
             return [dict(row) for row in cursor.fetchall()]
     except Exception as e:
@@ -377,6 +866,160 @@ def get_all_ads(user_id: int = 1) -> List[Dict[str, Any]]:
         print(f"[Database Error] Failed to get all ads: {e}")
         return []
 
+def get_ads(user_id: int = 1, search_name: str = None, since_ts: int = None, until_ts: int = None) -> List[Dict[str, Any]]:
+    """Visible ads, newest first (undated last), optionally for one watch and a date_ts range."""
+    try:
+        sql, params = 'SELECT * FROM ads WHERE user_id = ? AND is_hidden = 0', [user_id]
+        if search_name:
+            sql += ' AND search_name = ?'
+            params.append(search_name)
+        if since_ts is not None:
+            sql += ' AND date_ts >= ?'
+            params.append(since_ts)
+        if until_ts is not None:
+            sql += ' AND date_ts < ?'
+            params.append(until_ts)
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute(sql + ' ORDER BY date_ts DESC, id DESC', params)
+            return [dict(row) for row in cursor.fetchall()]
+    except Exception as e:
+        print(f"[Database Error] Failed to get ads: {e}")
+        return []
+
+def get_ads_columns(columns: List[str], user_id: int = 1) -> List[Dict[str, Any]]:
+    """Selected columns of all of a user's ads, hidden ones included (column names are trusted)."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute(f'SELECT {", ".join(columns)} FROM ads WHERE user_id = ?', (user_id,))
+            return [dict(row) for row in cursor.fetchall()]
+    except Exception as e:
+        print(f"[Database Error] Failed to get ad columns: {e}")
+        return []
+
+KM_PER_DEGREE = 111.32
+
+def _bbox_around(lat: float, lng: float, km: float) -> Tuple[float, float, float, float]:
+    """(south, west, north, east) box enclosing a radius of `km` around a point."""
+    dlat = km / KM_PER_DEGREE
+    dlng = km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    return lat - dlat, lng - dlng, lat + dlat, lng + dlng
+
+def _geo_where(user_id: int, bbox: Tuple[float, float, float, float], search_name: str = None) -> Tuple[str, List[Any]]:
+    south, west, north, east = bbox
+    sql = '''
+        FROM ads_geo g JOIN ads a ON a.rowid = g.id
+        WHERE g.min_lat >= ? AND g.max_lat <= ? AND g.min_lng >= ? AND g.max_lng <= ?
+          AND a.user_id = ? AND a.is_hidden = 0
+    '''
+    params = [south, north, west, east, user_id]
+    if search_name:
+        sql += ' AND a.search_name = ?'
+        params.append(search_name)
+    return sql, params
+
+def get_ads_in_bbox(bbox: Tuple[float, float, float, float], user_id: int = 1, search_name: str = None,
+                    limit: int = 500) -> Dict[str, Any]:
+    """Visible ads inside a (south, west, north, east) box, newest first, with the total match count."""
+    try:
+        where, params = _geo_where(user_id, bbox, search_name)
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            total = cursor.execute('SELECT COUNT(*) ' + where, params).fetchone()[0]
+            cursor.execute('SELECT a.* ' + where + ' ORDER BY a.date_ts DESC, a.id DESC LIMIT ?', params + [limit])
+            return {"total": total, "ads": [dict(row) for row in cursor.fetchall()]}
+    except Exception as e:
+        print(f"[Database Error] Failed to get ads in bbox: {e}")
+        return {"total": 0, "ads": []}
+
+def get_ads_near(lat: float, lng: float, km: float, user_id: int = 1, search_name: str = None,
+                 limit: int = 500) -> List[Dict[str, Any]]:
+    """Visible ads within `km` of a point, nearest first, each with its `distance_km`."""
+    try:
+        where, params = _geo_where(user_id, _bbox_around(lat, lng, km), search_name)
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            ads = [dict(row) for row in conn.execute('SELECT a.* ' + where, params).fetchall()]
+        if not ads:
+            return []
+        # The box over-selects its corners: exact great-circle filter on the candidates
+        distances = haversine_km(lat, lng, [ad['lat'] for ad in ads], [ad['lng'] for ad in ads])
+        nearby = [(d, ad) for d, ad in zip(distances.tolist(), ads) if d <= km]
+        nearby.sort(key=lambda item: item[0])
+        return [{**ad, 'distance_km': round(d, 2)} for d, ad in nearby[:limit]]
+    except Exception as e:
+        print(f"[Database Error] Failed to get ads near point: {e}")
+        return []
+
+def get_ad_clusters(bbox: Tuple[float, float, float, float], cell_deg: float, user_id: int = 1,
+                    search_name: str = None) -> List[Dict[str, Any]]:
+    """
+    Grid aggregation of the visible ads in a box: one row per non-empty `cell_deg` cell with
+    its count, centroid and price range. Single-ad cells carry the ad id.
+    """
+    try:
+        where, params = _geo_where(user_id, bbox, search_name)
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            # Offsets keep cell numbers positive so CAST truncation acts as floor()
+            cursor.execute('''
+                SELECT CAST((a.lat + 90) / ? AS INTEGER) AS cell_row, CAST((a.lng + 180) / ? AS INTEGER) AS cell_col,
+                       COUNT(*) AS count, AVG(a.lat) AS lat, AVG(a.lng) AS lng,
+                       MIN(a.price) AS min_price, MAX(a.price) AS max_price, MIN(a.id) AS ad_id
+            ''' + where + ' GROUP BY cell_row, cell_col', [cell_deg, cell_deg] + params)
+            clusters = []
+            for row in cursor.fetchall():
+                cluster = {k: row[k] for k in ('count', 'lat', 'lng', 'min_price', 'max_price')}
+                if row['count'] == 1:
+                    cluster['ad_id'] = row['ad_id']
+                clusters.append(cluster)
+            return clusters
+    except Exception as e:
+        print(f"[Database Error] Failed to get ad clusters: {e}")
+        return []
+
+def get_ads_version(user_id: int = 1) -> Dict[str, int]:
+    """Cheap fingerprint of a user's ads (highest change sequence + row count, deletions included)."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            row = conn.execute('SELECT COALESCE(MAX(change_seq), 0), COUNT(*) FROM ads WHERE user_id = ?', (user_id,)).fetchone()
+            return {"cursor": row[0], "count": row[1]}
+    except Exception as e:
+        print(f"[Database Error] Failed to get ads version: {e}")
+        return {"cursor": 0, "count": 0}
+
+def get_ads_changes(user_id: int = 1, since: int = 0, search_name: str = None) -> Dict[str, Any]:
+    """
+    Ads (hidden ones included) changed after the `since` cursor, with the new cursor and the
+    number of visible ads (optionally of one watch) so clients can check their merged copy.
+    Everything is read in the same snapshot so no change can slip between two syncs.
+    """
+    try:
+        conn = sqlite3.connect(DB_FILE, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute('BEGIN')
+            cursor_value = conn.execute('SELECT COALESCE(MAX(change_seq), 0) FROM ads WHERE user_id = ?', (user_id,)).fetchone()[0]
+            rows = conn.execute('SELECT * FROM ads WHERE user_id = ? AND change_seq > ? ORDER BY change_seq',
+                                (user_id, since)).fetchall()
+            count_sql, params = 'SELECT COUNT(*) FROM ads WHERE user_id = ? AND is_hidden = 0', [user_id]
+            if search_name:
+                count_sql += ' AND search_name = ?'
+                params.append(search_name)
+            visible = conn.execute(count_sql, params).fetchone()[0]
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        return {"cursor": max(cursor_value, since), "ads": [dict(row) for row in rows], "total": visible}
+    except Exception as e:
+        print(f"[Database Error] Failed to get ad changes: {e}")
+        return {"cursor": since, "ads": [], "total": None}
+
 # --- Gestion des veilles (Searches) ---
 
 def save_search(search_data: Dict[str, Any], user_id: int = 1):
@@ -390,12 +1033,13 @@ def save_search(search_data: Dict[str, Any], user_id: int = 1):
                 'locations': '[]', 'price_min': None, 'price_max': None, 'category': None, 
                 'last_run': None, 'is_active': 1, 'ai_context': None, 'refresh_mode': 'manual',
                 'refresh_interval': 60, 'platforms': '{}', 'last_viewed': None, 'discord_webhook': None,
-                'deep_search': 0
+                'deep_search': 0, 'quiet_start': None, 'quiet_end': None
             }
+            params = {**defaults, **search_data, 'user_id': user_id}
             cursor.execute('''
-                INSERT OR REPLACE INTO searches (user_id, name, query_text, city, radius, lat, lng, zip_code, locations, price_min, price_max, category, last_run, is_active, ai_context, refresh_mode, refresh_interval, platforms, last_viewed, discord_webhook, deep_search)
-                VALUES (:user_id, :name, :query_text, :city, :radius, :lat, :lng, :zip_code, :locations, :price_min, :price_max, :category, :last_run, :is_active, :ai_context, :refresh_mode, :refresh_interval, :platforms, :last_viewed, :discord_webhook, :deep_search)
-            ''', {**defaults, **search_data, 'user_id': user_id})
+                INSERT OR REPLACE INTO searches (user_id, name, query_text, city, radius, lat, lng, zip_code, locations, price_min, price_max, category, last_run, last_run_ts, is_active, ai_context, refresh_mode, refresh_interval, platforms, last_viewed, last_viewed_ts, discord_webhook, deep_search, quiet_start, quiet_end)
+                VALUES (:user_id, :name, :query_text, :city, :radius, :lat, :lng, :zip_code, :locations, :price_min, :price_max, :category, :last_run, :last_run_ts, :is_active, :ai_context, :refresh_mode, :refresh_interval, :platforms, :last_viewed, :last_viewed_ts, :discord_webhook, :deep_search, :quiet_start, :quiet_end)
+            ''', {**params, 'last_run_ts': to_epoch(params['last_run']), 'last_viewed_ts': to_epoch(params['last_viewed'])})
 
             conn.commit()
         return True
@@ -409,7 +1053,8 @@ def update_search_last_run(name: str, user_id: int = 1):
     try:
         with sqlite3.connect(DB_FILE) as conn:
             cursor = conn.cursor()
-            cursor.execute('UPDATE searches SET last_run = ? WHERE name = ? AND user_id = ?', (datetime.now().isoformat(), name, user_id))
+            now = datetime.now()
+            cursor.execute('UPDATE searches SET last_run = ?, last_run_ts = ? WHERE name = ? AND user_id = ?', (now.isoformat(), int(now.timestamp()), name, user_id))
             conn.commit()
         return True
     except Exception as e:
@@ -455,7 +1100,8 @@ def update_search_settings(name: str, settings: Dict[str, Any], user_id: int = 1
             
             allowed_keys = [
                 'ai_context', 'refresh_mode', 'refresh_interval', 
-                'platforms', 'discord_webhook', 'is_active', 'deep_search'
+                'platforms', 'discord_webhook', 'is_active', 'deep_search',
+                'quiet_start', 'quiet_end'
             ]
 
             
@@ -512,7 +1158,8 @@ def update_last_viewed(name: str, user_id: int = 1):
     try:
         with sqlite3.connect(DB_FILE) as conn:
             cursor = conn.cursor()
-            cursor.execute('UPDATE searches SET last_viewed = ? WHERE name = ? AND user_id = ?', (datetime.now().isoformat(), name, user_id))
+            now = datetime.now()
+            cursor.execute('UPDATE searches SET last_viewed = ?, last_viewed_ts = ? WHERE name = ? AND user_id = ?', (now.isoformat(), int(now.timestamp()), name, user_id))
             conn.commit()
         return True
     except Exception as e:
@@ -532,31 +1179,18 @@ def get_global_watch_stats(user_id: int = 1) -> Dict[str, Any]:
             cursor.execute('SELECT COUNT(*) FROM ads WHERE user_id = ?', (user_id,))
             total_ads = cursor.fetchone()[0]
             
-            cursor.execute('SELECT name, last_viewed FROM searches WHERE user_id = ?', (user_id,))
-            searches = cursor.fetchall()
-            
-            new_ads_total = 0
-            watch_details = []
-            
-            for s in searches:
-                name = s['name']
-                lv = s['last_viewed']
-                if lv:
-                    cursor.execute('SELECT COUNT(*) FROM ads WHERE search_name = ? AND user_id = ? AND date > ?', (name, user_id, lv))
-                else:
-                    cursor.execute('SELECT COUNT(*) FROM ads WHERE search_name = ? AND user_id = ?', (name, user_id))
-                
-                new_count = cursor.fetchone()[0]
-                new_ads_total += new_count
-                
-                cursor.execute('SELECT COUNT(*) FROM ads WHERE search_name = ? AND user_id = ?', (name, user_id))
-                total_for_search = cursor.fetchone()[0]
-                
-                watch_details.append({
-                    "name": name,
-                    "new_count": new_count,
-                    "total_count": total_for_search
-                })
+            # One grouped pass over the (user_id, search_name, date_ts) index
+            cursor.execute('''
+                SELECT s.name AS name, COUNT(a.id) AS total_count,
+                       COALESCE(SUM(CASE WHEN s.last_viewed_ts IS NULL OR a.date_ts > s.last_viewed_ts THEN 1 ELSE 0 END), 0) AS new_count
+                FROM searches s
+                LEFT JOIN ads a ON a.user_id = s.user_id AND a.search_name = s.name
+                WHERE s.user_id = ?
+                GROUP BY s.name
+            ''', (user_id,))
+            watch_details = [{"name": r['name'], "new_count": r['new_count'] if r['total_count'] else 0, "total_count": r['total_count']}
+                             for r in cursor.fetchall()]
+            new_ads_total = sum(d['new_count'] for d in watch_details)
                 
             return {
                 "total_watches": total_watches,
@@ -576,6 +1210,8 @@ def delete_search(name: str, user_id: int = 1):
             # Delete associated ads and price history first
             cursor.execute('DELETE FROM price_history WHERE user_id = ? AND ad_id IN (SELECT id FROM ads WHERE search_name = ? AND user_id = ?)', (user_id, name, user_id))
             cursor.execute('DELETE FROM ads WHERE search_name = ? AND user_id = ?', (name, user_id))
+            cursor.execute("DELETE FROM market_stats WHERE user_id = ? AND scope = 'watch' AND key = ?", (user_id, name))
+            cursor.execute("DELETE FROM market_stats_history WHERE user_id = ? AND scope = 'watch' AND key = ?", (user_id, name))
             # Delete the search itself
             cursor.execute('DELETE FROM searches WHERE name = ? AND user_id = ?', (name, user_id))
             conn.commit()
@@ -610,41 +1246,1172 @@ def clear_ad_analyses(user_id: int = 1, search_name: str = None, ad_ids: list =
         print(f"[Database Error] Failed to clear analyses: {e}")
         return False
 
-def get_setting(key: str, default: Any = None) -> Any:
-    """Retrieves a global setting."""
+# --- Quotas IA (partagés entre processus) ---
+
+def _load_quota_bucket(cursor, key_id: str, model: str, limits: Dict[str, int], now: float) -> Dict[str, Any]:
+    """Reads a quota bucket and refills it for the time elapsed since its last update."""
+    today = datetime.fromtimestamp(now, timezone.utc).date().isoformat()
+    cursor.execute('SELECT rpm_tokens, tpm_tokens, updated_at, day, day_requests, day_tokens FROM ai_quota WHERE key_id = ? AND model = ?', (key_id, model))
+    row = cursor.fetchone()
+    if not row:
+        return {'rpm_tokens': float(limits['rpm']), 'tpm_tokens': float(limits['tpm']), 'day': today, 'day_requests': 0, 'day_tokens': 0}
+
+    rpm_tokens, tpm_tokens, updated_at, day, day_requests, day_tokens = row
+    elapsed = max(0.0, now - (updated_at or now))
+    bucket = {
+        'rpm_tokens': min(float(limits['rpm']), rpm_tokens + elapsed * limits['rpm'] / 60.0),
+        'tpm_tokens': min(float(limits['tpm']), tpm_tokens + elapsed * limits['tpm'] / 60.0),
+        'day': day,
+        'day_requests': day_requests or 0,
+        'day_tokens': day_tokens or 0
+    }
+    # Daily quota resets on the calendar day (UTC), not 24h after the first call
+    if day != today:
+        bucket.update(day=today, day_requests=0, day_tokens=0)
+    return bucket
+
+def _save_quota_bucket(cursor, key_id: str, model: str, bucket: Dict[str, Any], now: float):
+    cursor.execute('''
+        INSERT OR REPLACE INTO ai_quota (key_id, model, rpm_tokens, tpm_tokens, updated_at, day, day_requests, day_tokens)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (key_id, model, bucket['rpm_tokens'], bucket['tpm_tokens'], now, bucket['day'], bucket['day_requests'], bucket['day_tokens']))
+
+QUOTA_RETRY_SECONDS = 2.0 # Wait before retrying a reservation the database could not record
+
+def reserve_ai_quota(key_id: str, model: str, tokens: int, limits: Dict[str, int]) -> Dict[str, Any]:
+    """
+    Reserves one request and `tokens` tokens in the persistent bucket.
+    Returns {'ok', 'wait', 'reason'}: the caller must wait `wait` seconds before sending.
+    Not ok when the daily quota is spent (reason 'daily') or the bucket could not be
+    updated (reason 'error', retry after `wait`).
+    The read-modify-write runs under BEGIN IMMEDIATE so concurrent processes are serialized.
+    """
+    now = time.time()
+    tokens = min(int(tokens), limits['tpm'])
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None)
+        try:
             cursor = conn.cursor()
-            cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
-            row = cursor.fetchone()
-            return row[0] if row else default
+            cursor.execute('BEGIN IMMEDIATE')
+            bucket = _load_quota_bucket(cursor, key_id, model, limits, now)
+            if bucket['day_requests'] >= limits['rpd']:
+                cursor.execute('ROLLBACK')
+                utc_now = datetime.fromtimestamp(now, timezone.utc)
+                tomorrow = utc_now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+                return {'ok': False, 'wait': (tomorrow - utc_now).total_seconds(), 'reason': 'daily'}
+
+            # Buckets may go negative: the debt is the time the caller has to wait
+            bucket['rpm_tokens'] -= 1
+            bucket['tpm_tokens'] -= tokens
+            bucket['day_requests'] += 1
+            bucket['day_tokens'] += tokens
+            wait = max(0.0, -bucket['rpm_tokens'] * 60.0 / limits['rpm'], -bucket['tpm_tokens'] * 60.0 / limits['tpm'])
+            _save_quota_bucket(cursor, key_id, model, bucket, now)
+            cursor.execute('COMMIT')
+            return {'ok': True, 'wait': wait, 'reason': 'tpm' if bucket['tpm_tokens'] < 0 else 'rpm' if wait else None}
+        finally:
+            conn.close()
     except Exception as e:
-        print(f"[Database Error] Failed to get setting {key}: {e}")
-        return default
+        # Fail closed: without the shared bucket there is no telling what other processes spent
+        print(f"[Database Error] Failed to reserve AI quota: {e}")
+        return {'ok': False, 'wait': QUOTA_RETRY_SECONDS, 'reason': 'error'}
 
-def set_setting(key: str, value: str):
-    """Saves a global setting."""
+def adjust_ai_quota(key_id: str, model: str, token_delta: int, limits: Dict[str, int], penalty_seconds: float = 0):
+    """
+    Corrects a reservation once the real token usage is known (token_delta = reserved - used)
+    and optionally drains the RPM bucket for `penalty_seconds` (e.g. after a 429).
+    """
+    now = time.time()
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None)
+        try:
             cursor = conn.cursor()
-            cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
-            conn.commit()
-        return True
+            cursor.execute('BEGIN IMMEDIATE')
+            bucket = _load_quota_bucket(cursor, key_id, model, limits, now)
+            bucket['tpm_tokens'] = min(float(limits['tpm']), bucket['tpm_tokens'] + token_delta)
+            bucket['day_tokens'] = max(0, bucket['day_tokens'] - token_delta)
+            if penalty_seconds:
+                bucket['rpm_tokens'] = min(bucket['rpm_tokens'], -penalty_seconds * limits['rpm'] / 60.0)
+            _save_quota_bucket(cursor, key_id, model, bucket, now)
+            cursor.execute('COMMIT')
+        finally:
+            conn.close()
     except Exception as e:
-        return False
-        
-def add_feedback(user_id: int, type: str, message: str):
-    """Saves user feedback/bug report."""
+        print(f"[Database Error] Failed to adjust AI quota: {e}")
+
+def get_ai_quota(key_id: str, model: str, limits: Dict[str, int]) -> Dict[str, Any]:
+    """Returns the current (refilled) state of a quota bucket without consuming it."""
     try:
         with sqlite3.connect(DB_FILE) as conn:
+            return _load_quota_bucket(conn.cursor(), key_id, model, limits, time.time())
+    except Exception as e:
+        print(f"[Database Error] Failed to get AI quota: {e}")
+        return {'rpm_tokens': float(limits['rpm']), 'tpm_tokens': float(limits['tpm']), 'day': None, 'day_requests': 0, 'day_tokens': 0}
+
+# --- File des travaux IA ---
+
+AI_JOB_MANUAL, AI_JOB_PEPITE, AI_JOB_BACKLOG = 0, 1, 2
+
+def _ai_job_row(row) -> Dict[str, Any]:
+    job = dict(row)
+    job['ad_ids'] = json.loads(job.get('ad_ids') or '[]')
+    job['done_ids'] = json.loads(job.get('done_ids') or '[]')
+    return job
+
+def enqueue_ai_job(ad_ids: List[str], user_id: int = 1, priority: int = AI_JOB_BACKLOG, custom_context: str = None, notify: bool = True) -> int:
+    """
+    Queues ads for AI analysis. Ads already waiting in another active job of the user are skipped.
+    Returns the job id, 0 if there was nothing new to queue, None on error.
+    """
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
             cursor = conn.cursor()
-            cursor.execute('INSERT INTO feedback (user_id, type, message, created_at) VALUES (?, ?, ?, ?)',
-                           (user_id, type, message, datetime.now().isoformat()))
+            cursor.execute("SELECT ad_ids, done_ids FROM ai_jobs WHERE user_id = ? AND status IN ('queued', 'running')", (user_id,))
+            pending = set()
+            for ids, done in cursor.fetchall():
+                pending.update(set(json.loads(ids or '[]')) - set(json.loads(done or '[]')))
+            ad_ids = [str(i) for i in dict.fromkeys(ad_ids) if str(i) not in pending]
+            if not ad_ids:
+                return 0
+            cursor.execute('''
+                INSERT INTO ai_jobs (user_id, priority, status, ad_ids, custom_context, notify, total, message, created_at)
+                VALUES (?, ?, 'queued', ?, ?, ?, ?, ?, ?)
+            ''', (user_id, priority, json.dumps(ad_ids), custom_context, 1 if notify else 0, len(ad_ids),
+                  "En file d'attente", datetime.now().isoformat()))
             conn.commit()
+            return cursor.lastrowid
+    except Exception as e:
+        print(f"[Database Error] Failed to enqueue AI job: {e}")
+        return None
+
+def claim_next_ai_job(worker_id: str = None, lease_seconds: int = 90) -> Dict[str, Any]:
+    """
+    Atomically picks the next queued job: highest priority first, then the user with the fewest
+    running jobs and served least recently (round-robin between users), then FIFO.
+    Running jobs whose lease expired (their worker process died) are picked up again.
+    """
+    try:
+        conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                SELECT j.* FROM ai_jobs j
+                WHERE j.status = 'queued' OR (j.status = 'running' AND j.lease_expires_at < ?)
+                ORDER BY j.priority,
+                         (SELECT COUNT(*) FROM ai_jobs r WHERE r.user_id = j.user_id AND r.status = 'running'),
+                         COALESCE((SELECT MAX(r.started_at) FROM ai_jobs r WHERE r.user_id = j.user_id), ''),
+                         j.id
+                LIMIT 1
+            ''', (time.time(),))
+            row = cursor.fetchone()
+            if not row:
+                cursor.execute('ROLLBACK')
+                return None
+            cursor.execute('''
+                UPDATE ai_jobs SET status = 'running', started_at = ?, lease_owner = ?, lease_expires_at = ?, heartbeat_at = ?
+                WHERE id = ?
+            ''', (datetime.now().isoformat(), worker_id, time.time() + lease_seconds, time.time(), row['id']))
+            cursor.execute('COMMIT')
+            job = _ai_job_row(row)
+            job.update(status='running', lease_owner=worker_id)
+            return job
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"[Database Error] Failed to claim AI job: {e}")
+        return None
+
+def update_ai_job(job_id: int, worker_id: str = None, **fields) -> bool:
+    """
+    Updates progress fields of a job (status, done_ids, progress, message, finished_at).
+    With a worker_id, only while that worker still holds the running job's lease: returns
+    False once the job was reclaimed by another worker (like finish_job).
+    """
+    allowed = ['status', 'done_ids', 'progress', 'message', 'finished_at']
+    updates = {k: (json.dumps(v) if k == 'done_ids' else v) for k, v in fields.items() if k in allowed}
+    if not updates:
         return True
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            sets = ', '.join(f"{k} = :{k}" for k in updates)
+            fence = " AND lease_owner = :worker_id AND status = 'running'" if worker_id is not None else ""
+            cursor = conn.execute(f"UPDATE ai_jobs SET {sets} WHERE id = :id{fence}",
+                                  {**updates, 'id': job_id, 'worker_id': worker_id})
+            conn.commit()
+        return cursor.rowcount == 1
     except Exception as e:
-        print(f"[Database Error] Failed to add feedback: {e}")
+        print(f"[Database Error] Failed to update AI job: {e}")
+        return False
+
+def add_ai_progress(user_id: int, kind: str, payload: Dict[str, Any]):
+    """Appends an AI status or job progress update for the user's dashboards (any process)."""
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            conn.execute('INSERT INTO ai_progress (user_id, kind, payload, created_at) VALUES (?, ?, ?, ?)',
+                         (user_id, kind, json.dumps(payload, default=str), time.time()))
+            conn.commit()
+    except Exception as e:
+        print(f"[Database Error] add_ai_progress failed: {e}")
+
+def get_ai_progress_head() -> int:
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            return conn.execute('SELECT COALESCE(MAX(seq), 0) FROM ai_progress').fetchone()[0]
+    except Exception as e:
+        print(f"[Database Error] get_ai_progress_head failed: {e}")
+        return 0
+
+def read_ai_progress(after: int, limit: int = 500) -> List[Dict[str, Any]]:
+    """Progress updates written after seq `after`, oldest first."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute('SELECT * FROM ai_progress WHERE seq > ? ORDER BY seq LIMIT ?', (after, limit)).fetchall()
+            return [{**dict(row), 'payload': json.loads(row['payload'])} for row in rows]
+    except Exception as e:
+        print(f"[Database Error] read_ai_progress failed: {e}")
+        return []
+
+def get_latest_ai_status(user_id: int) -> Dict[str, Any]:
+    """Last AI status written for a user, whichever process wrote it; None if there is none."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            row = conn.execute('''
+                SELECT payload FROM ai_progress WHERE user_id = ? AND kind = 'ai_status' ORDER BY seq DESC LIMIT 1
+            ''', (user_id,)).fetchone()
+            return json.loads(row[0]) if row else None
+    except Exception as e:
+        print(f"[Database Error] get_latest_ai_status failed: {e}")
+        return None
+
+def prune_ai_progress(keep_seconds: int = 3600) -> int:
+    """Drops old progress updates, keeping each user's last status."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                DELETE FROM ai_progress WHERE created_at < ?
+                AND seq NOT IN (SELECT MAX(seq) FROM ai_progress WHERE kind = 'ai_status' GROUP BY user_id)
+            ''', (time.time() - keep_seconds,))
+            conn.commit()
+            return cursor.rowcount
+    except Exception as e:
+        print(f"[Database Error] prune_ai_progress failed: {e}")
+        return 0
+
+def is_ai_job_cancelled(job_id: int) -> bool:
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            row = conn.execute('SELECT cancel_requested FROM ai_jobs WHERE id = ?', (job_id,)).fetchone()
+            return bool(row and row[0])
+    except Exception as e:
+        print(f"[Database Error] Failed to read AI job: {e}")
+        return False
+
+def cancel_ai_jobs(user_id: int, job_id: int = None) -> int:
+    """Cancels one job (or all active jobs) of a user. Queued jobs stop at once, running ones after their current batch."""
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            cursor = conn.cursor()
+            scope, params = ("AND id = ?", [user_id, job_id]) if job_id is not None else ("", [user_id])
+            now = datetime.now().isoformat()
+            cursor.execute(f"UPDATE ai_jobs SET status = 'cancelled', cancel_requested = 1, message = 'Annulé', finished_at = ? WHERE user_id = ? AND status = 'queued' {scope}", [now] + params)
+            count = cursor.rowcount
+            cursor.execute(f"UPDATE ai_jobs SET cancel_requested = 1 WHERE user_id = ? AND status = 'running' {scope}", params)
+            count += cursor.rowcount
+            conn.commit()
+            return count
+    except Exception as e:
+        print(f"[Database Error] Failed to cancel AI jobs: {e}")
+        return 0
+
+def get_ai_job(job_id: int, user_id: int = 1) -> Dict[str, Any]:
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute('SELECT * FROM ai_jobs WHERE id = ? AND user_id = ?', (job_id, user_id)).fetchone()
+            return _ai_job_row(row) if row else None
+    except Exception as e:
+        print(f"[Database Error] Failed to get AI job: {e}")
+        return None
+
+def get_ai_jobs(user_id: int = 1, limit: int = 20) -> List[Dict[str, Any]]:
+    """Most recent jobs of a user, active ones first."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM ai_jobs WHERE user_id = ?
+                ORDER BY CASE WHEN status IN ('queued', 'running') THEN 0 ELSE 1 END, id DESC
+                LIMIT ?
+            ''', (user_id, limit))
+            return [_ai_job_row(row) for row in cursor.fetchall()]
+    except Exception as e:
+        print(f"[Database Error] Failed to get AI jobs: {e}")
+        return []
+
+def requeue_interrupted_ai_jobs() -> int:
+    """
+    After a crash or restart, jobs left 'running' without a live lease go back to the queue
+    (done ads are kept); jobs leased by other running worker processes are left alone.
+    """
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE ai_jobs SET status = 'queued', message = 'Reprise après redémarrage'
+                WHERE status = 'running' AND (lease_expires_at IS NULL OR lease_expires_at < ?)
+            ''', (time.time(),))
+            conn.commit()
+            return cursor.rowcount
+    except Exception as e:
+        print(f"[Database Error] Failed to requeue AI jobs: {e}")
+        return 0
+
+# --- Statistiques de marché (t-digest persistés) ---
+
+MARKET_DIGEST_COMPRESSION = 100
+MAX_TRACKED_MARKET_QUERIES = 30 # Per user
+MARKET_QUERY_TTL_DAYS = 30
+MARKET_HISTORY_COMPRESSION = 40
+
+def _market_row(digest: TDigest, total: float, updated_at: str) -> Dict[str, Any]:
+    return {
+        'count': int(digest.count), 'total': total, 'min': digest.min, 'max': digest.max,
+        'p10': digest.quantile(0.10), 'p25': digest.quantile(0.25), 'p50': digest.quantile(0.50),
+        'p75': digest.quantile(0.75), 'p90': digest.quantile(0.90),
+        'digest': json.dumps(digest.to_dict()), 'updated_at': updated_at
+    }
+
+def _write_market_prices(cursor, user_id: int, scope: str, key: str, entries: List[tuple], existing) -> None:
+    """Adds (price, bucket) entries to the aggregate row and to its daily history buckets."""
+    digest = TDigest.from_dict(json.loads(existing['digest'])) if existing else TDigest(MARKET_DIGEST_COMPRESSION)
+    total = existing['total'] if existing else 0.0
+    for price, _ in entries:
+        digest.add(price)
+        total += price
+    row = _market_row(digest, total, datetime.now().isoformat())
+    cursor.execute('''
+        INSERT OR REPLACE INTO market_stats (user_id, scope, key, count, total, min, max, p10, p25, p50, p75, p90, digest, updated_at)
+        VALUES (:user_id, :scope, :key, :count, :total, :min, :max, :p10, :p25, :p50, :p75, :p90, :digest, :updated_at)
+    ''', {**row, 'user_id': user_id, 'scope': scope, 'key': key})
+
+    by_bucket = {}
+    for price, bucket in entries:
+        by_bucket.setdefault(bucket, []).append(price)
+    for bucket, prices in by_bucket.items():
+        cursor.execute('SELECT total, digest FROM market_stats_history WHERE user_id = ? AND scope = ? AND key = ? AND bucket = ?',
+                       (user_id, scope, key, bucket))
+        hist = cursor.fetchone()
+        day_digest = TDigest.from_dict(json.loads(hist[1])) if hist else TDigest(MARKET_HISTORY_COMPRESSION)
+        day_total = (hist[0] if hist else 0.0) + sum(prices)
+        for price in prices:
+            day_digest.add(price)
+        cursor.execute('''
+            INSERT OR REPLACE INTO market_stats_history (user_id, scope, key, bucket, count, total, min, max, p50, digest)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, scope, key, bucket, int(day_digest.count), day_total, day_digest.min, day_digest.max,
+              day_digest.quantile(0.5), json.dumps(day_digest.to_dict())))
+
+def update_market_stats(user_id: int, scope: str, key: str, entries: List[tuple], seed: bool = False) -> bool:
+    """
+    Incrementally adds (price, 'YYYY-MM-DD') entries to a market aggregate.
+    With seed=False nothing happens if the aggregate does not exist yet (returns False);
+    with seed=True the entries initialize it, unless another process seeded it first.
+    """
+    try:
+        conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT total, digest FROM market_stats WHERE user_id = ? AND scope = ? AND key = ?', (user_id, scope, key))
+            existing = cursor.fetchone()
+            if bool(existing) == seed:
+                cursor.execute('ROLLBACK')
+                return bool(existing)
+            if entries or seed:
+                _write_market_prices(cursor, user_id, scope, key, entries, existing)
+            cursor.execute('COMMIT')
+            return True
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"[Database Error] Failed to update market stats: {e}")
+        return False
+
+def get_market_aggregate(user_id: int, scope: str, key: str) -> Dict[str, Any]:
+    """Single-row read of a maintained market aggregate (None if not tracked yet)."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute('''
+                SELECT count, total, min, max, p10, p25, p50, p75, p90, updated_at
+                FROM market_stats WHERE user_id = ? AND scope = ? AND key = ?
+            ''', (user_id, scope, key)).fetchone()
+            return dict(row) if row else None
+    except Exception as e:
+        print(f"[Database Error] Failed to get market stats: {e}")
+        return None
+
+def get_market_history(user_id: int, scope: str, key: str, since: str = '') -> List[Dict[str, Any]]:
+    """Daily buckets (count, avg, median, min, max) of a market aggregate."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT bucket, count, total, min, max, p50 FROM market_stats_history
+                WHERE user_id = ? AND scope = ? AND key = ? AND bucket >= ?
+                ORDER BY bucket
+            ''', (user_id, scope, key, since))
+            return [dict(row) for row in cursor.fetchall()]
+    except Exception as e:
+        print(f"[Database Error] Failed to get market history: {e}")
+        return []
+
+def touch_market_query(user_id: int, key: str):
+    """Records that a query aggregate was read (at most one write per day and query)."""
+    try:
+        today = datetime.now().date().isoformat()
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            conn.execute('''
+                UPDATE market_stats SET accessed_at = ?
+                WHERE user_id = ? AND scope = 'query' AND key = ? AND (accessed_at IS NULL OR accessed_at < ?)
+            ''', (datetime.now().isoformat(), user_id, key, today))
+            conn.commit()
+    except Exception as e:
+        print(f"[Database Error] Failed to touch market query: {e}")
+
+def prune_market_queries(user_id: int = None, keep: int = MAX_TRACKED_MARKET_QUERIES,
+                         idle_days: int = MARKET_QUERY_TTL_DAYS) -> int:
+    """
+    Stops tracking query aggregates not read for idle_days, and each user's least recently
+    read ones beyond `keep`; every tracked query costs a match on each ingested ad.
+    """
+    try:
+        cutoff = (datetime.now() - timedelta(days=idle_days)).isoformat()
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            users = [user_id] if user_id is not None else [r[0] for r in conn.execute(
+                "SELECT DISTINCT user_id FROM market_stats WHERE scope = 'query'")]
+            stale = []
+            for uid in users:
+                keys = [r[0] for r in conn.execute('''
+                    SELECT key FROM market_stats WHERE user_id = ? AND scope = 'query'
+                    ORDER BY COALESCE(accessed_at, updated_at) DESC
+                ''', (uid,))]
+                recent = {r[0] for r in conn.execute('''
+                    SELECT key FROM market_stats WHERE user_id = ? AND scope = 'query' AND COALESCE(accessed_at, updated_at) >= ?
+                ''', (uid, cutoff))}
+                stale += [(uid, key) for i, key in enumerate(keys) if i >= keep or key not in recent]
+            for table in ('market_stats', 'market_stats_history'):
+                conn.executemany(f"DELETE FROM {table} WHERE user_id = ? AND scope = 'query' AND key = ?", stale)
+            conn.commit()
+            return len(stale)
+    except Exception as e:
+        print(f"[Database Error] Failed to prune market queries: {e}")
+        return 0
+
+def get_tracked_market_queries(user_id: int) -> List[str]:
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.execute("SELECT key FROM market_stats WHERE user_id = ? AND scope = 'query'", (user_id,))
+            return [row[0] for row in cursor.fetchall()]
+    except Exception as e:
+        print(f"[Database Error] Failed to get tracked market queries: {e}")
+        return []
+
+def get_setting(key: str, default: Any = None) -> Any:
+    """Retrieves a global setting."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
+            row = cursor.fetchone()
+            return row[0] if row else default
+    except Exception as e:
+        print(f"[Database Error] Failed to get setting {key}: {e}")
+        return default
+
+def set_setting(key: str, value: str):
+    """Saves a global setting."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
+            conn.commit()
+        return True
+    except Exception as e:
+        return False
+        
+def add_feedback(user_id: int, type: str, message: str):
+    """Saves user feedback/bug report."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute('INSERT INTO feedback (user_id, type, message, created_at) VALUES (?, ?, ?, ?)',
+                           (user_id, type, message, datetime.now().isoformat()))
+            conn.commit()
+        return True
+    except Exception as e:
+        print(f"[Database Error] Failed to add feedback: {e}")
         return False
 
 # Initialize or update the database
 initialize_db()
+
+# --- Journal des modifications (ad_events) ---
+
+def get_ad_events_head() -> int:
+    """Sequence number of the last log entry (0 when empty)."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            return conn.execute('SELECT COALESCE(MAX(seq), 0) FROM ad_events').fetchone()[0]
+    except Exception as e:
+        print(f"[Database Error] get_ad_events_head failed: {e}")
+        return 0
+
+def register_consumer(consumer: str) -> int:
+    """Creates a consumer offset at the end of the log (no-op if it exists); returns its offset."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.execute('''
+                INSERT OR IGNORE INTO consumer_offsets (consumer, seq, updated_at)
+                SELECT ?, COALESCE(MAX(seq), 0), ? FROM ad_events
+            ''', (consumer, datetime.now().isoformat()))
+            conn.commit()
+            return conn.execute('SELECT seq FROM consumer_offsets WHERE consumer = ?', (consumer,)).fetchone()[0]
+    except Exception as e:
+        print(f"[Database Error] register_consumer failed for {consumer}: {e}")
+        return None
+
+def read_ad_events(consumer: str, kinds: List[str] = None, limit: int = 500, after: int = None) -> Dict[str, Any]:
+    """
+    Next events after the consumer's offset (or after `after`, to read ahead before
+    committing), each with the current ad row ('ad', None if the ad was deleted since).
+    Returns {"events", "last_seq"}: last_seq covers the filtered-out events too and is what
+    commit_consumer_offset expects. A new consumer starts at the end of the log.
+    """
+    try:
+        offset = after if after is not None else register_consumer(consumer)
+        if offset is None:
+            return {"events": [], "last_seq": None}
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            cursor = conn.cursor()
+            rows = cursor.execute('SELECT * FROM ad_events WHERE seq > ? ORDER BY seq LIMIT ?', (offset, limit)).fetchall()
+            last_seq = rows[-1]['seq'] if rows else offset
+            events = [dict(r) for r in rows if not kinds or r['kind'] in kinds]
+
+            # Attach the current ad rows, one query per user
+            by_user: Dict[int, set] = {}
+            for event in events:
+                by_user.setdefault(event['user_id'], set()).add(event['ad_id'])
+            ads = {}
+            for user_id, ad_ids in by_user.items():
+                ad_ids = list(ad_ids)
+                for i in range(0, len(ad_ids), 500):
+                    chunk = ad_ids[i:i + 500]
+                    placeholders = ','.join('?' for _ in chunk)
+                    for ad in cursor.execute(f'SELECT * FROM ads WHERE user_id = ? AND id IN ({placeholders})', [user_id] + chunk):
+                        ads[(user_id, ad['id'])] = dict(ad)
+            for event in events:
+                event['ad'] = ads.get((event['user_id'], event['ad_id']))
+            return {"events": events, "last_seq": last_seq}
+    except Exception as e:
+        print(f"[Database Error] read_ad_events failed for {consumer}: {e}")
+        return {"events": [], "last_seq": None}
+
+def drop_consumer(consumer: str):
+    """Forgets a consumer offset that is no longer advanced."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.execute('DELETE FROM consumer_offsets WHERE consumer = ?', (consumer,))
+            conn.commit()
+    except Exception as e:
+        print(f"[Database Error] drop_consumer failed for {consumer}: {e}")
+
+def commit_consumer_offset(consumer: str, seq: int, fence: Tuple[str, str, int] = None) -> bool:
+    """
+    Moves a consumer's offset forward (never backward). With a fence (leader name, holder,
+    token), only while that leader lease is still held in that term; returns whether it moved.
+    """
+    if seq is None:
+        return True
+    try:
+        name, holder, token = fence or (None, None, None)
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO consumer_offsets (consumer, seq, updated_at) SELECT ?, ?, ?
+                WHERE ? IS NULL OR EXISTS (
+                    SELECT 1 FROM leader_leases WHERE name = ? AND holder = ? AND token = ? AND expires_at > ?
+                )
+                ON CONFLICT(consumer) DO UPDATE SET seq = MAX(seq, excluded.seq), updated_at = excluded.updated_at
+            ''', (consumer, seq, datetime.now().isoformat(), name, name, holder, token, time.time()))
+            conn.commit()
+            return cursor.rowcount > 0
+    except Exception as e:
+        print(f"[Database Error] commit_consumer_offset failed for {consumer}: {e}")
+        return False
+
+def prune_ad_events(keep_days: int = 30) -> int:
+    """Drops log entries older than keep_days that every consumer has already read."""
+    try:
+        cutoff = (datetime.now() - timedelta(days=keep_days)).isoformat()
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                DELETE FROM ad_events
+                WHERE created_at < ? AND seq <= (SELECT COALESCE(MIN(seq), 0) FROM consumer_offsets)
+            ''', (cutoff,))
+            conn.commit()
+            return cursor.rowcount
+    except Exception as e:
+        print(f"[Database Error] prune_ad_events failed: {e}")
+        return 0
+
+# --- Notification outbox (notifiers/outbox.py) ---
+def enqueue_notifications(items: List[Dict[str, Any]]) -> int:
+    """
+    Queues outbox messages in one transaction. Each item: {"webhook", "embed" (dict),
+    "user_id"?, "content"?, "not_before"? (epoch seconds)}. Returns the number queued.
+    """
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            count = _insert_outbox_rows(conn.cursor(), items)
+            conn.commit()
+        return count
+    except Exception as e:
+        print(f"[Database Error] Failed to enqueue notifications: {e}")
+        return 0
+
+def _insert_outbox_rows(cursor, items: List[Dict[str, Any]]) -> int:
+    rows = [(item.get('user_id'), item['webhook'], item.get('content'), json.dumps(item['embed'], ensure_ascii=False),
+             item.get('not_before') or 0, datetime.now().isoformat())
+            for item in items if item.get('webhook') and item.get('embed')]
+    cursor.executemany('''
+        INSERT INTO notification_outbox (user_id, webhook, content, embed, status, next_attempt_at, created_at)
+        VALUES (?, ?, ?, ?, 'pending', ?, ?)
+    ''', rows)
+    return len(rows)
+
+def get_due_webhooks(now: float = None, limit: int = 50) -> List[str]:
+    """Webhooks with at least one pending message due for delivery, oldest first."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            rows = conn.execute('''
+                SELECT webhook FROM notification_outbox
+                WHERE status = 'pending' AND next_attempt_at <= ?
+                GROUP BY webhook ORDER BY MIN(id) LIMIT ?
+            ''', (time.time() if now is None else now, limit)).fetchall()
+            return [r[0] for r in rows]
+    except Exception as e:
+        print(f"[Database Error] Failed to list due webhooks: {e}")
+        return []
+
+def claim_outbox_batch(webhook: str, limit: int = 10, max_chars: int = None) -> List[Dict[str, Any]]:
+    """
+    Atomically marks the next due messages of one webhook as 'sending' and returns them:
+    up to `limit`, in order, sharing the same content, and (if given) whose serialized embeds
+    total at most `max_chars` characters, so they fit in one webhook message.
+    """
+    try:
+        conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                SELECT * FROM notification_outbox
+                WHERE webhook = ? AND status = 'pending' AND next_attempt_at <= ?
+                ORDER BY id LIMIT ?
+            ''', (webhook, time.time(), limit))
+            batch, used = [], 0
+            for row in cursor.fetchall():
+                item = dict(row)
+                item['embed'] = json.loads(item['embed'])
+                size = len(json.dumps(item['embed'], ensure_ascii=False))
+                if batch and (item['content'] != batch[0]['content'] or (max_chars and used + size > max_chars)):
+                    break
+                batch.append(item)
+                used += size
+            if batch:
+                cursor.executemany("UPDATE notification_outbox SET status = 'sending', claimed_at = ? WHERE id = ?",
+                                   [(time.time(), item['id']) for item in batch])
+            cursor.execute('COMMIT')
+            return batch
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"[Database Error] Failed to claim outbox batch: {e}")
+        return []
+
+def complete_outbox(ids: List[int]):
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.executemany("UPDATE notification_outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE id = ?",
+                             [(datetime.now().isoformat(), i) for i in ids])
+            conn.commit()
+    except Exception as e:
+        print(f"[Database Error] Failed to complete outbox messages: {e}")
+
+def retry_outbox(ids: List[int], next_attempt_at: float, error: str = None, count_attempt: bool = True,
+                 max_attempts: int = None):
+    """
+    Puts messages back in the queue for `next_attempt_at` (epoch seconds). Rate-limit waits
+    pass count_attempt=False; messages reaching max_attempts are marked failed instead.
+    """
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            attempt = 1 if count_attempt else 0
+            cursor.executemany('''
+                UPDATE notification_outbox
+                SET attempts = attempts + ?, next_attempt_at = ?, last_error = ?, status = 'pending'
+                WHERE id = ?
+            ''', [(attempt, next_attempt_at, error, i) for i in ids])
+            if max_attempts:
+                cursor.execute(f'''
+                    UPDATE notification_outbox SET status = 'failed'
+                    WHERE status = 'pending' AND attempts >= ? AND id IN ({', '.join('?' * len(ids))})
+                ''', [max_attempts] + list(ids))
+            conn.commit()
+    except Exception as e:
+        print(f"[Database Error] Failed to reschedule outbox messages: {e}")
+
+def fail_outbox(ids: List[int], error: str):
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.executemany("UPDATE notification_outbox SET status = 'failed', last_error = ? WHERE id = ?",
+                             [(error, i) for i in ids])
+            conn.commit()
+    except Exception as e:
+        print(f"[Database Error] Failed to mark outbox messages failed: {e}")
+
+def recover_outbox(stale_seconds: int = 300) -> int:
+    """Requeues messages left 'sending' by a process that died mid-delivery."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.execute("UPDATE notification_outbox SET status = 'pending' WHERE status = 'sending' AND claimed_at < ?",
+                                  (time.time() - stale_seconds,))
+            conn.commit()
+            return cursor.rowcount
+    except Exception as e:
+        print(f"[Database Error] Failed to recover outbox: {e}")
+        return 0
+
+def get_outbox_stats(user_id: int = None) -> Dict[str, int]:
+    """Message counts per status (one user's, or all)."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            sql, params = 'SELECT status, COUNT(*) FROM notification_outbox', []
+            if user_id is not None:
+                sql += ' WHERE user_id = ?'
+                params.append(user_id)
+            return dict(conn.execute(sql + ' GROUP BY status', params).fetchall())
+    except Exception as e:
+        print(f"[Database Error] Failed to get outbox stats: {e}")
+        return {}
+
+def prune_notification_outbox(keep_days: int = 7) -> int:
+    """Drops delivered and failed messages older than keep_days."""
+    try:
+        cutoff = (datetime.now() - timedelta(days=keep_days)).isoformat()
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.execute("DELETE FROM notification_outbox WHERE status IN ('sent', 'failed') AND created_at < ?", (cutoff,))
+            conn.commit()
+            return cursor.rowcount
+    except Exception as e:
+        print(f"[Database Error] prune_notification_outbox failed: {e}")
+        return 0
+
+# --- Notification ledger (dedup of Discord alerts) ---
+NOTIFICATION_TTL_DAYS = 30 # After this, an ad may alert again for the same kind and price
+
+def _ledger_price(price) -> float:
+    try:
+        return round(float(price), 2) if price is not None else -1.0
+    except (TypeError, ValueError):
+        return -1.0
+
+def _ledger_keys(ads: List[Dict[str, Any]]) -> Dict[Tuple[str, float], Dict[str, Any]]:
+    keyed = {}
+    for ad in ads:
+        if ad.get('id') is not None:
+            keyed.setdefault((str(ad['id']), _ledger_price(ad.get('price'))), ad)
+    return keyed
+
+def _already_notified(cursor, keyed: Dict[Tuple[str, float], Dict[str, Any]], kind: str, user_id: int,
+                      ttl_days: int, now: float) -> set:
+    """One IN query checks the whole batch."""
+    ids = sorted({ad_id for ad_id, _ in keyed})
+    cursor.execute(f'''
+        SELECT ad_id, price FROM notifications_sent
+        WHERE user_id = ? AND kind = ? AND sent_at >= ? AND ad_id IN ({', '.join('?' * len(ids))})
+    ''', [user_id, kind, now - ttl_days * 86400] + ids)
+    return {(row[0], row[1]) for row in cursor.fetchall()}
+
+def unnotified(ads: List[Dict[str, Any]], kind: str, user_id: int = 1,
+               ttl_days: int = NOTIFICATION_TTL_DAYS) -> List[Dict[str, Any]]:
+    """Read-only pre-check: the ads not alerted for (user, ad, kind, price) within ttl_days."""
+    keyed = _ledger_keys(ads)
+    if not keyed:
+        return []
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            sent = _already_notified(conn.cursor(), keyed, kind, user_id, ttl_days, time.time())
+            return [ad for key, ad in keyed.items() if key not in sent]
+    except Exception as e:
+        print(f"[Database Error] Failed to check the notification ledger: {e}")
+        return []
+
+def claim_notifications(ads: List[Dict[str, Any]], kind: str, user_id: int = 1,
+                        ttl_days: int = NOTIFICATION_TTL_DAYS,
+                        build: Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    """
+    Returns the ads never alerted for (user, ad, kind, price) within ttl_days, and records
+    them in the same transaction so concurrent callers cannot both send the same alert.
+    `build(fresh_ads)` returns their outbox messages (see enqueue_notifications), queued in
+    that transaction too: an alert is recorded as sent only if it was queued.
+    Returns None when the transaction failed (nothing recorded, nothing queued).
+    """
+    keyed = _ledger_keys(ads)
+    if not keyed:
+        return []
+    try:
+        now = time.time()
+        conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None)
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            sent = _already_notified(cursor, keyed, kind, user_id, ttl_days, now)
+            fresh = [key for key in keyed if key not in sent]
+            cursor.executemany('''
+                INSERT OR REPLACE INTO notifications_sent (user_id, ad_id, kind, price, sent_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(user_id, ad_id, kind, price, now) for ad_id, price in fresh])
+            if build is not None and fresh:
+                _insert_outbox_rows(cursor, build([keyed[key] for key in fresh]))
+            cursor.execute('COMMIT')
+            return [keyed[key] for key in fresh]
+        finally:
+            conn.close() # Rolls back unless committed
+    except Exception as e:
+        print(f"[Database Error] Failed to claim notifications: {e}")
+        return None
+
+def prune_notifications_sent(ttl_days: int = NOTIFICATION_TTL_DAYS) -> int:
+    """Drops ledger entries older than the dedup TTL."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.execute('DELETE FROM notifications_sent WHERE sent_at < ?', (time.time() - ttl_days * 86400,))
+            conn.commit()
+            return cursor.rowcount
+    except Exception as e:
+        print(f"[Database Error] prune_notifications_sent failed: {e}")
+        return 0
+
+# --- Daily digest (digest.py) ---
+DIGEST_CANDIDATES_PER_USER = 20 # Kept above the digest size so hidden or deleted ads leave no gap
+
+def add_digest_candidates(ads: List[Dict[str, Any]], user_id: int = 1, keep: int = DIGEST_CANDIDATES_PER_USER):
+    """Merges scored ads into the user's digest candidates and trims them back to the best `keep`."""
+    rows = [(user_id, str(ad['id']), ad.get('ai_score') or 0, time.time()) for ad in ads if ad.get('id') is not None]
+    if not rows:
+        return
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT INTO digest_candidates (user_id, ad_id, score, added_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id, ad_id) DO UPDATE SET score = excluded.score
+            ''', rows)
+            cursor.execute('''
+                DELETE FROM digest_candidates WHERE user_id = ? AND rowid NOT IN (
+                    SELECT rowid FROM digest_candidates WHERE user_id = ? ORDER BY score DESC, added_at DESC LIMIT ?
+                )
+            ''', (user_id, user_id, keep))
+            conn.commit()
+    except Exception as e:
+        print(f"[Database Error] Failed to add digest candidates: {e}")
+
+def get_digest_ads(user_id: int = 1, limit: int = 5) -> List[Dict[str, Any]]:
+    """The user's best current candidates still visible, with their ad rows (one indexed query)."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute('''
+                SELECT ads.*, digest_candidates.added_at AS digest_added_at FROM digest_candidates
+                JOIN ads ON ads.id = digest_candidates.ad_id AND ads.user_id = digest_candidates.user_id
+                WHERE digest_candidates.user_id = ? AND ads.is_hidden = 0
+                ORDER BY digest_candidates.score DESC, digest_candidates.added_at DESC LIMIT ?
+            ''', (user_id, limit)).fetchall()
+            return [dict(r) for r in rows]
+    except Exception as e:
+        print(f"[Database Error] Failed to get digest ads: {e}")
+        return []
+
+def get_users_due_for_digest(now: datetime = None) -> List[Dict[str, Any]]:
+    """Users whose digest hour has come today and who have not received today's digest yet."""
+    now = now or datetime.now()
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute('''
+                SELECT id, discord_webhook, digest_hour FROM users
+                WHERE digest_hour IS NOT NULL AND digest_hour <= ?
+                  AND (last_digest_date IS NULL OR last_digest_date < ?)
+            ''', (now.hour, now.date().isoformat())).fetchall()
+            return [dict(r) for r in rows]
+    except Exception as e:
+        print(f"[Database Error] Failed to list users due for a digest: {e}")
+        return []
+
+def claim_digest(user_id: int, day: str) -> bool:
+    """Marks the user's digest of `day` as taken; False when another process already took it."""
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE users SET last_digest_date = ? WHERE id = ? AND (last_digest_date IS NULL OR last_digest_date < ?)
+            ''', (day, user_id, day))
+            conn.commit()
+            return cursor.rowcount > 0
+    except Exception as e:
+        print(f"[Database Error] Failed to claim digest: {e}")
+        return False
+
+def release_digest(user_id: int, day: str):
+    """Gives a claimed digest back (it could not be queued), so the next loop retries it."""
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            conn.execute('UPDATE users SET last_digest_date = NULL WHERE id = ? AND last_digest_date = ?', (user_id, day))
+            conn.commit()
+    except Exception as e:
+        print(f"[Database Error] Failed to release digest: {e}")
+
+def complete_digest(user_id: int, up_to: float):
+    """Clears the candidates a sent digest covered."""
+    try:
+        with sqlite3.connect(DB_FILE) as conn:
+            conn.execute('DELETE FROM digest_candidates WHERE user_id = ? AND added_at <= ?', (user_id, up_to))
+            conn.commit()
+    except Exception as e:
+        print(f"[Database Error] Failed to complete digest: {e}")
+
+# --- Lease-based job queue (jobs.py, worker.py) ---
+_LEASED_TABLES = ('jobs', 'ai_jobs')
+
+def enqueue_job(kind: str, payload: Dict[str, Any], user_id: int = 1, dedup_key: str = None,
+                priority: int = 0, max_attempts: int = 3, scheduled_for: float = None) -> int:
+    """
+    Queues a job and returns its id. With a dedup_key, an unfinished job with the same key is
+    returned instead of queueing a second one.
+    """
+    try:
+        now = time.time()
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR IGNORE INTO jobs (kind, user_id, payload, dedup_key, priority, status, attempts, max_attempts,
+                                            run_after, scheduled_for, created_at)
+                VALUES (?, ?, ?, ?, ?, 'queued', 0, ?, ?, ?, ?)
+            ''', (kind, user_id, json.dumps(payload), dedup_key, priority, max_attempts, now, scheduled_for or now, now))
+            if cursor.rowcount:
+                job_id = cursor.lastrowid
+            else:
+                job_id = cursor.execute("SELECT id FROM jobs WHERE dedup_key = ? AND status IN ('queued', 'running')",
+                                        (dedup_key,)).fetchone()[0]
+            conn.commit()
+            return job_id
+    except Exception as e:
+        print(f"[Database Error] Failed to enqueue job: {e}")
+        return None
+
+def _job_row(row) -> Dict[str, Any]:
+    job = dict(row)
+    job['payload'] = json.loads(job.get('payload') or '{}')
+    return job
+
+def claim_job(kinds: List[str], worker_id: str, lease_seconds: int) -> Dict[str, Any]:
+    """
+    Atomically leases the next runnable job of the given kinds to worker_id: queued ones, or
+    running ones whose lease expired (their worker died). Jobs out of attempts are failed.
+    Highest priority first, then the user with the fewest jobs of that kind running and served
+    least recently (fair share between users at execution time), then the oldest.
+    """
+    try:
+        conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            while True:
+                cursor.execute(f'''
+                    SELECT j.* FROM jobs j
+                    WHERE j.kind IN ({', '.join('?' * len(kinds))})
+                      AND ((j.status = 'queued' AND j.run_after <= ?) OR (j.status = 'running' AND j.lease_expires_at < ?))
+                    ORDER BY j.priority,
+                             (SELECT COUNT(*) FROM jobs r WHERE r.kind = j.kind AND r.user_id = j.user_id
+                                                          AND r.status = 'running' AND r.lease_expires_at >= ?),
+                             COALESCE((SELECT MAX(r.started_at) FROM jobs r WHERE r.kind = j.kind AND r.user_id = j.user_id), 0),
+                             j.run_after, j.id
+                    LIMIT 1
+                ''', list(kinds) + [now, now, now])
+                row = cursor.fetchone()
+                if not row:
+                    cursor.execute('COMMIT')
+                    return None
+                if row['attempts'] >= row['max_attempts']:
+                    cursor.execute("UPDATE jobs SET status = 'failed', finished_at = ?, last_error = COALESCE(last_error, 'Lease expired') WHERE id = ?",
+                                   (now, row['id']))
+                    continue
+                cursor.execute('''
+                    UPDATE jobs SET status = 'running', lease_owner = ?, lease_expires_at = ?, heartbeat_at = ?,
+                                    started_at = ?, attempts = attempts + 1
+                    WHERE id = ?
+                ''', (worker_id, now + lease_seconds, now, now, row['id']))
+                cursor.execute('COMMIT')
+                job = _job_row(row)
+                job.update(status='running', lease_owner=worker_id, started_at=now, attempts=row['attempts'] + 1)
+                return job
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"[Database Error] Failed to claim job: {e}")
+        return None
+
+def renew_leases(table: str, worker_id: str, ids: List[int], lease_seconds: int) -> List[int]:
+    """Heartbeat: extends the leases worker_id still holds; returns their ids (others were lost)."""
+    if table not in _LEASED_TABLES or not ids:
+        return []
+    try:
+        now = time.time()
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            placeholders = ', '.join('?' * len(ids))
+            conn.execute(f'''
+                UPDATE {table} SET lease_expires_at = ?, heartbeat_at = ?
+                WHERE lease_owner = ? AND status = 'running' AND id IN ({placeholders})
+            ''', [now + lease_seconds, now, worker_id] + list(ids))
+            rows = conn.execute(f"SELECT id FROM {table} WHERE lease_owner = ? AND status = 'running' AND id IN ({placeholders})",
+                                [worker_id] + list(ids)).fetchall()
+            conn.commit()
+            return [r[0] for r in rows]
+    except Exception as e:
+        print(f"[Database Error] Failed to renew leases: {e}")
+        return list(ids)
+
+def finish_job(job_id: int, worker_id: str, status: str, error: str = None, retry_in: float = None) -> bool:
+    """
+    Records a job outcome if worker_id still holds its lease (a job reclaimed after an expired
+    lease belongs to its new worker). retry_in puts it back in the queue instead.
+    """
+    try:
+        now = time.time()
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            if retry_in is not None:
+                cursor = conn.execute('''
+                    UPDATE jobs SET status = 'queued', run_after = ?, last_error = ?, lease_owner = NULL, lease_expires_at = NULL
+                    WHERE id = ? AND lease_owner = ? AND status = 'running'
+                ''', (now + retry_in, error, job_id, worker_id))
+            else:
+                cursor = conn.execute('''
+                    UPDATE jobs SET status = ?, last_error = ?, finished_at = ?, lease_expires_at = NULL
+                    WHERE id = ? AND lease_owner = ? AND status = 'running'
+                ''', (status, error, now, job_id, worker_id))
+            conn.commit()
+            return cursor.rowcount == 1
+    except Exception as e:
+        print(f"[Database Error] Failed to finish job: {e}")
+        return False
+
+def get_job(job_id: int) -> Dict[str, Any]:
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            return _job_row(row) if row else None
+    except Exception as e:
+        print(f"[Database Error] Failed to get job: {e}")
+        return None
+
+def get_job_stats(user_id: int = None) -> Dict[str, Any]:
+    """Job counts per kind and status, active workers, and the lateness of recent refreshes."""
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            where, params = ('WHERE user_id = ?', [user_id]) if user_id is not None else ('', [])
+            counts = {}
+            for kind, status, n in conn.execute(f'SELECT kind, status, COUNT(*) FROM jobs {where} GROUP BY kind, status', params):
+                counts.setdefault(kind, {})[status] = n
+            workers = [r[0] for r in conn.execute(
+                "SELECT DISTINCT lease_owner FROM jobs WHERE status = 'running' AND lease_expires_at >= ?", (time.time(),))]
+            lateness = conn.execute(f'''
+                SELECT AVG(started_at - scheduled_for), MAX(started_at - scheduled_for) FROM jobs
+                {where + ' AND' if where else 'WHERE'} kind = 'refresh' AND started_at IS NOT NULL AND created_at >= ?
+            ''', params + [time.time() - 86400]).fetchone()
+            return {"jobs": counts, "active_workers": workers,
+                    "refresh_lateness_24h": {"avg": round(lateness[0] or 0, 1), "max": round(lateness[1] or 0, 1)}}
+    except Exception as e:
+        print(f"[Database Error] Failed to get job stats: {e}")
+        return {}
+
+def prune_jobs(keep_days: int = 7) -> int:
+    """Drops finished jobs older than keep_days."""
+    try:
+        with sqlite3.connect(DB_FILE, timeout=30) as conn:
+            cursor = conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND created_at < ?",
+                                  (time.time() - keep_days * 86400,))
+            conn.commit()
+            return cursor.rowcount
+    except Exception as e:
+        print(f"[Database Error] prune_jobs failed: {e}")
+        return 0
+
+# --- Leader election (leader.py) ---
+def acquire_leadership(name: str, holder: str, ttl_seconds: float) -> Tuple[bool, int]:
+    """
+    Takes or renews the `name` leader lease for holder in one statement: granted when it is
+    free, expired or already held by holder. Returns (is_leader, fencing token); the token
+    grows each time leadership changes hands.
+    """
+    try:
+        now = time.time()
+        with sqlite3.connect(DB_FILE, timeout=10) as conn:
+            conn.execute('''
+                INSERT INTO leader_leases (name, holder, token, acquired_at, expires_at) VALUES (?, ?, 1, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    token = CASE WHEN leader_leases.holder = excluded.holder THEN leader_leases.token ELSE leader_leases.token + 1 END,
+                    acquired_at = CASE WHEN leader_leases.holder = excluded.holder THEN leader_leases.acquired_at ELSE excluded.acquired_at END,
+                    holder = excluded.holder,
+                    expires_at = excluded.expires_at
+                WHERE leader_leases.holder = excluded.holder OR leader_leases.expires_at < ?
+            ''', (name, holder, now, now + ttl_seconds, now))
+            conn.commit()
+            row = conn.execute('SELECT holder, token FROM leader_leases WHERE name = ?', (name,)).fetchone()
+            return row[0] == holder, row[1]
+    except Exception as e:
+        print(f"[Database Error] Leader election failed: {e}")
+        return False, None
+
+def release_leadership(name: str, holder: str):
+    """Lets another process take over at once instead of waiting for the lease to expire."""
+    try:
+        with sqlite3.connect(DB_FILE, timeout=10) as conn:
+            conn.execute('UPDATE leader_leases SET expires_at = 0 WHERE name = ? AND holder = ?', (name, holder))
+            conn.commit()
+    except Exception as e:
+        print(f"[Database Error] Failed to release leadership: {e}")
+
+def get_leaders() -> List[Dict[str, Any]]:
+    try:
+        with sqlite3.connect(DB_FILE, timeout=10) as conn:
+            conn.row_factory = sqlite3.Row
+            return [dict(r, alive=r['expires_at'] >= time.time()) for r in conn.execute('SELECT * FROM leader_leases')]
+    except Exception as e:
+        print(f"[Database Error] Failed to get leaders: {e}")
+        return []
@@ -0,0 +1,65 @@
+'''
+Per-user daily digest. The pipeline's digest stage keeps each user's best pépites of the day
+in digest_candidates as they are scored; at the user's digest hour the top ones are read back
+with one indexed query and queued in the Discord outbox as a single message.
+'''
+import time
+from datetime import datetime
+from typing import Callable, Dict, Any, List
+
+import database
+from notifiers import outbox
+
+DIGEST_SIZE = 5
+DIGEST_CONTENT = "📅 **VOTRE RÉCAPITULATIF QUOTIDIEN**\nVoici les {count} meilleures pépites trouvées ces dernières 24h :"
+
+
+def build_embeds(ads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [{
+        "title": f"🏆 {ad['title']}",
+        "url": ad['url'],
+        "description": f"Score: **{ad.get('ai_score')}/10** - {ad.get('price')}€\n{(ad.get('ai_summary') or '')[:100]}...",
+        "color": 0xF59E0B
+    } for ad in ads]
+
+
+def send_user_digest(user: Dict[str, Any], now: datetime = None) -> bool:
+    """
+    Queues one user's digest and marks the day done (also when there is nothing to send).
+    The day is claimed first, so a digest goes out once even if two processes get here.
+    Returns whether a digest was queued; a failed enqueue is retried on the next loop.
+    """
+    now = now or datetime.now()
+    day = now.date().isoformat()
+    if not database.claim_digest(user['id'], day):
+        return False
+    started = time.time()
+    ads = database.get_digest_ads(user_id=user['id'], limit=DIGEST_SIZE)
+    webhook = user.get('discord_webhook') or database.get_setting('discord_webhook')
+    if ads and webhook:
+        content = DIGEST_CONTENT.format(count=len(ads))
+        if not outbox.enqueue(webhook, build_embeds(ads), content=content, user_id=user['id']):
+            print(f"❌ Erreur Digest (utilisateur {user['id']}) : mise en file impossible")
+            database.release_digest(user['id'], day)
+            return False
+        print(f"✅ Daily Digest mis en file d'envoi (utilisateur {user['id']}, {len(ads)} pépite(s)).")
+    database.complete_digest(user['id'], up_to=started)
+    return bool(ads and webhook)
+
+
+def send_due_digests(now: datetime = None, gate: Callable[[], bool] = None) -> int:
+    """
+    Sends the digest of every user whose digest hour has come today; returns how many were
+    queued. With a gate (leader election), stops as soon as it returns False.
+    """
+    now = now or datetime.now()
+    sent = 0
+    for user in database.get_users_due_for_digest(now):
+        if gate is not None and not gate():
+            break
+        try:
+            sent += send_user_digest(user, now)
+        except Exception as e:
+            print(f"❌ Erreur Digest (utilisateur {user['id']}) : {e}")
+    return sent
+
@@ -0,0 +1,107 @@
+'''
+Lazy detail enrichment: fetches the full Leboncoin ad (description, coordinates, category)
+only for ads about to be analyzed or notified, instead of for every refreshed ad.
+Fetches are deduplicated across threads, spaced by a shared rate limit and stored in one
+write; details_at marks an ad as done so it is never fetched twice.
+'''
+import threading
+from typing import Dict, Any, List, Optional
+
+import database
+from ad_import import HostThrottle
+from utils import run_blocking
+
+ENRICH_MAX_PER_CALL = 40 # Detail fetches per enrich() call, the rest go out without details
+ENRICH_MIN_INTERVAL = 1.0 # Seconds between two Leboncoin API calls, all threads together
+ENRICH_WAIT_SECONDS = 60 # How long a caller waits for the same ads being fetched by another thread
+ENRICHABLE_SOURCES = ('LBC', 'lbc')
+
+_throttle = HostThrottle(ENRICH_MIN_INTERVAL)
+_inflight: Dict[tuple, threading.Event] = {}
+_inflight_lock = threading.Lock()
+_client = None
+_client_lock = threading.Lock()
+
+
+def needs_details(ad: Dict[str, Any]) -> bool:
+    """Leboncoin ads never enriched that still lack a description, coordinates or category."""
+    if ad.get('details_at') or ad.get('source') not in ENRICHABLE_SOURCES:
+        return False
+    return not ad.get('description') or ad.get('lat') is None or ad.get('lng') is None or not ad.get('category')
+
+
+def _get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            import lbc
+            _client = run_blocking(lbc.Client) # Opens its session with a request
+        return _client
+
+
+def fetch_details(ad_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Full ad from the Leboncoin API as detail columns. Returns {"id"} alone for an ad that no
+    longer exists (so it is not retried); raises on transient errors.
+    """
+    from lbc.exceptions import NotFoundError
+    _throttle.wait('https://api.leboncoin.fr')
+    try:
+        ad = run_blocking(_get_client().get_ad, ad_id)
+    except NotFoundError:
+        return {"id": ad_id}
+    location = getattr(ad, 'location', None)
+    return {
+        "id": ad_id,
+        "description": getattr(ad, 'body', None),
+        "lat": getattr(location, 'lat', None),
+        "lng": getattr(location, 'lng', None),
+        "category": getattr(ad, 'category_name', None),
+    }
+
+
+def enrich(ads: List[Dict[str, Any]], user_id: int = 1) -> List[Dict[str, Any]]:
+    """
+    Returns `ads` (same order, extra keys kept) with the stored details merged in, fetching
+    them first for the ads that need it. Ads being fetched by another thread are waited for.
+    """
+    candidates, seen = [], set()
+    for ad in ads:
+        if ad.get('id') not in seen and needs_details(ad):
+            seen.add(ad['id'])
+            candidates.append(ad['id'])
+    candidates = candidates[:ENRICH_MAX_PER_CALL]
+    if not candidates:
+        return ads
+
+    owned, waiting = [], []
+    with _inflight_lock:
+        for ad_id in candidates:
+            key = (user_id, ad_id)
+            if key in _inflight:
+                waiting.append(_inflight[key])
+            else:
+                _inflight[key] = threading.Event()
+                owned.append(ad_id)
+
+    details = []
+    try:
+        from lbc.exceptions import DatadomeError
+        for ad_id in owned:
+            try:
+                details.append(fetch_details(ad_id))
+            except DatadomeError as e:
+                print(f"[Enrichment] Blocked by Leboncoin, skipping the remaining details: {e}")
+                break
+            except Exception as e:
+                print(f"[Enrichment] Details of ad {ad_id} unavailable: {e}")
+        database.save_ad_details(details, user_id=user_id)
+    finally:
+        with _inflight_lock:
+            for ad_id in owned:
+                _inflight.pop((user_id, ad_id)).set()
+    for event in waiting:
+        event.wait(timeout=ENRICH_WAIT_SECONDS)
+
+    fresh = {str(ad['id']): ad for ad in database.get_ads_by_ids(candidates, user_id=user_id)}
+    return [{**ad, **fresh[str(ad['id'])]} if str(ad.get('id')) in fresh else ad for ad in ads]
@@ -0,0 +1,77 @@
+'''
+Per-user live event broker behind the /api/events Server-Sent Events stream.
+Producers (pipeline stages; AI status and job progress arrive from the worker processes
+through pipeline.LiveStage) publish; each open tab holds a bounded queue, so a slow or
+dead tab never blocks a producer.
+'''
+import json
+import queue
+import threading
+from typing import Dict, Any, List, Optional
+
+NEW_AD, PRICE_DROP, PEPITE = 'new_ad', 'price_drop', 'pepite'
+AI_STATUS, AI_JOB, WATCH_STATS = 'ai_status', 'ai_job', 'watch_stats'
+
+SUBSCRIBER_QUEUE_SIZE = 200
+HEARTBEAT_SECONDS = 25 # Keeps proxies from closing an idle stream
+
+_subscribers: Dict[int, List["queue.Queue"]] = {}
+_lock = threading.Lock()
+
+
+def subscribe(user_id: int) -> "queue.Queue":
+    q = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+    with _lock:
+        _subscribers.setdefault(user_id, []).append(q)
+    return q
+
+
+def unsubscribe(user_id: int, q: "queue.Queue"):
+    with _lock:
+        queues = _subscribers.get(user_id, [])
+        if q in queues:
+            queues.remove(q)
+        if not queues:
+            _subscribers.pop(user_id, None)
+
+
+def _offer(q: "queue.Queue", item):
+    try:
+        q.put_nowait(item)
+    except queue.Full:
+        # Drop the oldest event rather than block the producer
+        try:
+            q.get_nowait()
+        except queue.Empty:
+            pass
+        q.put_nowait(item)
+
+
+def publish(user_id: int, kind: str, data: Dict[str, Any]):
+    """Sends an event to every open stream of a user (no-op when nobody listens)."""
+    with _lock:
+        queues = list(_subscribers.get(user_id, []))
+    for q in queues:
+        _offer(q, (kind, data))
+
+
+def broadcast(kind: str, data: Dict[str, Any]):
+    """Sends an event to every open stream."""
+    with _lock:
+        queues = [q for qs in _subscribers.values() for q in qs]
+    for q in queues:
+        _offer(q, (kind, data))
+
+
+def has_subscribers(user_id: Optional[int] = None) -> bool:
+    with _lock:
+        return bool(_subscribers.get(user_id)) if user_id is not None else bool(_subscribers)
+
+
+def format_sse(kind: str, data: Dict[str, Any]) -> str:
+    return f"event: {kind}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+def ad_brief(ad: Dict[str, Any]) -> Dict[str, Any]:
+    """Compact ad payload for live events (the full ad is fetched from /api/ads when shown)."""
+    return {k: ad.get(k) for k in ('id', 'title', 'price', 'url', 'ai_score', 'location')}
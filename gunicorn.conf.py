@@ -0,0 +1,41 @@
+'''
+Gunicorn settings for the dashboard (see wsgi.py).
+gevent workers serve many requests each: while one waits on Leboncoin, Gemini or an imported
+page, the worker keeps serving others instead of being pinned. SSE streams (AI answers, live
+feed) hold a connection, not a worker.
+With EMBEDDED_WORKER on (single-container setup, the default), the master also runs worker.py
+beside the web workers, as a plain process; set it to false when workers run elsewhere.
+'''
+import os
+import sys
+import subprocess
+import multiprocessing
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+workers = int(os.getenv('WEB_CONCURRENCY', min(4, multiprocessing.cpu_count() * 2 + 1)))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', 200)) # Concurrent requests per gevent worker
+timeout = 120 # Deep searches and AI calls can take a while; SSE keeps the worker alive meanwhile
+graceful_timeout = 30
+keepalive = 5
+preload_app = False # Each worker starts its own background threads after the fork
+accesslog = '-'
+errorlog = '-'
+
+_ingestion = None
+
+
+def on_starting(server):
+    global _ingestion
+    if os.getenv('EMBEDDED_WORKER', 'true').lower() == 'true':
+        _ingestion = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')])
+        server.log.info(f"Started ingestion worker (pid {_ingestion.pid})")
+
+
+def on_exit(server):
+    if _ingestion is not None and _ingestion.poll() is None:
+        _ingestion.terminate() # SIGTERM: worker.py releases its leader lease on the way out
+        try:
+            _ingestion.wait(timeout=graceful_timeout)
+        except subprocess.TimeoutExpired:
+            _ingestion.kill()
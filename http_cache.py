@@ -0,0 +1,236 @@
+'''
+Persistent HTTP cache for page fetches (manual ad import, eBay search), kept in its own
+SQLite file so it never contends with the ads database.
+Bodies are stored zlib-compressed; stale entries are revalidated with conditional GETs
+(If-None-Match / If-Modified-Since), and the file is capped by size with LRU eviction.
+Hit, revalidation and miss counters are kept in the same file, so stats() covers every
+process fetching through it (web workers and ingestion workers alike).
+'''
+import os
+import json
+import time
+import zlib
+import sqlite3
+from typing import Dict, Any, Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# Next to the ads database by default
+HTTP_CACHE_FILE = os.getenv('HTTP_CACHE_PATH') or os.path.join(os.path.dirname(os.getenv('DB_PATH', 'leboncoin_ads.db')), 'http_cache.db')
+MAX_CACHE_BYTES = int(os.getenv('HTTP_CACHE_MAX_BYTES', 64 * 1024 * 1024)) # Compressed bodies
+DEFAULT_FRESHNESS = 0 # Seconds an entry is served without asking the server (0: always revalidate)
+# Per-host freshness: ad pages barely change within minutes, search result pages do
+HOST_FRESHNESS = {
+    'www.leboncoin.fr': 15 * 60,
+    'www.ebay.fr': 5 * 60,
+}
+_KEPT_HEADERS = ('content-type', 'etag', 'last-modified', 'cache-control')
+METRICS = ("requests", "hits", "revalidated", "misses", "stored", "evicted", "errors",
+           "bytes_saved") # bytes_saved: uncompressed bodies not downloaded
+
+
+class CachedResponse:
+    """The subset of requests.Response the fetchers use (status_code, headers, content, text)."""
+    def __init__(self, url: str, status_code: int, headers: Dict[str, str], content: bytes,
+                 encoding: Optional[str], from_cache: bool = False, revalidated: bool = False):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+        self.encoding = encoding
+        self.from_cache = from_cache
+        self.revalidated = revalidated
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status_code < 400
+
+
+class HttpCache:
+    def __init__(self, path: str = HTTP_CACHE_FILE, max_bytes: int = MAX_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        if not self._initialized:
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Réponses HTTP mises en cache
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    url TEXT PRIMARY KEY,
+                    host TEXT,
+                    status INTEGER,
+                    headers TEXT,
+                    encoding TEXT,
+                    body BLOB,
+                    size INTEGER,
+                    stored_at REAL,
+                    last_access REAL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_access ON responses (last_access)')
+            # Compteurs partagés par tous les processus
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS metrics (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            self._initialized = True
+        return conn
+
+    def _count(self, **deltas: int):
+        """Adds to the persisted counters; a failed write only loses the counts."""
+        try:
+            with self._connect() as conn:
+                conn.executemany('''
+                    INSERT INTO metrics (name, value) VALUES (?, ?)
+                    ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+                ''', [(name, n) for name, n in deltas.items() if n])
+        except sqlite3.Error as e:
+            print(f"[HTTP Cache] Metrics write failed: {e}")
+
+    @staticmethod
+    def freshness(url: str) -> int:
+        return HOST_FRESHNESS.get(urlparse(url).netloc, DEFAULT_FRESHNESS)
+
+    def _load(self, url: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute('SELECT status, headers, encoding, body, size, stored_at FROM responses WHERE url = ?',
+                               (url,)).fetchone()
+        if row is None:
+            return None
+        return {"status": row[0], "headers": json.loads(row[1] or '{}'), "encoding": row[2],
+                "body": row[3], "size": row[4], "stored_at": row[5]}
+
+    def _touch(self, url: str, refreshed: bool = False):
+        now = time.time()
+        with self._connect() as conn:
+            if refreshed:
+                conn.execute('UPDATE responses SET last_access = ?, stored_at = ? WHERE url = ?', (now, now, url))
+            else:
+                conn.execute('UPDATE responses SET last_access = ? WHERE url = ?', (now, url))
+
+    def _store(self, url: str, resp: requests.Response):
+        headers = {k.lower(): v for k, v in resp.headers.items() if k.lower() in _KEPT_HEADERS}
+        body = zlib.compress(resp.content, 6)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO responses (url, host, status, headers, encoding, body, size, stored_at, last_access)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (url, urlparse(url).netloc, resp.status_code, json.dumps(headers), resp.encoding, body, len(body), now, now))
+        self._count(stored=1)
+        self._evict()
+
+    def _evict(self):
+        """Drops the least recently used entries until the bodies fit in max_bytes."""
+        with self._connect() as conn:
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            excess, victims = total - self.max_bytes, []
+            for url, size in conn.execute('SELECT url, size FROM responses ORDER BY last_access'):
+                victims.append((url,))
+                excess -= size
+                if excess <= 0:
+                    break
+            conn.executemany('DELETE FROM responses WHERE url = ?', victims)
+        self._count(evicted=len(victims))
+
+    def is_fresh(self, url: str) -> bool:
+        """Whether a GET of `url` would be served from the cache without touching the network."""
+        try:
+            with self._connect() as conn:
+                row = conn.execute('SELECT stored_at FROM responses WHERE url = ?', (url,)).fetchone()
+        except sqlite3.Error:
+            return False
+        return row is not None and time.time() - row[0] < self.freshness(url)
+
+    def get(self, url: str, headers: Dict[str, str] = None, timeout: float = 10,
+            session: requests.Session = None, freshness: int = None) -> CachedResponse:
+        """
+        GET through the cache: fresh entries are served locally, stale ones revalidated
+        (304 keeps the stored body), anything else fetched and stored when cacheable.
+        Network errors propagate like requests.get; a broken cache file only disables caching.
+        """
+        freshness = self.freshness(url) if freshness is None else freshness
+        errors = 0
+        try:
+            entry = self._load(url)
+        except sqlite3.Error as e:
+            print(f"[HTTP Cache] Read failed: {e}")
+            errors += 1
+            entry = None
+
+        if entry and time.time() - entry["stored_at"] < freshness:
+            content = zlib.decompress(entry["body"])
+            self._touch(url)
+            self._count(requests=1, hits=1, bytes_saved=len(content), errors=errors)
+            return CachedResponse(url, entry["status"], entry["headers"], content, entry["encoding"], from_cache=True)
+
+        request_headers = dict(headers or {})
+        if entry and entry["headers"].get('etag'):
+            request_headers['If-None-Match'] = entry["headers"]['etag']
+        if entry and entry["headers"].get('last-modified'):
+            request_headers['If-Modified-Since'] = entry["headers"]['last-modified']
+
+        resp = (session or requests).get(url, headers=request_headers, timeout=timeout)
+        if resp.status_code == 304 and entry:
+            content = zlib.decompress(entry["body"])
+            self._touch(url, refreshed=True)
+            self._count(requests=1, revalidated=1, bytes_saved=len(content), errors=errors)
+            return CachedResponse(url, entry["status"], entry["headers"], content, entry["encoding"],
+                                  from_cache=True, revalidated=True)
+
+        if resp.status_code == 200 and 'no-store' not in resp.headers.get('Cache-Control', ''):
+            try:
+                self._store(url, resp)
+            except sqlite3.Error as e:
+                print(f"[HTTP Cache] Write failed: {e}")
+                errors += 1
+        self._count(requests=1, misses=1, errors=errors)
+        return CachedResponse(url, resp.status_code, dict(resp.headers), resp.content, resp.encoding)
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters since the cache file was created or cleared, across all processes."""
+        metrics = dict.fromkeys(METRICS, 0)
+        try:
+            with self._connect() as conn:
+                metrics.update(conn.execute('SELECT name, value FROM metrics').fetchall())
+                entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        except sqlite3.Error:
+            entries, size = None, None
+        served = metrics["hits"] + metrics["revalidated"]
+        return {**metrics, "entries": entries, "size_bytes": size, "max_bytes": self.max_bytes,
+                "hit_ratio": round(served / metrics["requests"], 3) if metrics["requests"] else 0.0}
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM responses')
+            conn.execute('DELETE FROM metrics')
+
+
+_cache = HttpCache()
+
+
+def get(url: str, headers: Dict[str, str] = None, timeout: float = 10,
+        session: requests.Session = None, freshness: int = None) -> CachedResponse:
+    """Cached drop-in for requests.get(url, headers=..., timeout=...)."""
+    return _cache.get(url, headers=headers, timeout=timeout, session=session, freshness=freshness)
+
+
+def is_fresh(url: str) -> bool:
+    return _cache.is_fresh(url)
+
+
+def stats() -> Dict[str, Any]:
+    return _cache.stats()
@@ -0,0 +1,138 @@
+'''
+Lease-based job queue shared by ingestion worker processes (worker.py), possibly on several
+hosts using the same database file. A worker leases a job from the jobs table, a heartbeat
+thread keeps the lease alive while it runs, and a job whose worker died is picked up again
+once its lease expires. AI analysis jobs (ai_jobs) use the same leases and heartbeat.
+'''
+import os
+import time
+import socket
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Any, List, Optional, Set, Tuple
+
+import database
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", 90))
+HEARTBEAT_SECONDS = LEASE_SECONDS / 3
+REFRESH_JOB_WORKERS = int(os.getenv("REFRESH_JOB_WORKERS", 2))
+REFRESH_TIMEOUT = 30 * 60 # A scheduled refresh waits this long for a worker before counting as failed
+RETRY_SECONDS = 30
+POLL_SECONDS = 2
+
+REFRESH = 'refresh'
+
+_handlers: Dict[str, Callable[[Dict[str, Any]], Any]] = {}
+_wakeup = threading.Event()
+
+
+class Heartbeat:
+    """Renews the leases this process holds until the jobs finish."""
+    def __init__(self, worker_id: str = WORKER_ID, interval: float = HEARTBEAT_SECONDS):
+        self.worker_id = worker_id
+        self.interval = interval
+        self._held: Set[Tuple[str, int]] = set()
+        self._lock = threading.Lock()
+        self._started = False
+
+    @contextmanager
+    def hold(self, table: str, job_id: int):
+        with self._lock:
+            self._held.add((table, job_id))
+            if not self._started:
+                self._started = True
+                threading.Thread(target=self._run, name="job-heartbeat", daemon=True).start()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._held.discard((table, job_id))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                by_table: Dict[str, List[int]] = {}
+                for table, job_id in self._held:
+                    by_table.setdefault(table, []).append(job_id)
+            for table, ids in by_table.items():
+                kept = set(database.renew_leases(table, self.worker_id, ids, LEASE_SECONDS))
+                lost = [i for i in ids if i not in kept]
+                if lost:
+                    print(f"[Jobs] Lease lost on {table} {lost}: another worker may run them again.")
+
+
+heartbeat = Heartbeat()
+
+
+def register(kind: str, handler: Callable[[Dict[str, Any]], Any]):
+    """Sets the function running jobs of `kind` in this process (job dict in, result ignored)."""
+    _handlers[kind] = handler
+
+
+def enqueue(kind: str, payload: Dict[str, Any], user_id: int = 1, dedup_key: str = None,
+            priority: int = 0, scheduled_for: float = None) -> int:
+    job_id = database.enqueue_job(kind, payload, user_id=user_id, dedup_key=dedup_key,
+                                  priority=priority, scheduled_for=scheduled_for)
+    _wakeup.set()
+    return job_id
+
+
+def run_refresh(name: str, user_id: int, scheduled_for: float = None, timeout: float = REFRESH_TIMEOUT) -> Optional[float]:
+    """
+    Queues a refresh job for a watch and waits until a worker (any process) has run it; returns
+    when the worker claimed it (the refresh's real start, for the scheduler's lateness).
+    Raises when it failed or timed out, so the caller's scheduling sees it as a failed run.
+    """
+    job_id = enqueue(REFRESH, {"name": name}, user_id=user_id, dedup_key=f"{REFRESH}:{user_id}:{name}",
+                     scheduled_for=scheduled_for)
+    if job_id is None:
+        raise RuntimeError("refresh job could not be queued")
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = database.get_job(job_id)
+        if job is None:
+            return None
+        if job['status'] == 'done':
+            return job['started_at']
+        if job['status'] == 'failed':
+            raise RuntimeError(job.get('last_error') or 'refresh job failed')
+        time.sleep(1)
+    raise TimeoutError(f"refresh job #{job_id} still pending after {timeout:.0f}s")
+
+
+class JobWorkerPool:
+    def __init__(self, kinds: List[str], workers: int = REFRESH_JOB_WORKERS):
+        self.kinds = list(kinds)
+        self._workers = max(1, workers)
+
+    def _run_job(self, job: Dict[str, Any]):
+        handler = _handlers.get(job['kind'])
+        try:
+            with heartbeat.hold('jobs', job['id']):
+                handler(job)
+        except Exception as e:
+            print(f"[Job Error] {job['kind']} job #{job['id']} failed (attempt {job['attempts']}): {e}")
+            retry = job['attempts'] < job['max_attempts']
+            database.finish_job(job['id'], WORKER_ID, 'failed', error=str(e), retry_in=RETRY_SECONDS if retry else None)
+            return
+        if not database.finish_job(job['id'], WORKER_ID, 'done'):
+            print(f"[Jobs] {job['kind']} job #{job['id']} finished after its lease was lost.")
+
+    def _work(self):
+        while True:
+            job = database.claim_job(self.kinds, WORKER_ID, LEASE_SECONDS)
+            if not job:
+                _wakeup.wait(timeout=POLL_SECONDS)
+                _wakeup.clear()
+                continue
+            self._run_job(job)
+
+    def start(self):
+        missing = [kind for kind in self.kinds if kind not in _handlers]
+        if missing:
+            raise ValueError(f"No handler registered for job kind(s): {', '.join(missing)}")
+        for i in range(self._workers):
+            threading.Thread(target=self._work, name=f"job-worker-{i+1}", daemon=True).start()
+        print(f"Started {self._workers} job worker(s) for {', '.join(self.kinds)} ({WORKER_ID}).")
@@ -0,0 +1,80 @@
+'''
+Advisory leader election over the shared SQLite database. Every worker process (and web
+process running an embedded worker) competes for a named lease in leader_leases; the holder
+renews it every few seconds and only the current leader runs the background loops that must
+happen once: refresh scheduling, digests, log consumers, outbox delivery and pruning.
+A leader that dies or stalls loses the lease after LEADER_TTL_SECONDS and another takes over.
+A stalled leader may still be finishing a step when that happens: the loops check is_leader()
+before each unit of work, and the writes that must not be repeated carry the fencing token
+(fence()), so they are refused once the term is over.
+'''
+import os
+import time
+import atexit
+import threading
+from typing import Callable, List, Optional, Tuple
+
+import database
+import jobs
+
+LEADER_TTL_SECONDS = float(os.getenv("LEADER_TTL_SECONDS", 15))
+RENEW_SECONDS = LEADER_TTL_SECONDS / 3
+SAFETY_MARGIN = 0.2 # Fraction of the TTL a leader stops starting new work before its lease can be taken over
+
+
+class LeaderElector:
+    def __init__(self, name: str = "background", holder: str = jobs.WORKER_ID, ttl: float = LEADER_TTL_SECONDS):
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self.token = None # Fencing token of the current term
+        self._valid_until = 0.0
+        self._callbacks: List[Callable[[], None]] = []
+        self._started = False
+        self._lock = threading.Lock()
+
+    def is_leader(self) -> bool:
+        """Whether this process leads right now; false as soon as a renewal is overdue."""
+        return time.time() < self._valid_until
+
+    def fence(self) -> Optional[Tuple[str, str, int]]:
+        """(name, holder, token) of the current term for fenced writes; None when not leading."""
+        return (self.name, self.holder, self.token) if self.is_leader() else None
+
+    def on_elected(self, callback: Callable[[], None]):
+        """Runs `callback` each time this process becomes leader (e.g. to resync at once)."""
+        self._callbacks.append(callback)
+
+    def _campaign(self):
+        was_leader = False
+        while True:
+            attempt = time.time()
+            leader, token = database.acquire_leadership(self.name, self.holder, self.ttl)
+            # Counted from before the attempt: the database may have granted it a moment later
+            self._valid_until = attempt + self.ttl * (1 - SAFETY_MARGIN) if leader else 0.0
+            if leader and not was_leader:
+                self.token = token
+                print(f"👑 {self.holder} is now the '{self.name}' leader (term {token}).")
+                for callback in self._callbacks:
+                    try:
+                        callback()
+                    except Exception as e:
+                        print(f"[Leader Error] {e}")
+            elif was_leader and not leader:
+                print(f"{self.holder} lost the '{self.name}' leadership.")
+            was_leader = leader
+            time.sleep(max(0.0, RENEW_SECONDS - (time.time() - attempt)))
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._campaign, name=f"leader-{self.name}", daemon=True).start()
+        atexit.register(self.release)
+
+    def release(self):
+        """Steps down so a follower takes over on its next renewal instead of after the TTL."""
+        if self.is_leader():
+            self._valid_until = 0.0
+            database.release_leadership(self.name, self.holder)
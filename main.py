@@ -1,6 +1,7 @@
 import random
 import lbc
 import database
+import analytics
 from config import handle
 from analyzer import analyze_results, generate_batch_summaries
 from nlp import parse_sentence
@@ -16,12 +17,12 @@ def run_viewer():
     print(f"\n{BORDER}")
     print("      📜 CONSULTATION DES ANNONCES SAUVEGARDÉES")
     print(f"{BORDER}")
-    all_ads = database.get_all_ads()
+    # Most recent first, ordered on the columnar cache
+    all_ads = analytics.top_ads(k=None, by='date')
     if not all_ads: 
         print(" > Aucune annonce en base de données.")
         return
     
-    all_ads.sort(key=lambda x: x.get('date') or '', reverse=True)
     print(f"Total: {len(all_ads)} annonce(s)\n")
     
     for i, ad in enumerate(all_ads):
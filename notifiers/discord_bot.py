@@ -1,5 +1,61 @@
 import requests
-from typing import Dict, Any
+from typing import Dict, Any, List
+
+MAX_EMBEDS_PER_MESSAGE = 10 # Discord webhook limits
+MAX_EMBED_CHARS_PER_MESSAGE = 6000
+BOT_USERNAME = "LBC Finder AI"
+BOT_AVATAR_URL = "https://raw.githubusercontent.com/FortAwesome/Font-Awesome/6.x/svgs/solid/rocket.svg"
+
+
+def build_ad_embed(ad: Dict[str, Any], is_pepite: bool = False, price_drop: bool = False) -> Dict[str, Any]:
+    """Rich embed of one ad (pépite, price drop or plain alert)."""
+    title_prefix = "✨ " if is_pepite else ""
+    if price_drop:
+        title_prefix = "📉 "
+
+    color = 0x10B981 # Green for general/pepite
+    if price_drop:
+        color = 0x4F46E5 # Indigo for price drop
+    elif is_pepite:
+        color = 0xF59E0B # Gold for pepite
+
+    # Score visualization
+    score = ad.get('ai_score', 0)
+    score_stars = "⭐" * int(score) if score else "Non noté"
+
+    embed = {
+        "title": f"{title_prefix}{ad['title']}",
+        "url": ad['url'],
+        "color": color,
+        "fields": [
+            {"name": "💰 Prix", "value": f"{ad['price']} €", "inline": True},
+            {"name": "📍 Lieu", "value": ad.get('location', 'Inconnu'), "inline": True},
+            {"name": "⭐ Note IA", "value": f"{score}/10 {score_stars}", "inline": False},
+            {"name": "📦 Source", "value": ad.get('source', 'LBC'), "inline": True}
+        ],
+        "footer": {"text": f"Veille : {ad.get('search_name', 'Manuelle')}"}
+    }
+
+    if ad.get('image_url'):
+        embed["thumbnail"] = {"url": ad['image_url']}
+
+    if ad.get('ai_summary'):
+        embed["description"] = f"**Résumé IA :** {ad['ai_summary']}"
+
+    return embed
+
+
+def build_payload(embeds: List[Dict[str, Any]], content: str = None) -> Dict[str, Any]:
+    """Webhook message carrying up to MAX_EMBEDS_PER_MESSAGE embeds."""
+    payload = {
+        "username": BOT_USERNAME,
+        "avatar_url": BOT_AVATAR_URL,
+        "embeds": embeds[:MAX_EMBEDS_PER_MESSAGE]
+    }
+    if content:
+        payload["content"] = content
+    return payload
+
 
 class DiscordNotifier:
     """
@@ -12,47 +68,8 @@ class DiscordNotifier:
         if not self.webhook_url:
             return
 
-        title_prefix = "✨ " if is_pepite else ""
-        if price_drop:
-            title_prefix = "📉 "
-            
-        color = 0x10B981 # Green for general/pepite
-        if price_drop:
-            color = 0x4F46E5 # Indigo for price drop
-        elif is_pepite:
-            color = 0xF59E0B # Gold for pepite
-
-        # Score visualization
-        score = ad.get('ai_score', 0)
-        score_stars = "⭐" * int(score) if score else "Non noté"
-
-        embed = {
-            "title": f"{title_prefix}{ad['title']}",
-            "url": ad['url'],
-            "color": color,
-            "fields": [
-                {"name": "💰 Prix", "value": f"{ad['price']} €", "inline": True},
-                {"name": "📍 Lieu", "value": ad.get('location', 'Inconnu'), "inline": True},
-                {"name": "⭐ Note IA", "value": f"{score}/10 {score_stars}", "inline": False},
-                {"name": "📦 Source", "value": ad.get('source', 'LBC'), "inline": True}
-            ],
-            "footer": {"text": f"Veille : {ad.get('search_name', 'Manuelle')}"}
-        }
-
-        if ad.get('image_url'):
-            embed["thumbnail"] = {"url": ad['image_url']}
-        
-        if ad.get('ai_summary'):
-            embed["description"] = f"**Résumé IA :** {ad['ai_summary']}"
-
-        payload = {
-            "username": "LBC Finder AI",
-            "avatar_url": "https://raw.githubusercontent.com/FortAwesome/Font-Awesome/6.x/svgs/solid/rocket.svg",
-            "embeds": [embed]
-        }
-        
-        if content:
-            payload["content"] = content
+        embed = build_ad_embed(ad, is_pepite=is_pepite, price_drop=price_drop)
+        payload = build_payload([embed], content=content)
 
         try:
             resp = requests.post(self.webhook_url, json=payload, timeout=10)
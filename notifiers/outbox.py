@@ -0,0 +1,208 @@
+'''
+Persistent Discord outbox: alerts are queued in the notification_outbox table and delivered
+by a dispatcher thread, packed up to 10 embeds per webhook message.
+Each webhook is served by at most one worker at a time, so bursts on one channel never delay
+another. Discord's rate-limit headers are honoured (429 Retry-After, bucket exhaustion, global
+limit); server and network errors are retried with exponential backoff.
+'''
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Any, List, Optional
+
+import requests
+
+import database
+from notifiers.discord_bot import build_ad_embed, build_payload, MAX_EMBEDS_PER_MESSAGE, MAX_EMBED_CHARS_PER_MESSAGE
+
+OUTBOX_WORKERS = 4 # Webhooks delivered in parallel
+POLL_SECONDS = 2 # Catches messages queued by other processes; same-process callers wake the dispatcher
+MAX_ATTEMPTS = 6 # Failed deliveries (5xx, network) before a message is marked failed
+BACKOFF_BASE = 2.0 # Seconds, doubled per attempt
+BACKOFF_MAX = 300.0
+REQUEST_TIMEOUT = 10
+STALE_SENDING_SECONDS = 300 # 'sending' rows older than this were left by a dead process
+
+_wakeup = threading.Event()
+_blocked_until: Dict[str, float] = {} # Per-webhook rate-limit bucket waits
+_global_until = 0.0
+_busy = set()
+_state_lock = threading.Lock()
+_started = False
+_start_lock = threading.Lock()
+
+
+def enqueue(webhook: str, embeds: List[Dict[str, Any]], content: str = None, user_id: int = None,
+            not_before: float = None) -> int:
+    """
+    Queues embeds for one webhook (messages sharing `content` are packed together), held
+    until `not_before` (epoch seconds) when given.
+    """
+    if not webhook or not embeds:
+        return 0
+    count = database.enqueue_notifications(items(webhook, embeds, content=content, user_id=user_id, not_before=not_before))
+    notify()
+    return count
+
+
+def items(webhook: str, embeds: List[Dict[str, Any]], content: str = None, user_id: int = None,
+          not_before: float = None) -> List[Dict[str, Any]]:
+    """Outbox rows for enqueue, or for database.claim_notifications to queue with its ledger rows."""
+    return [{"webhook": webhook, "embed": embed, "content": content, "user_id": user_id, "not_before": not_before}
+            for embed in embeds]
+
+
+def enqueue_ad(webhook: str, ad: Dict[str, Any], is_pepite: bool = False, price_drop: bool = False,
+               content: str = None, user_id: int = None) -> int:
+    return enqueue(webhook, [build_ad_embed(ad, is_pepite=is_pepite, price_drop=price_drop)],
+                   content=content, user_id=user_id)
+
+
+def notify():
+    """Wakes the dispatcher up right after a message is queued."""
+    _wakeup.set()
+
+
+def _backoff(attempts: int) -> float:
+    """Exponential backoff with full jitter for the next attempt."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempts)))
+
+
+def _retry_after(resp: requests.Response) -> float:
+    """Seconds to wait after a 429, from the Retry-After header or the JSON body."""
+    try:
+        return float(resp.json().get('retry_after'))
+    except Exception:
+        pass
+    try:
+        return float(resp.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+def _bucket_wait(resp: requests.Response) -> Optional[float]:
+    """Seconds until the webhook bucket refills when this response exhausted it."""
+    if resp.headers.get('X-RateLimit-Remaining') != '0':
+        return None
+    try:
+        return float(resp.headers.get('X-RateLimit-Reset-After'))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+def _block(webhook: str, seconds: float, is_global: bool = False):
+    global _global_until
+    until = time.time() + seconds
+    with _state_lock:
+        if is_global:
+            _global_until = max(_global_until, until)
+        else:
+            _blocked_until[webhook] = max(_blocked_until.get(webhook, 0), until)
+
+
+def _available_at(webhook: str) -> float:
+    with _state_lock:
+        return max(_global_until, _blocked_until.get(webhook, 0))
+
+
+def deliver_batch(webhook: str, batch: List[Dict[str, Any]], session: requests.Session = None) -> bool:
+    """
+    Posts one claimed batch as a single message and records the outcome.
+    Returns False when the webhook must not be used again before its rate-limit wait.
+    """
+    ids = [item['id'] for item in batch]
+    payload = build_payload([item['embed'] for item in batch], content=batch[0]['content'])
+    attempts = max(item['attempts'] for item in batch)
+    try:
+        resp = (session or requests).post(webhook, json=payload, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException as e:
+        database.retry_outbox(ids, time.time() + _backoff(attempts), error=str(e), max_attempts=MAX_ATTEMPTS)
+        return False
+
+    if resp.status_code == 429:
+        wait = _retry_after(resp)
+        _block(webhook, wait, is_global=resp.headers.get('X-RateLimit-Global', '').lower() == 'true')
+        # A rate limit is not a failed attempt: the batch goes out as soon as the bucket refills
+        database.retry_outbox(ids, time.time() + wait, error="429 rate limited", count_attempt=False)
+        print(f"[Outbox] Rate limited on a webhook, retrying {len(ids)} message(s) in {wait:.1f}s")
+        return False
+    if resp.status_code >= 500:
+        database.retry_outbox(ids, time.time() + _backoff(attempts), error=f"HTTP {resp.status_code}",
+                              max_attempts=MAX_ATTEMPTS)
+        return False
+    if resp.status_code >= 400:
+        # Deleted webhook, invalid embed...: retrying cannot help
+        database.fail_outbox(ids, f"HTTP {resp.status_code}: {resp.text[:200]}")
+        print(f"[Outbox] Webhook rejected {len(ids)} message(s): HTTP {resp.status_code}")
+        return resp.status_code not in (401, 403, 404)
+
+    database.complete_outbox(ids)
+    wait = _bucket_wait(resp)
+    if wait:
+        _block(webhook, wait)
+        return False
+    return True
+
+
+def drain_webhook(webhook: str, gate: Callable[[], bool] = None):
+    """
+    Delivers the due messages of one webhook, batch after batch, until empty, rate limited or
+    the gate closes (this process stopped leading).
+    """
+    session = requests.Session()
+    try:
+        while _available_at(webhook) <= time.time() and (gate is None or gate()):
+            batch = database.claim_outbox_batch(webhook, limit=MAX_EMBEDS_PER_MESSAGE,
+                                                max_chars=MAX_EMBED_CHARS_PER_MESSAGE)
+            if not batch or not deliver_batch(webhook, batch, session=session):
+                break
+    except Exception as e:
+        print(f"[Outbox Error] Delivery failed: {e}")
+    finally:
+        session.close()
+        with _state_lock:
+            _busy.discard(webhook)
+        _wakeup.set() # Rate-limited webhooks are rescheduled by the dispatcher
+
+
+def _next_wakeup() -> float:
+    """Seconds until the earliest rate-limit wait ends, capped by the poll interval."""
+    now = time.time()
+    with _state_lock:
+        waits = [until - now for until in list(_blocked_until.values()) + [_global_until] if until > now]
+    return max(0.05, min(waits + [POLL_SECONDS]))
+
+
+def _dispatch(pool: ThreadPoolExecutor, gate: Callable[[], bool] = None):
+    database.recover_outbox(STALE_SENDING_SECONDS)
+    while True:
+        try:
+            now = time.time()
+            # One delivering process at a time keeps the rate-limit state in one place
+            due = database.get_due_webhooks(now) if gate is None or gate() else []
+            for webhook in due:
+                with _state_lock:
+                    if webhook in _busy or max(_global_until, _blocked_until.get(webhook, 0)) > now:
+                        continue
+                    _busy.add(webhook)
+                pool.submit(drain_webhook, webhook, gate)
+            with _state_lock:
+                for webhook in [w for w, until in _blocked_until.items() if until <= now]:
+                    del _blocked_until[webhook]
+        except Exception as e:
+            print(f"[Outbox Error] Dispatcher failed: {e}")
+        _wakeup.wait(timeout=_next_wakeup())
+        _wakeup.clear()
+
+
+def start(workers: int = OUTBOX_WORKERS, gate: Callable[[], bool] = None):
+    """Starts the dispatcher once per process; with a gate, it only delivers while it returns True."""
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="outbox")
+        threading.Thread(target=_dispatch, args=(pool, gate), name="outbox-dispatcher", daemon=True).start()
+        _started = True
+        print(f"Started Discord outbox dispatcher with {workers} delivery worker(s).")
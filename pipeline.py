@@ -0,0 +1,348 @@
+'''
+Event pipeline over the ad_events change log. Writers only touch the ads table (triggers
+append to the log); each stage tails the log from its own offset in its own thread and
+turns raw changes into "new ad" / "price drop" / "pépite" events.
+'''
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Callable, List, Dict, Any, Optional
+
+import database
+import enrichment
+import events
+import notifiers.discord_bot as disc_bot
+from notifiers import outbox
+from utils import run_blocking
+
+NEW_AD, PRICE_DROP, PEPITE = 'new_ad', 'price_drop', 'pepite'
+
+# Best pre-scored ads auto-analyzed per refresh to look for pépites (fits one packed request)
+AUTO_ANALYSIS_PER_REFRESH = 10
+
+POLL_SECONDS = 2       # Catches writes from other processes; same-process writers call notify()
+READ_BATCH = 500
+MAX_EVENT_ATTEMPTS = 5 # A failing event is retried on the next polls, then skipped
+
+
+@dataclass
+class AdEvent:
+    kind: str
+    user_id: int
+    search_name: str
+    ads: List[Dict[str, Any]] = field(default_factory=list)
+    last_seq: int = None # Log position once the event is handled
+
+
+def resolve_webhook(search_info: Dict[str, Any], user_id: int) -> str:
+    """Watch webhook > user webhook > global webhook."""
+    if search_info.get('discord_webhook'):
+        return search_info['discord_webhook']
+    user_data = database.get_user_by_id(user_id) or {}
+    return user_data.get('discord_webhook') or database.get_setting('discord_webhook')
+
+
+def quiet_until(search_info: Dict[str, Any], now: datetime = None) -> Optional[float]:
+    """
+    End of the watch's current quiet hours as epoch seconds, or None outside them.
+    quiet_start/quiet_end are local hours (0-23, end excluded) and may wrap past midnight.
+    """
+    start, end = search_info.get('quiet_start'), search_info.get('quiet_end')
+    if start is None or end is None or start == end:
+        return None
+    now = now or datetime.now()
+    inside = start <= now.hour < end if start < end else (now.hour >= start or now.hour < end)
+    if not inside:
+        return None
+    resume = now.replace(hour=end, minute=0, second=0, microsecond=0)
+    if resume <= now:
+        resume += timedelta(days=1)
+    return resume.timestamp()
+
+
+def _find_search(user_id: int, search_name: str) -> Dict[str, Any]:
+    return next((s for s in database.get_active_searches(user_id=user_id) if s['name'] == search_name), {})
+
+
+def to_ad_events(log_events: List[Dict[str, Any]], kinds: tuple = None) -> List[AdEvent]:
+    """
+    Turns change-log rows into pipeline events (of `kinds`, default all), grouping consecutive
+    rows with the same (kind, user, watch), so each event covers one stretch of the log.
+    insert -> new ad, price decrease -> price drop, analysis scoring 8+ -> pépite.
+    """
+    grouped: List[AdEvent] = []
+    for entry in log_events:
+        ad = entry.get('ad')
+        if not ad or ad.get('is_hidden'):
+            continue # Deleted or hidden since
+        kind = None
+        if entry['kind'] == database.AD_EVENT_INSERT:
+            kind = NEW_AD
+        elif entry['kind'] == database.AD_EVENT_PRICE:
+            old_price, new_price = _to_float(entry['old_value']), _to_float(entry['new_value'])
+            if old_price and new_price and new_price < old_price:
+                kind, ad = PRICE_DROP, {**ad, 'old_price': old_price}
+        elif entry['kind'] == database.AD_EVENT_ANALYSIS:
+            if (_to_float(entry['new_value']) or 0) >= 8:
+                kind = PEPITE
+        if kind is None or (kinds is not None and kind not in kinds):
+            continue
+        last = grouped[-1] if grouped else None
+        if not last or (last.kind, last.user_id, last.search_name) != (kind, entry['user_id'], ad.get('search_name')):
+            last = AdEvent(kind, entry['user_id'], ad.get('search_name'))
+            grouped.append(last)
+        last.ads.append(ad)
+        last.last_seq = entry['seq']
+    return grouped
+
+
+def _to_float(value):
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class Stage:
+    """A consumer thread tailing the change log from its own offset."""
+    name = "stage"
+    kinds: tuple = () # Pipeline event kinds handled by the stage
+    durable = True # False: tails from an in-memory position, per process, nothing replayed on restart
+
+    def __init__(self):
+        self.wakeup = threading.Event()
+        self._seq = None
+        self.gate: Callable[[], bool] = None # When set, the stage only consumes while it returns True
+        self.fence: Callable[[], Optional[tuple]] = None # Leader term the offset commits are fenced by
+        self._failures = (None, 0) # (last_seq of the failing event, attempts)
+
+    def handle(self, event: AdEvent):
+        raise NotImplementedError
+
+    def _db(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Database call made by the stage thread."""
+        return fn(*args, **kwargs)
+
+    def poll(self) -> int:
+        """
+        Processes the next batch of the log; returns the number of log rows read. The offset
+        moves after each event and the gate is checked before each one, so a leader that loses
+        its term mid-batch stops there and leaves the rest to the next leader. A failed event
+        keeps the offset before it and is retried from there on the next polls.
+        """
+        if not self.durable and self._seq is None:
+            self._seq = self._db(database.get_ad_events_head)
+        batch = self._db(database.read_ad_events, self.name, limit=READ_BATCH, after=None if self.durable else self._seq)
+        if batch['last_seq'] is None or (not self.durable and batch['last_seq'] == self._seq):
+            return 0
+        for event in to_ad_events(batch['events'], self.kinds):
+            if self.gate is not None and not self.gate():
+                return 0
+            try:
+                self.handle(event)
+            except Exception as e:
+                if not self._give_up(event, e):
+                    return 0 # Back off until the next poll
+            if not self._advance(event.last_seq):
+                return 0
+        return len(batch['events']) if self._advance(batch['last_seq']) else 0
+
+    def _give_up(self, event: AdEvent, error: Exception) -> bool:
+        """Counts a failed attempt; True once the event has failed MAX_EVENT_ATTEMPTS times."""
+        seq, attempts = self._failures
+        attempts = attempts + 1 if seq == event.last_seq else 1
+        self._failures = (event.last_seq, attempts)
+        print(f"[Pipeline Error] {self.name} failed on {event.kind} ({event.search_name}), "
+              f"attempt {attempts}/{MAX_EVENT_ATTEMPTS}: {error}")
+        if attempts < MAX_EVENT_ATTEMPTS:
+            return False
+        print(f"[Pipeline Error] {self.name} skips {len(event.ads)} ad(s) of {event.search_name} after {attempts} attempts.")
+        self._failures = (None, 0)
+        return True
+
+    def _advance(self, seq: int) -> bool:
+        """Moves the offset to seq; False when the fenced commit is refused (term over)."""
+        if not self.durable:
+            self._seq = seq
+            return True
+        fence = None
+        if self.fence is not None:
+            fence = self.fence()
+            if fence is None:
+                return False
+        return self._db(database.commit_consumer_offset, self.name, seq, fence=fence)
+
+    def _run(self):
+        while True:
+            try:
+                if (self.gate is None or self.gate()) and self.poll():
+                    continue
+            except Exception as e:
+                print(f"[Pipeline Error] {self.name} could not read the change log: {e}")
+            self.wakeup.wait(timeout=POLL_SECONDS)
+            self.wakeup.clear()
+
+    def start(self, gate: Callable[[], bool] = None, fence: Callable[[], Optional[tuple]] = None):
+        self.gate = gate
+        self.fence = fence
+        if not self.durable:
+            self._db(database.drop_consumer, self.name) # A stale offset would hold back log pruning
+        threading.Thread(target=self._run, name=f"pipeline-{self.name}", daemon=True).start()
+
+
+class AnalysisStage(Stage):
+    """Sends the best pre-scored unscored new ads of a watch to the AI job queue (pépite candidates)."""
+    name = "analysis"
+    kinds = (NEW_AD,)
+
+    def handle(self, event: AdEvent):
+        import ai_jobs
+        search = _find_search(event.user_id, event.search_name)
+        # Auto-analysis only serves Discord alerts of active watches
+        if not search or not resolve_webhook(search, event.user_id):
+            return
+        unscored = [{**ad, 'search_name': event.search_name} for ad in event.ads if not ad.get('ai_score')]
+        to_analyze = ai_jobs.gate_candidates(unscored, user_id=event.user_id)[:AUTO_ANALYSIS_PER_REFRESH]
+        if not to_analyze:
+            return
+        ctx = search.get('ai_context')
+        if not ctx or not ctx.strip():
+            ctx = database.get_setting('default_ai_context', f"Recherche de : {search.get('query_text', 'Produit')}")
+        ai_jobs.enqueue([ad['id'] for ad in to_analyze], user_id=event.user_id, priority=ai_jobs.PEPITE, custom_context=ctx)
+
+
+class NotificationStage(Stage):
+    """Queues pépite and price-drop alerts in the Discord outbox."""
+    name = "notification"
+    kinds = (PRICE_DROP, PEPITE)
+
+    def handle(self, event: AdEvent):
+        search = _find_search(event.user_id, event.search_name)
+        webhook = resolve_webhook(search, event.user_id)
+        if not webhook:
+            return
+        # Re-analyses and price flip-flops must not alert twice for the same ad and price
+        ads = database.unnotified(event.ads, event.kind, user_id=event.user_id)
+        if not ads:
+            return
+        # Pépites were enriched before their analysis; price drops may still lack details
+        ads = enrichment.enrich(ads, user_id=event.user_id)
+        not_before = quiet_until(search)
+
+        def build(fresh: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+            if event.kind == PRICE_DROP:
+                return outbox.items(webhook, [disc_bot.build_ad_embed(ad, price_drop=True) for ad in fresh],
+                                    user_id=event.user_id, not_before=not_before)
+            exceptional = [ad for ad in fresh if (ad.get('ai_score') or 0) >= 9]
+            regular = [ad for ad in fresh if (ad.get('ai_score') or 0) < 9]
+            return (outbox.items(webhook, [disc_bot.build_ad_embed(ad, is_pepite=True) for ad in exceptional],
+                                 content="🚨 **ALERTE PÉPITE EXCEPTIONNELLE !** @everyone", user_id=event.user_id,
+                                 not_before=not_before)
+                    + outbox.items(webhook, [disc_bot.build_ad_embed(ad, is_pepite=True) for ad in regular],
+                                   user_id=event.user_id, not_before=not_before))
+
+        # Ledger and outbox rows in one transaction; queued, not posted: the outbox packs them
+        # per webhook and paces them by Discord's limits
+        claimed = database.claim_notifications(ads, event.kind, user_id=event.user_id, build=build)
+        if claimed is None:
+            raise RuntimeError("notifications could not be queued") # Retried by the stage
+        if claimed:
+            outbox.notify()
+
+
+class DigestStage(Stage):
+    """Keeps each user's best pépites of the day as candidates for their daily digest."""
+    name = "digest"
+    kinds = (PEPITE,)
+
+    def handle(self, event: AdEvent):
+        database.add_digest_candidates(event.ads, user_id=event.user_id)
+
+
+class StatsStage(Stage):
+    """Keeps the per-watch and per-query market aggregates current."""
+    name = "stats"
+    kinds = (NEW_AD,)
+
+    def handle(self, event: AdEvent):
+        import analyzer
+        analyzer.record_market_prices(event.user_id, event.search_name, event.ads)
+
+
+class LiveStage(Stage):
+    """
+    Pushes ad events, refreshed watch counters and AI progress (ai_progress table, written by
+    the worker processes) to the user's open dashboards.
+    It runs in the web processes, where gunicorn's gevent workers make its thread a greenlet:
+    sqlite3 cannot yield to the hub, so its reads go to gevent's native thread pool and a
+    busy database never stalls the requests of the worker.
+    """
+    name = "live"
+    kinds = (NEW_AD, PRICE_DROP, PEPITE)
+    durable = False # Each web process serves its own dashboards, so each sees every event
+
+    def __init__(self):
+        super().__init__()
+        self._progress_seq = None
+
+    def _db(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        return run_blocking(fn, *args, **kwargs)
+
+    def poll(self) -> int:
+        return super().poll() + self._relay_ai_progress()
+
+    def _relay_ai_progress(self) -> int:
+        if self._progress_seq is None:
+            self._progress_seq = self._db(database.get_ai_progress_head)
+        rows = self._db(database.read_ai_progress, self._progress_seq, limit=READ_BATCH)
+        for row in rows:
+            if events.has_subscribers(row['user_id']):
+                events.publish(row['user_id'], row['kind'], row['payload'])
+        if rows:
+            self._progress_seq = rows[-1]['seq']
+        return len(rows)
+
+    def handle(self, event: AdEvent):
+        if not events.has_subscribers(event.user_id):
+            return
+        events.publish(event.user_id, event.kind, {
+            "search_name": event.search_name,
+            "count": len(event.ads),
+            "ads": [events.ad_brief(ad) for ad in event.ads[:20]]
+        })
+        if event.kind == NEW_AD:
+            events.publish(event.user_id, events.WATCH_STATS, self._db(database.get_global_watch_stats, user_id=event.user_id))
+
+
+_analysis = AnalysisStage()
+_notification = NotificationStage()
+_digest = DigestStage()
+_stats = StatsStage()
+_live = LiveStage()
+_stages = (_analysis, _notification, _digest, _stats, _live)
+# Live pushes reach the dashboards connected to the process running the stage: the web one
+WEB_STAGES = (_live.name,)
+WORKER_STAGES = tuple(stage.name for stage in _stages if stage.name not in WEB_STAGES)
+_started = set()
+_start_lock = threading.Lock()
+
+
+def notify():
+    """Wakes the stages up right after a write instead of waiting for the next poll."""
+    for stage in _stages:
+        stage.wakeup.set()
+
+
+def start(names: tuple = None, gate: Callable[[], bool] = None, fence: Callable[[], Optional[tuple]] = None):
+    """
+    Starts the stage threads (all, or the named ones) once per process. With a gate (leader
+    election), they only consume the log while it returns True: one consumer per offset.
+    With a fence (LeaderElector.fence), offsets only move during the current leader's term.
+    """
+    with _start_lock:
+        to_start = [stage for stage in _stages if (names is None or stage.name in names) and stage.name not in _started]
+        for stage in to_start:
+            stage.start(gate, fence)
+            _started.add(stage.name)
+    if to_start:
+        print(f"Started event pipeline ({', '.join(stage.name for stage in to_start)}) on the ad_events log.")
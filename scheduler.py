@@ -0,0 +1,186 @@
+'''
+Deadline-based refresh scheduler for auto-refresh watches.
+Watches wait in a heap ordered by due time (last run + interval). A dispatcher thread hands
+due watches to a bounded worker pool, giving each user with pending work a fair share of the
+workers, so one user's slow deep-search watches cannot hold back everyone else's refreshes.
+Lateness (start time minus due time) is recorded per watch as the scheduling debt. When `run`
+only hands the refresh over to a job queue, it returns when the refresh really started, and
+the queue itself orders the jobs fairly between users (database.claim_job).
+'''
+import os
+import math
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import Callable, Dict, Any, List, Tuple
+
+REFRESH_WORKERS = int(os.getenv("REFRESH_WORKERS", 3))
+IDLE_WAKEUP_SECONDS = 60 # Upper bound between two dispatcher passes
+
+WatchKey = Tuple[int, str] # (user_id, watch name)
+
+
+@dataclass
+class WatchStats:
+    runs: int = 0
+    failures: int = 0
+    last_lateness: float = 0.0 # Seconds between the due time and the start of the refresh
+    max_lateness: float = 0.0
+    total_lateness: float = 0.0
+    last_duration: float = 0.0
+
+
+class RefreshScheduler:
+    def __init__(self, run: Callable[[str, int, float], Any], workers: int = REFRESH_WORKERS,
+                 gate: Callable[[], bool] = None):
+        self._run = run # run(name, user_id, due), one refresh; may return its real start time
+        self._gate = gate # When set, watches are only dispatched while it returns True (leader)
+        self.workers = max(1, workers)
+        self._heap: List[Tuple[float, int, WatchKey]] = []
+        self._seq = itertools.count()
+        self._due: Dict[WatchKey, float] = {} # Current due time; heap entries with another one are stale
+        self._intervals: Dict[WatchKey, int] = {}
+        self._waiting: List[Tuple[float, WatchKey]] = [] # Due but held back by the worker or fair-share limit
+        self._running: Dict[WatchKey, float] = {} # -> dispatch time
+        self._user_running: Dict[int, int] = {}
+        self._last_served: Dict[int, float] = {}
+        self._stats: Dict[WatchKey, WatchStats] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="refresh")
+        self._started = False
+
+    def _schedule(self, key: WatchKey, due: float):
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, next(self._seq), key))
+
+    def sync(self, searches: List[Dict[str, Any]]):
+        """
+        Aligns the queue with the watches: auto-refresh watches are (re)scheduled from their
+        last run, others dropped. Running watches are rescheduled when they finish.
+        """
+        now = time.time()
+        with self._lock:
+            seen = set()
+            for s in searches:
+                if s.get('refresh_mode') != 'auto' or not s.get('is_active', 1):
+                    continue
+                key = (s.get('user_id', 1), s['name'])
+                seen.add(key)
+                interval = max(1, int(s.get('refresh_interval') or 60)) * 60
+                self._intervals[key] = interval
+                if key in self._running:
+                    continue
+                # Never run yet: due now, unless already queued
+                due = s['last_run_ts'] + interval if s.get('last_run_ts') else self._due.get(key, now)
+                if self._due.get(key) != due:
+                    self._schedule(key, due)
+            for key in [k for k in self._due if k not in seen]:
+                del self._due[key]
+                self._intervals.pop(key, None)
+        self._wakeup.set()
+
+    def _fair_share(self, ready: List[Tuple[float, WatchKey]]) -> int:
+        """Concurrent refreshes allowed per user: the workers split among users with work."""
+        users = {key[0] for _, key in ready} | {u for u, n in self._user_running.items() if n}
+        return max(1, math.ceil(self.workers / max(1, len(users))))
+
+    def _dispatch_due(self) -> float:
+        """Starts what can run now; returns the seconds until the next due watch."""
+        if self._gate is not None and not self._gate():
+            return IDLE_WAKEUP_SECONDS
+        now = time.time()
+        with self._lock:
+            ready = [(due, key) for due, key in self._waiting if self._due.get(key) == due]
+            while self._heap and self._heap[0][0] <= now:
+                due, _, key = heapq.heappop(self._heap)
+                if self._due.get(key) == due and key not in self._running and (due, key) not in ready:
+                    ready.append((due, key))
+            share = self._fair_share(ready)
+            self._waiting = []
+            while ready:
+                # Least busy user first, then the one served longest ago, then the earliest deadline
+                ready.sort(key=lambda item: (self._user_running.get(item[1][0], 0),
+                                             self._last_served.get(item[1][0], 0), item[0]))
+                due, key = ready.pop(0)
+                user_id = key[0]
+                if len(self._running) >= self.workers or self._user_running.get(user_id, 0) >= share:
+                    self._waiting.append((due, key))
+                    continue
+                self._running[key] = now
+                self._user_running[user_id] = self._user_running.get(user_id, 0) + 1
+                self._last_served[user_id] = now
+                self._pool.submit(self._run_one, key, due)
+            upcoming = [due for due, _, key in self._heap if self._due.get(key) == due]
+        return max(0.05, min(upcoming) - now) if upcoming else IDLE_WAKEUP_SECONDS
+
+    def _run_one(self, key: WatchKey, due: float):
+        user_id, name = key
+        started = real_start = time.time()
+        failed = False
+        try:
+            real_start = self._run(name, user_id, due) or started
+        except Exception as e:
+            failed = True
+            print(f"Error refreshing {name} (UID {user_id}): {e}")
+        finally:
+            finished = time.time()
+            with self._lock:
+                del self._running[key]
+                self._user_running[user_id] -= 1
+                stats = self._stats.setdefault(key, WatchStats())
+                stats.runs += 1
+                stats.failures += failed
+                stats.last_lateness = max(0.0, real_start - due)
+                stats.max_lateness = max(stats.max_lateness, stats.last_lateness)
+                stats.total_lateness += stats.last_lateness
+                stats.last_duration = finished - real_start
+                if key in self._intervals:
+                    self._schedule(key, finished + self._intervals[key])
+            self._wakeup.set()
+
+    def _loop(self):
+        while True:
+            try:
+                delay = self._dispatch_due()
+            except Exception as e:
+                print(f"[Scheduler Error] {e}")
+                delay = IDLE_WAKEUP_SECONDS
+            self._wakeup.wait(timeout=min(delay, IDLE_WAKEUP_SECONDS))
+            self._wakeup.clear()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._loop, name="refresh-scheduler", daemon=True).start()
+        print(f"Started refresh scheduler with {self.workers} worker(s).")
+
+    def stats(self, user_id: int = None) -> Dict[str, Any]:
+        """Queue state and per-watch lateness; debt_seconds sums how late the overdue watches are."""
+        now = time.time()
+        with self._lock:
+            watches = []
+            for key in set(self._due) | set(self._running) | set(self._stats):
+                if user_id is not None and key[0] != user_id:
+                    continue
+                stats = self._stats.get(key, WatchStats())
+                due = self._due.get(key)
+                watches.append({
+                    "user_id": key[0], "name": key[1], "running": key in self._running,
+                    "next_due_in": round(due - now, 1) if due is not None and key not in self._running else None,
+                    "overdue": round(max(0.0, now - due), 1) if due is not None and key not in self._running else 0.0,
+                    "avg_lateness": round(stats.total_lateness / stats.runs, 1) if stats.runs else 0.0,
+                    **{k: round(v, 1) if isinstance(v, float) else v for k, v in asdict(stats).items() if k != 'total_lateness'}
+                })
+            return {
+                "workers": self.workers,
+                "running": sum(1 for w in watches if w["running"]),
+                "waiting": sum(1 for w in watches if w["overdue"] > 0),
+                "debt_seconds": round(sum(w["overdue"] for w in watches), 1),
+                "watches": sorted(watches, key=lambda w: -w["overdue"])
+            }
@@ -1,8 +1,9 @@
-import requests
 from bs4 import BeautifulSoup
 from typing import List, Dict, Any
 import re
 
+import http_cache
+
 class BaseSearcher:
     def search(self, query: str, **kwargs) -> List[Dict[str, Any]]:
         raise NotImplementedError
@@ -14,7 +15,7 @@ class EbaySearcher(BaseSearcher):
         headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
         
         try:
-            response = requests.get(url, headers=headers, timeout=10)
+            response = http_cache.get(url, headers=headers, timeout=10)
             soup = BeautifulSoup(response.text, 'html.parser')
             items = []
             
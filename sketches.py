@@ -0,0 +1,101 @@
+'''
+Streaming quantile sketch (merging t-digest) used to keep market price percentiles
+up to date without rescanning the ads table.
+'''
+import math
+from typing import List, Dict, Any, Optional
+
+
+class TDigest:
+    """
+    Merging t-digest (Dunning). Keeps at most ~`compression` centroids whatever the number
+    of values added; tails are kept more precise than the middle (k1 scale function).
+    """
+    def __init__(self, compression: int = 100):
+        self.compression = compression
+        self.centroids: List[List[float]] = [] # [mean, weight], sorted by mean
+        self._buffer: List[List[float]] = []
+        self.count = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def add(self, value: float, weight: float = 1.0):
+        value = float(value)
+        self._buffer.append([value, weight])
+        self.count += weight
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self._buffer) >= self.compression * 5:
+            self._compress()
+
+    def merge(self, other: "TDigest"):
+        other._compress()
+        for mean, weight in other.centroids:
+            self._buffer.append([mean, weight])
+        self.count += other.count
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        self._compress()
+
+    def _k(self, q: float) -> float:
+        return self.compression / (2 * math.pi) * math.asin(2 * min(max(q, 0.0), 1.0) - 1)
+
+    def _q(self, k: float) -> float:
+        return (math.sin(min(max(k * 2 * math.pi / self.compression, -math.pi / 2), math.pi / 2)) + 1) / 2
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        items = sorted(self.centroids + self._buffer, key=lambda c: c[0])
+        self._buffer = []
+        total = sum(w for _, w in items)
+        merged, cumulative = [], 0.0
+        current = list(items[0])
+        q_limit = self._q(self._k(0.0) + 1)
+        for mean, weight in items[1:]:
+            if (cumulative + current[1] + weight) / total <= q_limit:
+                current[0] += (mean - current[0]) * weight / (current[1] + weight)
+                current[1] += weight
+            else:
+                cumulative += current[1]
+                merged.append(current)
+                q_limit = self._q(self._k(cumulative / total) + 1)
+                current = [mean, weight]
+        merged.append(current)
+        self.centroids = merged
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimated value at quantile q (0..1), interpolated between centroid centers."""
+        self._compress()
+        if not self.centroids:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+        target = q * self.count
+        first_mean, first_weight = self.centroids[0]
+        if target <= first_weight / 2:
+            return self.min + (first_mean - self.min) * target / (first_weight / 2)
+        cumulative = 0.0
+        for (mean, weight), (next_mean, next_weight) in zip(self.centroids, self.centroids[1:]):
+            center = cumulative + weight / 2
+            next_center = cumulative + weight + next_weight / 2
+            if target <= next_center:
+                return mean + (next_mean - mean) * (target - center) / (next_center - center)
+            cumulative += weight
+        last_mean, last_weight = self.centroids[-1]
+        remaining = self.count - target
+        return self.max - (self.max - last_mean) * remaining / (last_weight / 2) if remaining < last_weight / 2 else last_mean
+
+    def to_dict(self) -> Dict[str, Any]:
+        self._compress()
+        return {"c": self.compression, "n": self.count, "min": self.min, "max": self.max,
+                "centroids": [[round(m, 4), w] for m, w in self.centroids]}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "TDigest":
+        digest = cls(compression=data.get("c", 100))
+        digest.centroids = [list(c) for c in data.get("centroids", [])]
+        digest.count = data.get("n", sum(w for _, w in digest.centroids))
+        digest.min, digest.max = data.get("min"), data.get("max")
+        return digest
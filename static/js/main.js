@@ -54,25 +54,57 @@ async function init() {
         await loadHistory();
         initMap();
 
-        setInterval(checkForUpdates, 30000);
+        connectLiveEvents();
     } catch (e) {
         console.error("Metadata load error", e);
     }
 }
 
-async function checkForUpdates() {
-    if (!currentSearchName) return;
-    try {
-        const resp = await fetch(`/api/ads?search_name=${encodeURIComponent(currentSearchName)}`);
-        const ads = await resp.json();
-        if (ads.length > lastSeenCount) {
-            const diff = ads.length - lastSeenCount;
+/* --- Live updates (server push) --- */
+let liveEvents = null;
+let pendingNewAds = 0;
+
+function connectLiveEvents() {
+    if (liveEvents || typeof EventSource === 'undefined') return;
+    // EventSource reconnects on its own (server sends retry: 5000)
+    liveEvents = new EventSource('/api/events');
+
+    liveEvents.addEventListener('new_ad', e => {
+        const data = JSON.parse(e.data);
+        if (data.search_name === currentSearchName) {
+            pendingNewAds += data.count;
             const alert = document.getElementById('update-alert');
             const alertText = document.getElementById('update-alert-text');
-            if (alertText) alertText.innerText = `${diff} nouvelle(s) annonce(s) disponible(s) ! Cliquez pour rafraîchir.`;
+            if (alertText) alertText.innerText = `${pendingNewAds} nouvelle(s) annonce(s) disponible(s) ! Cliquez pour rafraîchir.`;
             if (alert) alert.style.display = 'block';
+        } else {
+            logSystem(`${data.count} nouvelle(s) annonce(s) dans "${data.search_name}".`, 'info');
         }
-    } catch (e) { }
+    });
+    liveEvents.addEventListener('price_drop', e => {
+        const data = JSON.parse(e.data);
+        const first = data.ads[0];
+        showNotify(data.count === 1 && first
+            ? `📉 Baisse de prix : ${first.title} (${first.price}€)`
+            : `📉 ${data.count} baisse(s) de prix dans "${data.search_name}".`);
+    });
+    liveEvents.addEventListener('pepite', e => {
+        const data = JSON.parse(e.data);
+        data.ads.forEach(ad => logSystem(`💎 Pépite (${ad.ai_score}/10) : ${ad.title}`, 'info'));
+    });
+    liveEvents.addEventListener('ai_status', e => renderAiStatus(JSON.parse(e.data)));
+    liveEvents.addEventListener('ai_job', e => {
+        const job = JSON.parse(e.data);
+        if (job.status === 'failed') logSystem(`Job IA #${job.id} en échec : ${job.message}`, 'error');
+    });
+    liveEvents.addEventListener('watch_stats', e => {
+        const stats = JSON.parse(e.data);
+        window.watchStats = stats;
+        const set = (id, v) => { const el = document.getElementById(id); if (el) el.innerText = v; };
+        set('stat-total-watches', stats.total_watches);
+        set('stat-total-ads', stats.total_ads);
+        set('stat-new-ads', stats.new_ads_total);
+    });
 }
 
 function switchTab(tabId) {
@@ -289,7 +321,7 @@ function renderAds(ads, gridId, rebuildCloud = true) {
                 <div class="ad-title">${ad.title}</div>
                 <div class="ad-price">${price}</div>
                 <div class="ad-meta">
-                    <span>📍 ${ad.location || 'France'}</span>
+                    <span>📍 ${ad.location || 'France'}${ad.distance_km != null ? ` · ${Math.round(ad.distance_km)} km` : ''}</span>
                     <span>🕒 ${dateStr}</span>
                 </div>
                 ${ad.ai_summary ? `<div class="ai-summary-box"><b>IA :</b> ${ad.ai_summary}</div>` : ''}
@@ -305,21 +337,57 @@ function renderAds(ads, gridId, rebuildCloud = true) {
     });
 }
 
-async function loadHistory(searchName = null) {
-    if (searchName === undefined) searchName = null;
-    currentSearchName = searchName;
-    const alert = document.getElementById('update-alert');
-    if (alert) alert.style.display = 'none';
+// Per-watch copy of the ad grid, kept current with /api/ads?since=<cursor> deltas
+const adsCache = {};
 
-    const url = searchName ? `/api/ads?search_name=${encodeURIComponent(searchName)}` : '/api/ads';
+function sortAdsByDate(ads) {
+    // Same order as the server: date_ts desc (undated last), then id desc
+    return ads.sort((a, b) => (b.date_ts ?? -Infinity) - (a.date_ts ?? -Infinity) || String(b.id).localeCompare(String(a.id)));
+}
+
+async function syncAds(searchName) {
+    const key = searchName || '';
+    const base = searchName ? `/api/ads?search_name=${encodeURIComponent(searchName)}` : '/api/ads';
+    const cached = adsCache[key];
+
+    if (cached) {
+        try {
+            const resp = await fetch(`${base}${searchName ? '&' : '?'}since=${cached.cursor}`);
+            const delta = await resp.json();
+            const byId = new Map(cached.ads.map(ad => [String(ad.id), ad]));
+            delta.removed.forEach(id => byId.delete(String(id)));
+            delta.changed.forEach(ad => byId.set(String(ad.id), ad));
+            // Deletions are not part of the change log: resync fully if the counts disagree
+            if (delta.total === null || byId.size === delta.total) {
+                cached.ads = sortAdsByDate(Array.from(byId.values()));
+                cached.cursor = delta.cursor;
+                return cached.ads.slice();
+            }
+        } catch (e) {
+            console.error("Delta sync error", e);
+        }
+        delete adsCache[key];
+    }
 
     // Show skeletons immediately
     renderAds([], 'ads-grid-history');
 
-    const resp = await fetch(url);
+    const resp = await fetch(base);
     const ads = await resp.json();
+    adsCache[key] = { ads: ads.slice(), cursor: parseInt(resp.headers.get('X-Ads-Cursor') || '0', 10) };
+    return ads;
+}
+
+async function loadHistory(searchName = null) {
+    if (searchName === undefined) searchName = null;
+    currentSearchName = searchName;
+    const alert = document.getElementById('update-alert');
+    if (alert) alert.style.display = 'none';
+
+    const ads = await syncAds(searchName);
     adsData = ads;
     lastSeenCount = ads.length;
+    pendingNewAds = 0;
     activeFilters.clear();
     renderAds(ads, 'ads-grid-history');
 
@@ -589,6 +657,7 @@ async function checkScam(adId) {
 function closeModal() {
     const modal = document.getElementById('compare-modal');
     if (modal) modal.classList.remove('show');
+    cancelAIStream('compare');
 }
 
 function toggleAdSelection(adId) {
@@ -758,22 +827,54 @@ function renderLocations() {
 }
 
 
+let mapLayer = null;
+let mapRequest = null;
+
 function initMap() {
     const el = document.getElementById('map');
     if (!el || map) return;
     map = L.map('map').setView([46.6, 1.8], 6);
     L.tileLayer('https://{s}.tile.osm.org/{z}/{x}/{y}.png').addTo(map);
+    mapLayer = L.layerGroup().addTo(map);
+    map.on('moveend', loadMapData);
+}
+
+// Pins and zoom-level clusters of the stored ads in view, aggregated server-side
+async function loadMapData() {
+    if (!map) return;
+    if (mapRequest) mapRequest.abort();
+    mapRequest = new AbortController();
+    const params = new URLSearchParams({ bbox: map.getBounds().toBBoxString(), zoom: map.getZoom() });
+    if (currentSearchName) params.set('search_name', currentSearchName);
+    try {
+        const resp = await fetch(`/api/map/clusters?${params}`, { signal: mapRequest.signal });
+        if (!resp.ok) return;
+        const data = await resp.json();
+        mapLayer.clearLayers();
+        data.clusters.forEach(c => {
+            const size = Math.min(28 + Math.log10(c.count) * 14, 64);
+            const icon = L.divIcon({
+                className: 'map-cluster',
+                html: `<div style="width:${size}px;height:${size}px;line-height:${size}px;border-radius:50%;background:rgba(99,102,241,0.85);color:#fff;text-align:center;font-weight:600">${c.count}</div>`,
+                iconSize: [size, size]
+            });
+            L.marker([c.lat, c.lng], { icon })
+                .on('click', () => map.setView([c.lat, c.lng], Math.min(map.getZoom() + 2, 18)))
+                .addTo(mapLayer);
+        });
+        data.pins.forEach(ad => {
+            L.marker([ad.lat, ad.lng]).addTo(mapLayer)
+                .bindPopup(`<b>${ad.title}</b><br>${ad.price != null ? ad.price + ' €<br>' : ''}<a href="${ad.url}" target="_blank">Voir</a>`);
+        });
+    } catch (e) {
+        if (e.name !== 'AbortError') console.error('Map load error', e);
+    }
 }
 
 function renderMap() {
     if (!map) initMap();
     if (!map) return;
-    map.eachLayer(l => { if (l instanceof L.Marker) map.removeLayer(l); });
-    adsData.forEach(ad => {
-        if (ad.lat && ad.lng) {
-            L.marker([ad.lat, ad.lng]).addTo(map).bindPopup(`<b>${ad.title}</b><br><a href="${ad.url}" target="_blank">Voir</a>`);
-        }
-    });
+    loadMapData();
 }
 
 async function runComparison() {
@@ -830,28 +931,29 @@ async function hideAd(adId) {
 }
 
 async function generateNegotiation(adId) {
-    showNotify("Génération du brouillon...");
+    const modal = document.getElementById('compare-modal');
+    const result = document.getElementById('compare-result');
+    if (modal) modal.classList.add('show');
+    if (!result) return;
+    result.innerHTML = `
+        <h3>🤝 Stratégie de Négociation</h3>
+        <div id="negotiation-draft" style="background:var(--bg); padding:1.5rem; border-radius:12px; font-family:serif; line-height:1.6; border:1px solid var(--border)">
+            <em>Génération du brouillon...</em>
+        </div>
+        <button id="btn-copy-negotiation" class="btn-primary" style="margin-top:20px; width:100%; display:none">📋 Copier le message</button>
+    `;
+    const box = document.getElementById('negotiation-draft');
     try {
-        const resp = await fetch('/api/negotiate', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ ad_id: adId })
-        });
-        const data = await resp.json();
-        const modal = document.getElementById('compare-modal');
-        const result = document.getElementById('compare-result');
-        if (modal) modal.classList.add('show');
-        if (result) {
-            result.innerHTML = `
-                <h3>🤝 Stratégie de Négociation</h3>
-                <div style="background:var(--bg); padding:1.5rem; border-radius:12px; font-family:serif; line-height:1.6; border:1px solid var(--border)">
-                    ${data.draft.replace(/\n/g, '<br>')}
-                </div>
-                <button class="btn-primary" style="margin-top:20px; width:100%" onclick="copyNegotiationToClipboard(\`${data.draft.replace(/`/g, '\\`').replace(/\$/g, '\\$')}\`)">📋 Copier le message</button>
-            `;
+        const draft = await streamAI('/api/negotiate/stream', { ad_id: adId }, text => {
+            box.innerHTML = text.replace(/\n/g, '<br>');
+        }, 'compare');
+        const btn = document.getElementById('btn-copy-negotiation');
+        if (btn && draft) {
+            btn.onclick = () => copyNegotiationToClipboard(draft);
+            btn.style.display = 'block';
         }
     } catch (e) {
-        showNotify("Erreur de génération.");
+        if (e.name !== 'AbortError') box.innerHTML = `❌ ${e.message || 'Erreur de génération.'}`;
     }
 }
 
@@ -985,8 +1087,17 @@ function runComparison() {
             </tr>
         </tbody>
     </table>`;
+    html += `<h3 style="margin-top:1.5rem">🤖 Avis de l'IA</h3><div id="compare-ai-verdict" class="markdown-body"><em>Comparaison en cours...</em></div>`;
 
     result.innerHTML = html;
+
+    const verdict = document.getElementById('compare-ai-verdict');
+    const ads = selectedAds.map(ad => ({ title: ad.title, price: ad.price, description: ad.description || ad.ai_summary || '' }));
+    streamAI('/api/compare/stream', { ads }, text => {
+        verdict.innerHTML = (typeof marked !== 'undefined') ? marked.parse(text) : text;
+    }, 'compare').catch(e => {
+        if (e.name !== 'AbortError') verdict.innerHTML = `❌ ${e.message || 'Comparaison indisponible.'}`;
+    });
 }
 
 
@@ -1004,17 +1115,20 @@ async function sendChatMessage() {
     if (!msg) return;
     appendMessage('user', msg);
     input.value = '';
-    const resp = await fetch('/api/chat', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ query: msg, search_name: currentSearchName })
-    });
-    const data = await resp.json();
-    appendMessage('ai', data.response);
+    const bubble = appendMessage('ai', '…');
+    const container = document.getElementById('ai-chat-messages');
+    try {
+        await streamAI('/api/chat/stream', { message: msg, search_name: currentSearchName }, text => {
+            bubble.innerHTML = (typeof marked !== 'undefined') ? marked.parse(text) : text;
+            container.scrollTop = container.scrollHeight;
+        }, 'chat');
+    } catch (e) {
+        if (e.name !== 'AbortError') bubble.innerHTML = `❌ ${e.message || 'Erreur de réponse.'}`;
+    }
 }
 
-/* --- AI Status Polling --- */
-let aiStatusInterval = null;
+/* --- AI Status (pushed through /api/events) --- */
+let aiRunning = false;
 
 function toggleEmbeddedStatus(forceOpen = null) {
     const panel = document.getElementById('ai-status-embedded');
@@ -1031,88 +1145,80 @@ let lastStatusLog = "";
 async function updateAiStatus() {
     try {
         const resp = await fetch('/api/ai-status');
-        const data = await resp.json();
+        renderAiStatus(await resp.json());
+    } catch (e) {
+        console.error("AI Status fetch error", e);
+    }
+}
 
-        // const title = document.getElementById('ai-status-title'); // Removed in bottom panel design
-        const log = document.getElementById('ai-status-log');
-        const logContainer = document.getElementById('ai-status-log-container');
-        const progressFill = document.getElementById('ai-status-progress');
-        const progressContainer = document.getElementById('ai-status-progress-container');
-        const badge = document.getElementById('ai-status-badge');
+function renderAiStatus(data) {
+    // const title = document.getElementById('ai-status-title'); // Removed in bottom panel design
+    const log = document.getElementById('ai-status-log');
+    const logContainer = document.getElementById('ai-status-log-container');
+    const progressFill = document.getElementById('ai-status-progress');
+    const progressContainer = document.getElementById('ai-status-progress-container');
+    const badge = document.getElementById('ai-status-badge');
 
-        // if (title) title.innerText = ... // Removed
+    // if (title) title.innerText = ... // Removed
 
-        if (log && data.message && data.message !== lastStatusLog) {
-            lastStatusLog = data.message;
-            // Simplified log for embedded view
-            log.innerHTML = `<div style="padding:2px 0">${data.message}</div>`;
+    if (log && data.message && data.message !== lastStatusLog) {
+        lastStatusLog = data.message;
+        // Simplified log for embedded view
+        log.innerHTML = `<div style="padding:2px 0">${data.message}</div>`;
 
-            // Also log to the full system console
-            logSystem(data.message, data.status === 'error' ? 'error' : 'info');
-        }
+        // Also log to the full system console
+        logSystem(data.message, data.status === 'error' ? 'error' : 'info');
+    }
 
-        // Auto-show if running and hidden (Persistence)
-        const panel = document.getElementById('ai-status-embedded');
-        if (data.status === 'loading' && panel && panel.style.display === 'none') {
-            panel.style.display = 'block';
-            if (!aiStatusInterval) aiStatusInterval = setInterval(updateAiStatus, 1000); // Resume polling if stopped
-        }
+    // Auto-show if running and hidden (Persistence)
+    const panel = document.getElementById('ai-status-embedded');
+    if (data.status === 'loading') {
+        aiRunning = true;
+        if (panel && panel.style.display === 'none') panel.style.display = 'block';
+    }
 
-        if (progressFill && data.total > 0) {
-            if (progressContainer) progressContainer.style.display = 'block';
-            const percent = (data.progress / data.total) * 100;
-            progressFill.style.width = percent + '%';
-        } else {
-            if (progressContainer) progressContainer.style.display = 'none';
-        }
+    if (progressFill && data.total > 0) {
+        if (progressContainer) progressContainer.style.display = 'block';
+        const percent = (data.progress / data.total) * 100;
+        progressFill.style.width = percent + '%';
+    } else {
+        if (progressContainer) progressContainer.style.display = 'none';
+    }
 
-        if (badge) {
-            badge.className = 'status-badge ' + (data.status === 'waiting' ? 'badge-waiting' : (data.status === 'error' ? 'badge-error' : (data.status === 'idle' ? 'badge-success' : 'badge-loading')));
-            badge.innerText = data.status === 'waiting' ? 'PAUSE' : (data.status === 'error' ? 'ERREUR' : (data.status === 'idle' ? 'FINI' : 'TRAVAIL'));
-        }
+    const quotaEl = document.getElementById('ai-status-quota');
+    if (quotaEl) {
+        const q = data.quota;
+        quotaEl.innerText = q
+            ? `Quota ${q.model} : ${q.rpm_remaining}/${q.rpm_limit} req/min · ${q.daily_remaining}/${q.daily_limit} req/jour`
+            : '';
+    }
 
-        if (data.status === 'idle' && aiStatusInterval) {
-            // Keep it open, but stop polling once it's idle
-            clearInterval(aiStatusInterval);
-            aiStatusInterval = null;
-            showNotify("✅ L'IA a terminé d'analyser vos annonces.");
-            if (currentSearchName) loadHistory(currentSearchName);
-        }
-    } catch (e) {
-        console.error("AI Status poll error", e);
+    if (badge) {
+        badge.className = 'status-badge ' + (data.status === 'waiting' ? 'badge-waiting' : (data.status === 'error' ? 'badge-error' : (data.status === 'idle' ? 'badge-success' : 'badge-loading')));
+        badge.innerText = data.status === 'waiting' ? 'PAUSE' : (data.status === 'error' ? 'ERREUR' : (data.status === 'idle' ? 'FINI' : 'TRAVAIL'));
     }
-}
 
+    if (data.status === 'idle' && aiRunning) {
+        // Keep the panel open, just reload the freshly scored ads
+        aiRunning = false;
+        showNotify("✅ L'IA a terminé d'analyser vos annonces.");
+        if (currentSearchName) loadHistory(currentSearchName);
+    }
+}
 
-function startAiStatusPolling() {
-    if (aiStatusInterval) clearInterval(aiStatusInterval);
 
+function startAiStatusTracking() {
     // Reset Log
     const log = document.getElementById('ai-status-log');
     if (log) log.innerHTML = '';
     lastStatusLog = "";
 
-    // Open Panel
+    // Open Panel; progress then arrives through /api/events
     toggleEmbeddedStatus(true);
-
-    aiStatusInterval = setInterval(updateAiStatus, 1000);
+    aiRunning = true;
     updateAiStatus(); // Run once
 }
 
-// Check status on load
-document.addEventListener('DOMContentLoaded', () => {
-    // Initial check if AI is running (persistence)
-    updateAiStatus().then(() => {
-        // If updateAiStatus detected running state, it would have started polling? 
-        // Actually updateAiStatus doesn't start polling. Let's do it here.
-        fetch('/api/ai-status').then(r => r.json()).then(d => {
-            if (d.status === 'loading') {
-                startAiStatusPolling();
-            }
-        });
-    });
-});
-
 async function stopAiAnalysis() {
     // Direct stop without confirmation as requested
     // if (!confirm("Voulez-vous vraiment arrêter l'analyse en cours ?")) return;
@@ -1232,6 +1338,65 @@ function appendMessage(role, text) {
     div.innerHTML = (typeof marked !== 'undefined') ? marked.parse(text) : text;
     container.appendChild(div);
     container.scrollTop = container.scrollHeight;
+    return div;
+}
+
+/* --- AI Streaming (SSE over fetch) --- */
+const aiStreams = {};
+
+// POSTs `body` to a /stream endpoint and calls onText(fullText) as chunks arrive.
+// Starting a new stream on the same channel aborts the previous one, which closes
+// the connection and stops the generation server-side.
+async function streamAI(url, body, onText, channel = 'default') {
+    if (aiStreams[channel]) aiStreams[channel].abort();
+    const controller = new AbortController();
+    aiStreams[channel] = controller;
+
+    try {
+        const resp = await fetch(url, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(body),
+            signal: controller.signal
+        });
+        if (!resp.ok || !resp.body) {
+            const data = await resp.json().catch(() => ({}));
+            throw new Error(data.error || `Erreur ${resp.status}`);
+        }
+
+        const reader = resp.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '', text = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let sep;
+            while ((sep = buffer.indexOf('\n\n')) !== -1) {
+                const raw = buffer.slice(0, sep);
+                buffer = buffer.slice(sep + 2);
+                let event = 'message', data = '';
+                raw.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) event = line.slice(6).trim();
+                    else if (line.startsWith('data:')) data += line.slice(5).trim();
+                });
+                const payload = data ? JSON.parse(data) : {};
+                if (event === 'error') throw new Error(payload.error);
+                if (event === 'done') return text;
+                if (payload.text) {
+                    text += payload.text;
+                    onText(text);
+                }
+            }
+        }
+        return text;
+    } finally {
+        if (aiStreams[channel] === controller) delete aiStreams[channel];
+    }
+}
+
+function cancelAIStream(channel) {
+    if (aiStreams[channel]) aiStreams[channel].abort();
 }
 
 function openHelpModal() {
@@ -1274,20 +1439,30 @@ function runDashboardSort() {
     const sort = document.getElementById('dashboard-sort').value;
     if (sort === 'price-asc') adsData.sort((a, b) => (a.price || 0) - (b.price || 0));
     else if (sort === 'score-desc') adsData.sort((a, b) => (b.ai_score || 0) - (a.ai_score || 0));
-    else if (sort === 'date-desc') adsData.sort((a, b) => new Date(b.date || 0) - new Date(a.date || 0));
+    else if (sort === 'date-desc') adsData.sort((a, b) => (b.date_ts || 0) - (a.date_ts || 0));
+    else if (sort === 'distance-asc') {
+        if (!adsData.some(a => a.distance_km != null)) showNotify("📍 Renseignez votre ville dans les paramètres.");
+        adsData.sort((a, b) => (a.distance_km ?? Infinity) - (b.distance_km ?? Infinity));
+    }
     renderAds(adsData, 'ads-grid-history');
 }
 
 function openGemBuilder() { document.getElementById('gem-builder-modal').classList.add('show'); }
-function closeGemModal() { document.getElementById('gem-builder-modal').classList.remove('show'); }
+function closeGemModal() { document.getElementById('gem-builder-modal').classList.remove('show'); cancelAIStream('gem'); }
 async function buildGem() {
     const goal = document.getElementById('gem-goal').value;
-    const resp = await fetch('/api/gem-builder', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ goal }) });
-    const data = await resp.json();
     const preview = document.getElementById('gem-preview');
-    if (preview) { preview.innerText = data.instructions; preview.style.display = 'block'; }
-    const btn = document.getElementById('btn-use-gem');
-    if (btn) btn.style.display = 'block';
+    if (!preview) return;
+    preview.style.display = 'block';
+    preview.innerText = '…';
+    try {
+        const instructions = await streamAI('/api/gem-builder/stream', { goal }, text => { preview.innerText = text; }, 'gem');
+        preview.innerText = instructions.trim();
+        const btn = document.getElementById('btn-use-gem');
+        if (btn) btn.style.display = 'block';
+    } catch (e) {
+        if (e.name !== 'AbortError') preview.innerText = `❌ ${e.message || 'Erreur.'}`;
+    }
 }
 function useGem() { document.getElementById('ai-context').value = document.getElementById('gem-preview').innerText; closeGemModal(); }
 
@@ -1295,7 +1470,7 @@ async function runBatchAnalysis() {
     const loader = document.getElementById('global-loader');
     if (loader) loader.style.display = 'block';
 
-    startAiStatusPolling();
+    startAiStatusTracking();
 
     // Prepare payload
     let payload = {};
@@ -1332,7 +1507,7 @@ async function runSelectiveAnalysis() {
     showNotify(`Lancement de l'analyse sur ${selectedAds.length} annonce(s)...`);
     const adIds = selectedAds.map(ad => ad.id);
 
-    startAiStatusPolling();
+    startAiStatusTracking();
 
     try {
         const resp = await fetch('/api/analyze', {
@@ -1359,6 +1534,8 @@ async function openGlobalSettings() {
 
         document.getElementById('global-google-api-key').value = s.google_api_key || '';
         document.getElementById('global-discord-webhook').value = s.discord_webhook || '';
+        document.getElementById('global-home-city').value = s.home_city || '';
+        document.getElementById('global-digest-hour').value = s.digest_hour ?? '';
         document.getElementById('global-default-ai-context').value = s.default_ai_context || '';
         document.getElementById('global-default-refresh-mode').value = s.default_refresh_mode || 'manual';
         document.getElementById('global-default-refresh-interval').value = s.default_refresh_interval || 60;
@@ -1382,6 +1559,8 @@ async function saveGlobalSettings() {
     const payload = {
         google_api_key: document.getElementById('global-google-api-key').value,
         discord_webhook: document.getElementById('global-discord-webhook').value,
+        home_city: document.getElementById('global-home-city').value,
+        digest_hour: document.getElementById('global-digest-hour').value,
         default_ai_context: document.getElementById('global-default-ai-context').value,
         default_refresh_mode: document.getElementById('global-default-refresh-mode').value,
         default_refresh_interval: parseInt(document.getElementById('global-default-refresh-interval').value) || 60,
@@ -1401,8 +1580,12 @@ async function saveGlobalSettings() {
         if (resp.ok) {
             showNotify("Configuration globale enregistrée !");
             closeGlobalSettings();
+            // Distances depend on the home point
+            Object.keys(adsCache).forEach(k => delete adsCache[k]);
+            loadHistory(currentSearchName);
         } else {
-            showNotify("Erreur lors de l'enregistrement.");
+            const err = await resp.json().catch(() => ({}));
+            showNotify(err.message || "Erreur lors de l'enregistrement.");
         }
     } catch (e) {
         showNotify("Erreur technique.");
@@ -1465,6 +1648,8 @@ async function openSearchSettings(name) {
     document.getElementById('settings-refresh-mode').value = s.refresh_mode || 'manual';
     document.getElementById('settings-refresh-interval').value = s.refresh_interval || 60;
     document.getElementById('settings-deep-search').checked = !!s.deep_search;
+    document.getElementById('settings-quiet-start').value = s.quiet_start ?? '';
+    document.getElementById('settings-quiet-end').value = s.quiet_end ?? '';
 
 
     const platforms = robustParseJSON(s.platforms, { lbc: true, ebay: false, vinted: false });
@@ -1488,7 +1673,9 @@ async function saveSearchSettings() {
             ebay: document.getElementById('settings-platform-ebay').checked,
             vinted: document.getElementById('settings-platform-vinted').checked
         },
-        deep_search: document.getElementById('settings-deep-search').checked ? 1 : 0
+        deep_search: document.getElementById('settings-deep-search').checked ? 1 : 0,
+        quiet_start: document.getElementById('settings-quiet-start').value,
+        quiet_end: document.getElementById('settings-quiet-end').value
     };
 
 
@@ -1570,15 +1757,17 @@ function copyToClipboard() {
 }
 
 async function submitManualAd() {
-    const url = document.getElementById('manual-ad-url').value.trim();
-    if (!url) return showNotify("Veuillez entrer une URL.");
+    const text = document.getElementById('manual-ad-url').value.trim();
+    if (!text) return showNotify("Veuillez entrer une URL.");
+    const urls = text.split(/\s+/).filter(u => u.startsWith('http'));
+    if (urls.length > 1) return importManualAds(text);
 
     showNotify("⏳ Ajout de l'annonce en cours...");
     try {
         const resp = await fetch('/api/ads/manual', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ url, search_name: currentSearchName || 'Ajout Manuel' })
+            body: JSON.stringify({ url: urls[0] || text, search_name: currentSearchName || 'Ajout Manuel' })
         });
         const data = await resp.json();
         if (resp.ok) {
@@ -1594,6 +1783,51 @@ async function submitManualAd() {
     }
 }
 
+// Bulk import: the server streams one NDJSON line per URL, then the write outcome and a summary
+async function importManualAds(text) {
+    const progress = document.getElementById('manual-ad-progress');
+    const setProgress = msg => { if (progress) { progress.style.display = 'block'; progress.innerText = msg; } };
+    let fetched = 0, failed = 0, total = text.split(/\s+/).filter(u => u.startsWith('http')).length;
+    setProgress(`⏳ 0 / ${total} annonces récupérées...`);
+    try {
+        const resp = await fetch('/api/ads/import', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ text, search_name: currentSearchName || 'Ajout Manuel' })
+        });
+        if (!resp.ok) {
+            const data = await resp.json().catch(() => ({}));
+            return setProgress("❌ " + (data.error || "Erreur lors de l'import."));
+        }
+        const reader = resp.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            for (const line of lines) {
+                if (!line.trim()) continue;
+                const msg = JSON.parse(line);
+                if (msg.type === 'fetched') {
+                    fetched++;
+                    if (msg.status !== 'parsed') failed++;
+                    setProgress(`⏳ ${fetched} / ${total} annonces récupérées${failed ? ` (${failed} en échec)` : ''}...`);
+                } else if (msg.type === 'summary') {
+                    total = msg.total;
+                    setProgress(`✅ ${msg.new} ajoutée(s), ${msg.changed} mise(s) à jour, ${msg.unchanged} inchangée(s), ${msg.failed} en échec.`);
+                }
+            }
+        }
+        document.getElementById('manual-ad-url').value = '';
+        await loadHistory(currentSearchName);
+    } catch (e) {
+        setProgress("❌ Erreur technique de connexion.");
+    }
+}
+
 async function shareToDiscord(adId) {
 
     try {
@@ -0,0 +1,31 @@
+import os
+import sys
+import tempfile
+
+# database initializes its file at import: point it at a scratch one before any test imports it
+os.environ.setdefault('DB_PATH', os.path.join(tempfile.mkdtemp(), 'test.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import database
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh database per test."""
+    monkeypatch.setattr(database, 'DB_FILE', str(tmp_path / 'test.db'))
+    database.initialize_db()
+    return database
+
+
+@pytest.fixture
+def client(db):
+    """Flask test client logged in as a fresh user; its id is client.user_id."""
+    import app
+    app.app.config['TESTING'] = True
+    user_id = db.create_user('tester', 'secret')
+    test_client = app.app.test_client()
+    assert test_client.post('/login', json={"username": "tester", "password": "secret"}).status_code == 200
+    test_client.user_id = user_id
+    return test_client
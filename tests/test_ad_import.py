@@ -0,0 +1,38 @@
+import json
+
+import ad_import
+
+ERROR = "'urls' doit être une liste de chaînes et 'text' une chaîne."
+
+
+def _fake_fetch(urls, search_name):
+    for url in urls:
+        ad_id = ad_import.extract_ad_id(url)
+        yield {"url": url, "id": ad_id, "status": "parsed",
+               "ad": {"id": ad_id, "title": f"annonce {ad_id}", "price": 10, "search_name": search_name,
+                      "date": "2026-10-19T10:00:00", "url": url}}
+
+
+def _lines(response):
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_invalid_payloads_are_rejected(client):
+    for payload in ({"urls": {"a": 1}}, {"urls": ["https://www.leboncoin.fr/ad/velos/1.htm", 3]},
+                    {"text": ["https://www.leboncoin.fr/ad/velos/1.htm"]}, {"urls": 12}):
+        response = client.post('/api/ads/import', json=payload)
+        assert response.status_code == 400
+        assert response.get_json()["error"] == ERROR
+
+
+def test_no_valid_url_is_rejected(client):
+    response = client.post('/api/ads/import', json={"text": "rien à importer"})
+    assert response.status_code == 400
+
+
+def test_string_urls_are_read_like_pasted_text(client, monkeypatch):
+    monkeypatch.setattr(ad_import, 'fetch_ads', _fake_fetch)
+    pasted = "https://www.leboncoin.fr/ad/velos/1.htm https://www.leboncoin.fr/ad/velos/2.htm"
+    lines = _lines(client.post('/api/ads/import', json={"urls": pasted}))
+    assert [line["id"] for line in lines if line["type"] == "fetched"] == ['1', '2']
+    assert lines[-1] == {"type": "summary", "total": 2, "new": 2, "changed": 0, "unchanged": 0, "failed": 0}
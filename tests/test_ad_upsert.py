@@ -0,0 +1,42 @@
+import sqlite3
+
+import ad_import
+
+
+def _scraped(price=100, **extra):
+    return {"id": "42", "title": "Vélo", "price": price, "search_name": "velo", "location": "Lyon",
+            "date": "2026-10-19T10:00:00", "url": "https://www.leboncoin.fr/ad/velo/42", **extra}
+
+
+def _events(db):
+    with sqlite3.connect(db.DB_FILE) as conn:
+        return [row[0] for row in conn.execute('SELECT kind FROM ad_events ORDER BY seq')]
+
+
+def test_unchanged_ads_are_skipped(db):
+    report = db.add_ads_bulk([_scraped(), _scraped(price=80, id="43")], user_id=1)
+    assert (report["new"], report["unchanged"]) == (2, 0)
+    events = len(_events(db))
+
+    report = db.add_ads_bulk([_scraped(), _scraped(price=70, id="43")], user_id=1)
+    assert (report["unchanged"], report["changed"]) == (1, 1)
+    assert report["outcomes"][1][2] is True # Price drop
+    assert len(_events(db)) == events + 1 # No write, so no log row, for the unchanged ad
+
+
+def test_enriched_details_survive_a_plain_refresh(db):
+    db.add_ad(_scraped(description="Très bon état", lat=45.76, lng=4.83), user_id=1)
+    report = db.add_ads_bulk([_scraped()], user_id=1) # Search results carry no details
+    assert report["unchanged"] == 1
+    assert db.get_ads_by_ids(["42"], user_id=1)[0]["description"] == "Très bon état"
+
+
+def test_manual_reimport_is_unchanged(db):
+    parsed = ad_import.parse_ad_page('')
+    url = "https://www.leboncoin.fr/ad/velo/77"
+    first = ad_import.build_manual_ad(url, "77", "velo", parsed)
+    assert db.add_ads_bulk([first], user_id=1)["new"] == 1
+
+    again = {**ad_import.build_manual_ad(url, "77", "velo", parsed), "date": "2030-01-01T00:00:00"}
+    assert db.add_ads_bulk([again], user_id=1)["unchanged"] == 1
+    assert db.get_ads_by_ids(["77"], user_id=1)[0]["date"] == first["date"]
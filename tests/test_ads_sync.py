@@ -0,0 +1,39 @@
+def _ad(i, price=100, search_name="velo"):
+    return {"id": str(i), "title": f"vélo {i}", "price": price, "search_name": search_name,
+            "date": "2026-10-19T10:00:00", "url": f"https://example.com/{i}"}
+
+
+def test_etag_answers_304_until_ads_change(client, db):
+    db.add_ads_bulk([_ad(1), _ad(2)], user_id=client.user_id)
+    first = client.get('/api/ads')
+    assert first.status_code == 200 and len(first.get_json()) == 2
+    etag = first.headers['ETag']
+
+    assert client.get('/api/ads', headers={"If-None-Match": etag}).status_code == 304
+    db.add_ad(_ad(2, price=90), user_id=client.user_id)
+    again = client.get('/api/ads', headers={"If-None-Match": etag})
+    assert again.status_code == 200 and again.headers['ETag'] != etag
+
+
+def test_since_returns_only_the_delta(client, db):
+    db.add_ads_bulk([_ad(1), _ad(2), _ad(3)], user_id=client.user_id)
+    cursor = int(client.get('/api/ads').headers['X-Ads-Cursor'])
+
+    empty = client.get(f'/api/ads?since={cursor}').get_json()
+    assert (empty["changed"], empty["removed"], empty["total"]) == ([], [], 3)
+
+    db.add_ad(_ad(2, price=80), user_id=client.user_id)
+    db.hide_ad('3', user_id=client.user_id)
+    db.add_ad(_ad(4), user_id=client.user_id)
+    delta = client.get(f'/api/ads?since={cursor}').get_json()
+    assert sorted(ad["id"] for ad in delta["changed"]) == ['2', '4']
+    assert delta["removed"] == ['3']
+    assert delta["total"] == 3 and delta["cursor"] > cursor
+
+
+def test_since_of_a_watch_removes_moved_ads(client, db):
+    db.add_ads_bulk([_ad(1), _ad(2)], user_id=client.user_id)
+    cursor = int(client.get('/api/ads?search_name=velo').headers['X-Ads-Cursor'])
+    db.move_ads_to_search(['1'], 'casque', user_id=client.user_id)
+    delta = client.get(f'/api/ads?search_name=velo&since={cursor}').get_json()
+    assert (delta["changed"], delta["removed"], delta["total"]) == ([], ['1'], 1)
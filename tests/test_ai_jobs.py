@@ -0,0 +1,40 @@
+import time
+
+import ai_jobs
+import analyzer
+import enrichment
+
+
+def _reclaimed_job(db):
+    """An AI job claimed by worker a, whose lease expired and was taken over by worker b."""
+    job_id = db.enqueue_ai_job(['1', '2'], user_id=1)
+    stale = db.claim_next_ai_job('worker-a', lease_seconds=0)
+    time.sleep(0.01)
+    current = db.claim_next_ai_job('worker-b', lease_seconds=60)
+    assert stale['id'] == current['id'] == job_id
+    return stale, current
+
+
+def test_update_rejected_after_lease_lost(db):
+    stale, current = _reclaimed_job(db)
+    assert db.update_ai_job(stale['id'], worker_id='worker-a', status='done', done_ids=['1', '2']) is False
+    assert db.update_ai_job(current['id'], worker_id='worker-b', progress=1, done_ids=['1']) is True
+    job = db.get_ai_job(current['id'])
+    assert (job['status'], job['done_ids'], job['progress']) == ('running', ['1'], 1)
+
+
+def test_stale_worker_stops_its_slice(db, monkeypatch):
+    stale, current = _reclaimed_job(db)
+    sent = []
+    ads = [{"id": '1', "search_name": "velo"}, {"id": '2', "search_name": "velo"}]
+    monkeypatch.setattr(db, 'get_ads_by_ids', lambda ids, user_id=1: ads)
+    monkeypatch.setattr(enrichment, 'needs_details', lambda ad: False)
+    monkeypatch.setattr(analyzer, 'generate_batch_summaries', lambda batch, **kwargs: sent.append(batch) or [])
+
+    ai_jobs.run_job_slice(stale)
+    assert sent == [] # Not sent to the LLM a second time
+    assert db.get_ai_job(current['id'])['status'] == 'running'
+
+    ai_jobs.run_job_slice(current)
+    assert len(sent) == 1
+    assert db.get_ai_job(current['id'])['status'] == 'done'
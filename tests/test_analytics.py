@@ -0,0 +1,25 @@
+import analytics
+
+
+def _ad(i, search_name="velo", price=100):
+    return {"id": str(i), "title": f"vélo {i}", "price": price, "search_name": search_name,
+            "date": "2026-10-19T10:00:00", "url": f"https://example.com/{i}"}
+
+
+def _total(cache, user_id=1):
+    with cache.reading(user_id) as cols:
+        return cols.summary()["total_ads"]
+
+
+def test_deletes_reach_the_cache_through_the_change_log(db):
+    for i in range(3):
+        db.add_ad(_ad(i), user_id=1)
+    db.add_ad(_ad(9, search_name="casque"), user_id=1)
+    cache = analytics.AnalyticsCache()
+    assert _total(cache) == 4
+
+    db.hide_ad('0', user_id=1)
+    db.delete_search('velo', user_id=1)
+    db.add_ad(_ad(10, search_name="casque", price=50), user_id=1)
+    with cache.reading(1) as cols:
+        assert cols.summary() == {"total_ads": 2, "avg_price": 75.0, "pending_ai": 2}
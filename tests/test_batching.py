@@ -0,0 +1,64 @@
+import json
+from types import SimpleNamespace
+
+import analyzer
+
+
+def _payload(i, description=""):
+    return {"id": str(i), "titre": f"annonce {i}", "description": description}
+
+
+def test_pack_batches_respects_the_input_budget():
+    payloads = [_payload(i, "x" * 400) for i in range(10)]
+    cost = analyzer.estimate_tokens(json.dumps(payloads[0], ensure_ascii=False))
+    batches = analyzer.pack_batches(payloads, base_tokens=100, budget=100 + 3 * cost, max_ads=25)
+    assert [len(b) for b in batches] == [3, 3, 3, 1]
+    assert [p["id"] for b in batches for p in b] == [str(i) for i in range(10)]
+
+
+def test_pack_batches_caps_ads_and_keeps_oversized_ads():
+    assert [len(b) for b in analyzer.pack_batches([_payload(i) for i in range(7)], 0, budget=10**6, max_ads=3)] == [3, 3, 1]
+    huge = [_payload(0, "x" * 10000), _payload(1)]
+    assert [len(b) for b in analyzer.pack_batches(huge, 0, budget=50)] == [1, 1]
+
+
+def _answer(batch, skip=()):
+    return json.dumps([{"id": p["id"], "ai_summary": "ok", "ai_score": 7, "ai_tips": ""} for p in batch if p["id"] not in skip])
+
+
+def _fake_model(monkeypatch, answer):
+    """Replaces the Gemini call: answer(ids) gives the response text; returns the calls made."""
+    calls = []
+
+    def generate(prompt, api_key=None, output_tokens=0):
+        batch = json.loads(prompt[prompt.index("Données :") + len("Données :"):])
+        calls.append(([p["id"] for p in batch], output_tokens))
+        return SimpleNamespace(text=answer(batch), usage_metadata=None)
+
+    monkeypatch.setattr(analyzer, 'safe_generate_content', generate)
+    return calls
+
+
+def test_malformed_answer_is_bisected(monkeypatch):
+    calls = _fake_model(monkeypatch, lambda batch: "pas du JSON" if len(batch) > 2 else _answer(batch))
+    report = {"requests": 0, "splits": 0, "failed": 0, "prompt_tokens": 0, "output_tokens": 0}
+    summaries = analyzer._summarize_batch([_payload(i) for i in range(4)], None, None, report)
+    assert sorted(s["id"] for s in summaries) == ['0', '1', '2', '3']
+    assert [ids for ids, _ in calls] == [['0', '1', '2', '3'], ['0', '1'], ['2', '3']]
+    assert (report["requests"], report["splits"], report["failed"]) == (3, 1, 0)
+
+
+def test_missing_ads_are_retried_once(monkeypatch):
+    calls = _fake_model(monkeypatch, lambda batch: _answer(batch, skip={'2'}))
+    report = {"requests": 0, "splits": 0, "failed": 0, "prompt_tokens": 0, "output_tokens": 0}
+    summaries = analyzer._summarize_batch([_payload(i) for i in range(3)], None, None, report)
+    assert sorted(s["id"] for s in summaries) == ['0', '1']
+    assert [ids for ids, _ in calls] == [['0', '1', '2'], ['2']]
+    assert report["failed"] == 1
+
+
+def test_output_tokens_reserved_per_ad(monkeypatch):
+    calls = _fake_model(monkeypatch, _answer)
+    summaries = analyzer.generate_batch_summaries([{"id": str(i), "title": "t"} for i in range(3)], user_id=None)
+    assert len(summaries) == 3
+    assert calls == [(['0', '1', '2'], 3 * analyzer.OUTPUT_TOKENS_PER_AD)]
@@ -0,0 +1,49 @@
+from datetime import datetime
+
+import digest
+
+NOW = datetime(2026, 10, 19, 9, 0)
+DAY = NOW.date().isoformat()
+WEBHOOK = "https://discord.example/api/webhooks/1/x"
+
+
+def _user(db):
+    user_id = db.create_user('digest', 'secret')
+    db.update_user_settings(user_id, {'discord_webhook': WEBHOOK, 'digest_hour': 8})
+    ad = {"id": "1", "title": "vélo", "price": 100, "search_name": "velo", "url": "https://example.com/1",
+          "ai_score": 9, "ai_summary": "Très bon état"}
+    db.add_ad(ad, user_id=user_id)
+    db.add_digest_candidates([ad], user_id=user_id)
+    return user_id
+
+
+def _due(db, user_id):
+    return user_id in [user['id'] for user in db.get_users_due_for_digest(NOW)]
+
+
+def test_a_day_is_claimed_once_until_released(db):
+    user_id = _user(db)
+    assert db.claim_digest(user_id, DAY)
+    assert not db.claim_digest(user_id, DAY)
+    db.release_digest(user_id, "2026-10-18") # Another day's release leaves the claim alone
+    assert not db.claim_digest(user_id, DAY)
+    db.release_digest(user_id, DAY)
+    assert db.claim_digest(user_id, DAY)
+
+
+def test_digest_is_queued_once(db, monkeypatch):
+    monkeypatch.setattr(digest.outbox, 'notify', lambda: None)
+    user_id = _user(db)
+    user = {"id": user_id, "discord_webhook": WEBHOOK}
+    assert digest.send_user_digest(user, NOW)
+    assert not digest.send_user_digest(user, NOW) # A second process finds the day taken
+    assert db.get_outbox_stats() == {"pending": 1}
+    assert db.get_digest_ads(user_id=user_id) == [] and not _due(db, user_id)
+
+
+def test_failed_enqueue_releases_the_day(db, monkeypatch):
+    user_id = _user(db)
+    monkeypatch.setattr(digest.outbox, 'enqueue', lambda *a, **k: 0)
+    assert not digest.send_user_digest({"id": user_id, "discord_webhook": WEBHOOK}, NOW)
+    assert _due(db, user_id)
+    assert len(db.get_digest_ads(user_id=user_id)) == 1 # Candidates kept for the retry
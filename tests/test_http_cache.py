@@ -0,0 +1,65 @@
+import requests
+
+from http_cache import HttpCache
+
+URL = "https://www.example.com/annonce/1"
+
+
+class FakeSession:
+    """Answers with the queued responses and records the request headers."""
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.sent = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.sent.append(headers or {})
+        return self.responses.pop(0)
+
+
+def _response(status, body=b"", headers=None):
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = body
+    resp.headers.update(headers or {})
+    resp.encoding = 'utf-8'
+    return resp
+
+
+def test_revalidates_with_etag_and_reuses_body_on_304(tmp_path):
+    cache = HttpCache(path=str(tmp_path / 'cache.db'))
+    session = FakeSession(_response(200, b"<html>v1</html>", {"ETag": '"v1"'}), _response(304))
+
+    first = cache.get(URL, session=session, freshness=0)
+    assert first.text == "<html>v1</html>" and not first.from_cache
+    second = cache.get(URL, session=session, freshness=0)
+    assert session.sent[1]["If-None-Match"] == '"v1"'
+    assert second.revalidated and second.text == "<html>v1</html>"
+
+
+def test_fresh_entry_served_without_request(tmp_path):
+    cache = HttpCache(path=str(tmp_path / 'cache.db'))
+    session = FakeSession(_response(200, b"body", {"Last-Modified": "Mon, 19 Oct 2026 10:00:00 GMT"}))
+    cache.get(URL, session=session, freshness=60)
+    assert cache.is_fresh(URL) is False # Default freshness of an unknown host is 0
+    resp = cache.get(URL, session=session, freshness=60)
+    assert resp.from_cache and not resp.revalidated
+    assert len(session.sent) == 1
+
+
+def test_no_store_is_not_cached(tmp_path):
+    cache = HttpCache(path=str(tmp_path / 'cache.db'))
+    session = FakeSession(_response(200, b"a", {"Cache-Control": "no-store"}), _response(200, b"b"))
+    cache.get(URL, session=session, freshness=60)
+    assert cache.get(URL, session=session, freshness=60).text == "b"
+
+
+def test_stats_shared_between_processes(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    web, worker = HttpCache(path=path), HttpCache(path=path)
+    worker.get(URL, session=FakeSession(_response(200, b"body", {"ETag": '"v1"'})), freshness=0)
+    worker.get(URL, session=FakeSession(_response(304)), freshness=0)
+
+    stats = web.stats()
+    assert (stats["requests"], stats["misses"], stats["revalidated"], stats["stored"]) == (2, 1, 1, 1)
+    assert stats["bytes_saved"] == 4
+    assert stats["hit_ratio"] == 0.5
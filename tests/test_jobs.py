@@ -0,0 +1,63 @@
+import time
+
+
+def test_expired_lease_is_reclaimed(db):
+    job_id = db.enqueue_job('refresh', {"name": "velo"})
+    job = db.claim_job(['refresh'], 'worker-a', lease_seconds=60)
+    assert job['id'] == job_id
+    # Leased: nobody else gets it
+    assert db.claim_job(['refresh'], 'worker-b', lease_seconds=60) is None
+
+    # Worker a stops heartbeating: its last renewal runs out
+    db.renew_leases('jobs', 'worker-a', [job_id], lease_seconds=0)
+    time.sleep(0.01)
+    job = db.claim_job(['refresh'], 'worker-b', lease_seconds=60)
+    assert job['id'] == job_id
+    assert job['lease_owner'] == 'worker-b'
+    assert job['attempts'] == 2
+
+
+def test_finish_job_rejected_after_lease_lost(db):
+    job_id = db.enqueue_job('refresh', {"name": "velo"})
+    db.claim_job(['refresh'], 'worker-a', lease_seconds=0)
+    time.sleep(0.01)
+    db.claim_job(['refresh'], 'worker-b', lease_seconds=60)
+
+    assert db.renew_leases('jobs', 'worker-a', [job_id], lease_seconds=60) == []
+    assert db.finish_job(job_id, 'worker-a', 'done') is False
+    assert db.get_job(job_id)['status'] == 'running'
+    assert db.finish_job(job_id, 'worker-b', 'done') is True
+    assert db.get_job(job_id)['status'] == 'done'
+
+
+def test_expired_lease_out_of_attempts_fails(db):
+    job_id = db.enqueue_job('refresh', {"name": "velo"}, max_attempts=1)
+    db.claim_job(['refresh'], 'worker-a', lease_seconds=0)
+    time.sleep(0.01)
+    assert db.claim_job(['refresh'], 'worker-b', lease_seconds=60) is None
+    assert db.get_job(job_id)['status'] == 'failed'
+
+
+def test_heartbeat_keeps_lease(db, monkeypatch):
+    import jobs
+    monkeypatch.setattr(jobs, 'LEASE_SECONDS', 0.3)
+    job_id = db.enqueue_job('refresh', {"name": "velo"})
+    db.claim_job(['refresh'], 'worker-a', lease_seconds=0.3)
+    with jobs.Heartbeat(worker_id='worker-a', interval=0.1).hold('jobs', job_id):
+        time.sleep(0.6)
+        assert db.claim_job(['refresh'], 'worker-b', lease_seconds=60) is None
+    assert db.finish_job(job_id, 'worker-a', 'done') is True
+
+
+def test_claim_order_is_fair_between_users(db):
+    for name in ("a", "b", "c"):
+        db.enqueue_job('refresh', {"name": name}, user_id=1)
+    db.enqueue_job('refresh', {"name": "d"}, user_id=2)
+
+    first = db.claim_job(['refresh'], 'worker-a', lease_seconds=60)
+    second = db.claim_job(['refresh'], 'worker-b', lease_seconds=60)
+    # User 2's job runs before user 1's backlog, although queued last
+    assert (first['user_id'], second['user_id']) == (1, 2)
+    db.finish_job(first['id'], 'worker-a', 'done')
+    db.finish_job(second['id'], 'worker-b', 'done')
+    assert [db.claim_job(['refresh'], 'worker-a', lease_seconds=60)['payload']['name'] for _ in range(2)] == ["b", "c"]
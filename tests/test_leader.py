@@ -0,0 +1,48 @@
+import time
+import threading
+
+import leader
+
+TTL = 0.5
+
+
+def _watch(electors, seconds):
+    """Samples the electors for `seconds`; returns how often several claimed to lead at once."""
+    both = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        both += sum(e.is_leader() for e in electors) > 1
+        time.sleep(0.005)
+    return both
+
+
+def test_two_electors_never_both_lead(db, monkeypatch):
+    monkeypatch.setattr(leader, 'RENEW_SECONDS', TTL / 5)
+    stalled = threading.Event()
+    acquire = db.acquire_leadership
+
+    def acquire_leadership(name, holder, ttl):
+        # The first leader stalls on its renewals (GC pause, blocked I/O) while it still looks alive
+        if holder == 'a' and stalled.is_set():
+            time.sleep(TTL * 3)
+        return acquire(name, holder, ttl)
+
+    monkeypatch.setattr(db, 'acquire_leadership', acquire_leadership)
+    a = leader.LeaderElector('test', holder='a', ttl=TTL)
+    a.start()
+    time.sleep(TTL / 5)
+    b = leader.LeaderElector('test', holder='b', ttl=TTL)
+    b.start()
+
+    both = _watch([a, b], TTL * 2)
+    assert both == 0
+    assert a.is_leader() and not b.is_leader()
+    term = a.token
+
+    stalled.set()
+    both = _watch([a, b], TTL * 3)
+    assert both == 0
+    assert b.is_leader() and not a.is_leader()
+    assert b.token == term + 1
+    assert a.fence() is None
+
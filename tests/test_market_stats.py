@@ -0,0 +1,69 @@
+import random
+
+import pytest
+
+import analyzer
+from sketches import TDigest
+
+
+def _digest(values, compression=100):
+    digest = TDigest(compression)
+    for v in values:
+        digest.add(v)
+    return digest
+
+
+def test_quantiles_within_one_percent_rank():
+    rng = random.Random(7)
+    values = [rng.lognormvariate(5, 0.6) for _ in range(20000)]
+    digest = _digest(values)
+    ordered = sorted(values)
+    for q in (0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99):
+        estimate = digest.quantile(q)
+        rank = sum(v <= estimate for v in ordered) / len(ordered)
+        assert rank == pytest.approx(q, abs=0.01)
+    assert len(digest.centroids) <= 2 * digest.compression
+    assert (digest.min, digest.max) == (min(values), max(values))
+
+
+def test_merge_matches_a_single_digest():
+    rng = random.Random(3)
+    a, b = [rng.uniform(0, 100) for _ in range(5000)], [rng.uniform(100, 300) for _ in range(5000)]
+    merged = _digest(a)
+    merged.merge(_digest(b))
+    whole = _digest(a + b)
+    assert merged.count == 10000
+    for q in (0.1, 0.5, 0.9):
+        assert merged.quantile(q) == pytest.approx(whole.quantile(q), rel=0.02)
+
+
+def test_round_trip_keeps_quantiles():
+    digest = _digest(range(1, 1001))
+    restored = TDigest.from_dict(digest.to_dict())
+    assert restored.count == 1000
+    assert restored.quantile(0.5) == pytest.approx(digest.quantile(0.5), abs=0.01)
+    restored.add(5000)
+    assert restored.max == 5000
+
+
+def _ad(i, price, title="vélo route"):
+    return {"id": str(i), "title": title, "price": price, "search_name": "velo", "date": "2026-10-19T10:00:00",
+            "url": f"https://example.com/{i}"}
+
+
+def test_market_stats_follow_new_ads_without_rescan(db, monkeypatch):
+    db.add_ads_bulk([_ad(i, 100 + i) for i in range(101)], user_id=1)
+    stats = analyzer.get_market_stats("vélo", user_id=1)
+    assert (stats["count"], stats["min"], stats["max"]) == (101, 100, 200)
+    assert stats["median"] == pytest.approx(150, abs=2)
+    assert analyzer.get_market_stats(user_id=1, search_name="velo")["count"] == 101
+
+    # Incremental from here on: a table scan would fail the test
+    monkeypatch.setattr(analyzer, '_seed_market_stats', lambda *args: pytest.fail("rescanned"))
+    new = [_ad(1000 + i, 1000) for i in range(101)]
+    db.add_ads_bulk(new, user_id=1)
+    analyzer.record_market_prices(1, "velo", new)
+    stats = analyzer.get_market_stats("vélo", user_id=1)
+    assert (stats["count"], stats["max"]) == (202, 1000)
+    assert stats["p90"] == pytest.approx(1000, abs=1)
+    assert analyzer.get_market_stats(user_id=1, search_name="velo")["count"] == 202
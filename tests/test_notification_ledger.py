@@ -0,0 +1,58 @@
+import sqlite3
+
+import pytest
+
+import pipeline
+
+WEBHOOK = "https://discord.example/api/webhooks/1/x"
+
+
+def _ad(i, price=100):
+    return {"id": str(i), "title": f"vélo {i}", "price": price, "search_name": "velo", "url": f"https://example.com/{i}"}
+
+
+def _build(fresh):
+    return [{"webhook": WEBHOOK, "embed": {"title": ad['title']}, "user_id": 1} for ad in fresh]
+
+
+def _count(db, table):
+    with sqlite3.connect(db.DB_FILE) as conn:
+        return conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+
+def test_an_ad_alerts_once_per_kind_and_price(db):
+    assert [ad['id'] for ad in db.claim_notifications([_ad(1), _ad(2)], 'price_drop', build=_build)] == ['1', '2']
+    assert db.claim_notifications([_ad(1), _ad(2)], 'price_drop', build=_build) == []
+    assert db.unnotified([_ad(1), _ad(2, price=90)], 'price_drop') == [_ad(2, price=90)]
+    assert [ad['id'] for ad in db.claim_notifications([_ad(1)], 'pepite')] == ['1']
+    assert [ad['id'] for ad in db.claim_notifications([_ad(1)], 'price_drop', user_id=2)] == ['1']
+    assert _count(db, 'notification_outbox') == 2
+
+
+def test_failed_build_records_nothing(db):
+    def broken(fresh):
+        raise ValueError("embed")
+
+    assert db.claim_notifications([_ad(1)], 'pepite', build=broken) is None
+    assert _count(db, 'notifications_sent') == 0 and _count(db, 'notification_outbox') == 0
+    assert [ad['id'] for ad in db.claim_notifications([_ad(1)], 'pepite', build=_build)] == ['1']
+
+
+def test_notification_stage_does_not_realert_a_replayed_event(db, monkeypatch):
+    monkeypatch.setattr(pipeline.enrichment, 'enrich', lambda ads, user_id=1: ads)
+    monkeypatch.setattr(pipeline.outbox, 'notify', lambda: None)
+    db.set_setting('discord_webhook', WEBHOOK)
+    event = pipeline.AdEvent(pipeline.PRICE_DROP, 1, "velo", ads=[{**_ad(1, price=80), 'old_price': 100}])
+    stage = pipeline.NotificationStage()
+    stage.handle(event)
+    stage.handle(event)
+    assert _count(db, 'notification_outbox') == 1 and _count(db, 'notifications_sent') == 1
+
+
+def test_notification_stage_raises_when_nothing_could_be_queued(db, monkeypatch):
+    monkeypatch.setattr(pipeline.enrichment, 'enrich', lambda ads, user_id=1: ads)
+    monkeypatch.setattr(pipeline.database, 'claim_notifications', lambda *a, **k: None)
+    db.set_setting('discord_webhook', WEBHOOK)
+    event = pipeline.AdEvent(pipeline.PRICE_DROP, 1, "velo", ads=[_ad(1, price=80)])
+    with pytest.raises(RuntimeError):
+        pipeline.NotificationStage().handle(event)
@@ -0,0 +1,84 @@
+import pytest
+import requests
+
+from notifiers import outbox
+
+WEBHOOK = "https://discord.example/api/webhooks/1/x"
+
+
+class FakeSession:
+    """Answers posts with the queued responses and records the payloads."""
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.posted = []
+
+    def post(self, url, json=None, timeout=None):
+        self.posted.append(json)
+        return self.responses.pop(0)
+
+    def close(self):
+        pass
+
+
+def _response(status, headers=None, body=b"{}"):
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = body
+    resp.headers.update(headers or {})
+    return resp
+
+
+@pytest.fixture
+def session(db, monkeypatch):
+    monkeypatch.setattr(outbox, '_blocked_until', {})
+    monkeypatch.setattr(outbox, '_global_until', 0.0)
+    monkeypatch.setattr(outbox, 'notify', lambda: None)
+    fake = FakeSession()
+    monkeypatch.setattr(outbox.requests, 'Session', lambda: fake)
+    return fake
+
+
+def _embeds(n):
+    return [{"title": f"annonce {i}"} for i in range(n)]
+
+
+def test_messages_are_packed_ten_embeds_per_post(db, session):
+    session.responses = [_response(204), _response(204)]
+    assert outbox.enqueue(WEBHOOK, _embeds(12), user_id=1) == 12
+    outbox.drain_webhook(WEBHOOK)
+    assert [len(payload["embeds"]) for payload in session.posted] == [10, 2]
+    assert db.get_outbox_stats() == {"sent": 12}
+
+
+def test_messages_with_another_content_go_in_their_own_post(db, session):
+    session.responses = [_response(204), _response(204)]
+    outbox.enqueue(WEBHOOK, _embeds(2), content="Résumé")
+    outbox.enqueue(WEBHOOK, _embeds(1))
+    outbox.drain_webhook(WEBHOOK)
+    assert [(p.get("content"), len(p["embeds"])) for p in session.posted] == [("Résumé", 2), (None, 1)]
+
+
+def test_rate_limit_blocks_the_webhook_without_counting_an_attempt(db, session):
+    session.responses = [_response(429, {"Retry-After": "30"}, body=b"")]
+    outbox.enqueue(WEBHOOK, _embeds(3))
+    outbox.drain_webhook(WEBHOOK)
+    assert len(session.posted) == 1 # Stopped at the 429 instead of retrying at once
+    assert db.get_outbox_stats() == {"pending": 3}
+    assert outbox._available_at(WEBHOOK) > outbox.time.time() + 25
+    assert db.claim_outbox_batch(WEBHOOK) == [] # Held back until the wait ends
+
+
+def test_server_errors_are_retried_then_failed(db, session, monkeypatch):
+    monkeypatch.setattr(outbox, '_backoff', lambda attempts: 0)
+    outbox.enqueue(WEBHOOK, _embeds(1))
+    for _ in range(outbox.MAX_ATTEMPTS):
+        session.responses = [_response(503)]
+        outbox.drain_webhook(WEBHOOK)
+    assert len(session.posted) == outbox.MAX_ATTEMPTS
+    assert db.get_outbox_stats() == {"failed": 1}
+
+
+def test_closed_gate_delivers_nothing(db, session):
+    outbox.enqueue(WEBHOOK, _embeds(2))
+    outbox.drain_webhook(WEBHOOK, gate=lambda: False)
+    assert session.posted == [] and db.get_outbox_stats() == {"pending": 2}
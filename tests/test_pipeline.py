@@ -0,0 +1,95 @@
+import sqlite3
+
+import pipeline
+
+
+def _ad(i, price=100):
+    return {"id": str(i), "title": f"vélo {i}", "price": price, "search_name": "velo",
+            "date": "2026-10-19T10:00:00", "url": f"https://example.com/{i}"}
+
+
+class RecordingStage(pipeline.Stage):
+    name = "test-stage"
+    kinds = (pipeline.NEW_AD, pipeline.PRICE_DROP)
+
+    def __init__(self, fail_on=()):
+        super().__init__()
+        self.fail_on = set(fail_on)
+        self.handled = []
+
+    def handle(self, event):
+        if self.fail_on & {ad['id'] for ad in event.ads}:
+            raise RuntimeError("boom")
+        self.handled.append((event.kind, [ad['id'] for ad in event.ads]))
+
+
+def _offset(db, consumer):
+    with sqlite3.connect(db.DB_FILE) as conn:
+        return conn.execute('SELECT seq FROM consumer_offsets WHERE consumer = ?', (consumer,)).fetchone()[0]
+
+
+def test_stage_consumes_from_its_offset(db):
+    stage = RecordingStage()
+    db.register_consumer(stage.name)
+    db.add_ads_bulk([_ad(1), _ad(2)])
+    db.add_ad(_ad(1, price=80))
+    assert stage.poll() == 3
+    assert stage.handled == [(pipeline.NEW_AD, ['1', '2']), (pipeline.PRICE_DROP, ['1'])]
+    assert _offset(db, stage.name) == db.get_ad_events_head()
+    assert stage.poll() == 0 and len(stage.handled) == 2
+
+
+def test_failing_event_is_retried_then_skipped(db):
+    stage = RecordingStage(fail_on={'2'})
+    db.add_ad(_ad(2))
+    db.register_consumer(stage.name)
+    db.add_ad(_ad(1))
+    db.add_ad(_ad(2, price=50))
+    db.add_ad(_ad(3))
+    start = _offset(db, stage.name)
+
+    for _ in range(pipeline.MAX_EVENT_ATTEMPTS - 1):
+        assert stage.poll() == 0
+    # The event before the failing one is committed once, the failing one is not
+    assert stage.handled == [(pipeline.NEW_AD, ['1'])]
+    assert start < _offset(db, stage.name) < db.get_ad_events_head()
+
+    assert stage.poll() == 2 # Last attempt gives up, the rest of the batch goes through
+    assert stage.handled == [(pipeline.NEW_AD, ['1']), (pipeline.NEW_AD, ['3'])]
+    assert _offset(db, stage.name) == db.get_ad_events_head()
+
+
+def test_closed_gate_stops_before_the_next_event(db):
+    stage = RecordingStage()
+    db.register_consumer(stage.name)
+    start = _offset(db, stage.name)
+    db.add_ad(_ad(1))
+    db.add_ad(_ad(1, price=50))
+    open_for = iter([True, False])
+    stage.gate = lambda: next(open_for)
+    assert stage.poll() == 0
+    assert stage.handled == [(pipeline.NEW_AD, ['1'])]
+    assert start < _offset(db, stage.name) < db.get_ad_events_head()
+
+
+def test_stale_fence_refuses_the_commit(db):
+    stage = RecordingStage()
+    db.register_consumer(stage.name)
+    start = _offset(db, stage.name)
+    assert db.acquire_leadership("pipeline", "a", 30)[0]
+    token = db.acquire_leadership("pipeline", "a", 30)[1]
+    db.release_leadership("pipeline", "a")
+    db.acquire_leadership("pipeline", "b", 30)
+
+    db.add_ad(_ad(1))
+    stage.fence = lambda: ("pipeline", "a", token)
+    assert stage.poll() == 0
+    assert _offset(db, stage.name) == start
+
+    stage.fence = lambda: None # No term at all
+    assert stage.poll() == 0
+    assert _offset(db, stage.name) == start
+
+    stage.fence = lambda: ("pipeline", "b", db.acquire_leadership("pipeline", "b", 30)[1])
+    assert stage.poll() == 1
+    assert _offset(db, stage.name) == db.get_ad_events_head()
@@ -0,0 +1,47 @@
+from datetime import datetime
+
+import numpy as np
+
+import analyzer
+
+NOW = datetime.now() # select_for_llm scores freshness against the clock
+
+
+def _ad(i, title, price, hours_old=None, **extra):
+    date_ts = int(NOW.timestamp() - hours_old * 3600) if hours_old is not None else None
+    return {"id": str(i), "title": title, "price": price, "date_ts": date_ts, **extra}
+
+
+def test_features_from_columns():
+    ads = [_ad(1, "Vélo route carbone", 100, hours_old=0), _ad(2, "Vélo", 200, hours_old=72), _ad(3, "Casque", None)]
+    features = analyzer._prescore_features(ads, "vélo carbone", reference_price=200, now=NOW)
+    np.testing.assert_allclose(features["keywords"], [1.0, 0.5, 0.0])
+    np.testing.assert_allclose(features["price"][:2], [1.0, 0.5])
+    assert np.isnan(features["price"][2])
+    np.testing.assert_allclose(features["freshness"][:2], [1.0, 0.5], rtol=1e-4)
+    assert np.isnan(features["freshness"][2]) # Undated
+
+
+def test_prescore_ranks_cheap_matching_fresh_ads_first():
+    ads = [_ad(1, "iphone 13 cassé", 600, hours_old=400, is_pro=1), _ad(2, "iphone 13", 300, hours_old=2, is_pro=0)]
+    scores = analyzer.prescore_ads(ads, "iphone 13", reference_price=500, now=NOW)
+    assert scores[1] > scores[0]
+    assert 0 <= scores.min() and scores.max() <= 10
+
+
+def test_select_for_llm_threshold_and_price_guard():
+    ads = [
+        _ad(1, "iphone 13", 480, hours_old=1),
+        _ad(2, "coque iphone", 100, hours_old=900, is_pro=1), # Far under the median, query word in the title
+        _ad(3, "lot de cables", 100, hours_old=900, is_pro=1), # Cheap but unrelated
+        _ad(4, "iphone 13", 900, hours_old=900, is_pro=1),
+    ]
+    selected = analyzer.select_for_llm(ads, "iphone 13", reference_price=500, threshold=7.0)
+    assert [ad["id"] for ad in selected] == ['1', '2']
+    assert selected[0]["prescore"] >= 7.0 > selected[1]["prescore"]
+
+
+def test_string_prices_are_parsed():
+    ads = [_ad(1, "a", "120", hours_old=1), _ad(2, "b", "n/a", hours_old=1)]
+    prices = analyzer._prescore_features(ads, "a", reference_price=100, now=NOW)["prices"]
+    assert prices[0] == 120 and np.isnan(prices[1])
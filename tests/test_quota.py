@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+import pytest
+
+import analyzer
+
+LIMITS = {"rpm": 2, "tpm": 1000, "rpd": 3}
+PROMPT = "x" * 4000 # ~1000 tokens at the default ratio
+
+
+def test_rpm_bucket_makes_the_caller_wait(db):
+    assert db.reserve_ai_quota('key', 'model', 10, LIMITS)['wait'] == 0
+    assert db.reserve_ai_quota('key', 'model', 10, LIMITS)['wait'] == 0
+    res = db.reserve_ai_quota('key', 'model', 10, LIMITS)
+    assert res['ok'] and res['reason'] == 'rpm'
+    assert res['wait'] == pytest.approx(30, abs=0.5) # One request in debt at 2 per minute
+
+
+def test_daily_quota_refuses(db):
+    for _ in range(3):
+        db.reserve_ai_quota('key', 'model', 10, LIMITS)
+    res = db.reserve_ai_quota('key', 'model', 10, LIMITS)
+    assert not res['ok'] and res['reason'] == 'daily'
+
+
+def test_tpm_debt_and_refund(db):
+    db.reserve_ai_quota('key', 'model', 1000, LIMITS)
+    db.adjust_ai_quota('key', 'model', 800, LIMITS) # Only 200 were used
+    assert db.get_ai_quota('key', 'model', LIMITS)['tpm_tokens'] == pytest.approx(800, abs=20)
+    res = db.reserve_ai_quota('key', 'model', 1000, LIMITS)
+    assert res['reason'] == 'tpm' and res['wait'] == pytest.approx(12, abs=1)
+
+
+def test_reservation_fails_closed_on_database_error(db, monkeypatch, tmp_path):
+    monkeypatch.setattr(db, 'DB_FILE', str(tmp_path)) # A directory: every connection fails
+    res = db.reserve_ai_quota('key', 'model', 10, LIMITS)
+    assert not res['ok'] and res['reason'] == 'error' and res['wait'] > 0
+
+
+class FakeClient:
+    def __init__(self, error=None, chunks=()):
+        self.models = SimpleNamespace(generate_content=self._generate, generate_content_stream=self._stream)
+        self.error = error
+        self.chunks = chunks
+
+    def _generate(self, model, contents):
+        raise self.error
+
+    def _stream(self, model, contents):
+        yield from self.chunks
+
+
+def _tokens_charged():
+    return analyzer._quota.remaining('key', 'model')['daily_tokens']
+
+
+def test_failed_call_refunds_its_tokens(db, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path) # Errors are appended to debug_ai_errors.log
+    monkeypatch.setattr(analyzer, '_prepare_call', lambda api_key=None: (FakeClient(ValueError("400 bad request")), 'key', 'model'))
+    assert analyzer.safe_generate_content(PROMPT) is None
+    assert _tokens_charged() == 0
+
+
+def test_cancelled_stream_charges_reported_usage(db, monkeypatch):
+    usage = SimpleNamespace(total_token_count=50, prompt_token_count=1000)
+    chunks = [SimpleNamespace(text="a", usage_metadata=usage), SimpleNamespace(text="b", usage_metadata=usage)]
+    monkeypatch.setattr(analyzer, '_prepare_call', lambda api_key=None: (FakeClient(chunks=chunks), 'key', 'model'))
+    stream = analyzer.stream_generate_content(PROMPT)
+    assert next(stream) == "a"
+    stream.close() # Client went away
+    assert _tokens_charged() == 50
@@ -0,0 +1,84 @@
+import time
+import threading
+
+from scheduler import RefreshScheduler
+
+
+def _watch(user_id, name):
+    return {"user_id": user_id, "name": name, "refresh_mode": "auto", "refresh_interval": 60,
+            "last_run_ts": None, "is_active": 1}
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_fair_share_with_two_users():
+    running = {}
+    started = []
+    lock = threading.Lock()
+    release = {}
+
+    def run(name, user_id, due):
+        with lock:
+            running[user_id] = running.get(user_id, 0) + 1
+            started.append((user_id, name))
+            event = release.setdefault(name, threading.Event())
+        event.wait(5)
+        with lock:
+            running[user_id] -= 1
+
+    def finish(name):
+        with lock:
+            release.setdefault(name, threading.Event()).set()
+
+    user_1 = [_watch(1, f"deep-{i}") for i in range(5)]
+    scheduler = RefreshScheduler(run, workers=4)
+    scheduler.sync(user_1)
+    scheduler.start()
+    # Alone, user 1 gets every worker
+    _wait_for(lambda: len(started) == 4)
+    assert running == {1: 4}
+
+    scheduler.sync(user_1 + [_watch(2, "quick")])
+    time.sleep(0.2)
+    assert len(started) == 4 # All workers busy: user 2 waits for a free one
+
+    # The freed worker goes to user 2, not to user 1's last watch
+    finish(started[0][1])
+    _wait_for(lambda: len(started) == 5)
+    assert started[4] == (2, "quick")
+
+    # User 1 is back to its share (2 of 4 workers): the free worker stays free for user 2
+    finish(started[1][1])
+    time.sleep(0.2)
+    assert len(started) == 5
+    assert running == {1: 2, 2: 1}
+
+    # User 2 is done: user 1 may use every worker again
+    finish("quick")
+    _wait_for(lambda: len(started) == 6)
+    assert started[5] == (1, "deep-4")
+
+    for i in range(5):
+        finish(f"deep-{i}")
+    _wait_for(lambda: scheduler.stats()["running"] == 0)
+    assert all(w["runs"] == 1 for w in scheduler.stats()["watches"])
+
+
+def test_lateness_measured_to_the_real_start():
+    done = threading.Event()
+
+    def run(name, user_id, due):
+        done.set()
+        return due + 42 # Claimed by a job worker 42s after its due time
+
+    scheduler = RefreshScheduler(run, workers=1)
+    scheduler.sync([_watch(1, "velo")])
+    scheduler.start()
+    assert done.wait(5)
+    _wait_for(lambda: scheduler.stats()["watches"][0]["runs"] == 1)
+    assert scheduler.stats()["watches"][0]["last_lateness"] == 42.0
@@ -1,5 +1,8 @@
+import sys
 import requests
-from typing import Optional, Tuple
+import numpy as np
+from datetime import datetime
+from typing import Any, Callable, Optional, Tuple
 
 def get_coordinates(city_name: str) -> Optional[Tuple[float, float, str]]:
     """
@@ -19,3 +22,51 @@ def get_coordinates(city_name: str) -> Optional[Tuple[float, float, str]]:
     except Exception as e:
         print(f"Error resolving coordinates for {city_name}: {e}")
     return None
+
+
+EARTH_RADIUS_KM = 6371.0
+
+def haversine_km(lat: float, lng: float, lats, lngs) -> np.ndarray:
+    """
+    Great-circle distances (km) from one point to arrays of points, vectorized with NumPy.
+    Missing coordinates (NaN) give NaN distances.
+    """
+    lat1, lng1 = np.radians(lat), np.radians(lng)
+    lat2 = np.radians(np.asarray(lats, dtype=np.float64))
+    lng2 = np.radians(np.asarray(lngs, dtype=np.float64))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def to_epoch(value) -> Optional[int]:
+    """
+    Normalizes the date formats stored over time (isoformat(), str(datetime), 'YYYY-MM-DD',
+    aware or naive, epoch numbers) to integer POSIX seconds. Naive values are local time.
+    Returns None when the value is empty or unparsable.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    text = str(value).strip()
+    if text.isdigit():
+        return int(text)
+    try:
+        return int(datetime.fromisoformat(text.replace('Z', '+00:00')).timestamp())
+    except ValueError:
+        return None
+
+def run_blocking(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Calls fn(*args, **kwargs) without stalling a gevent server: libraries doing their own
+    network I/O in C (curl_cffi under lbc, grpc) cannot yield to other greenlets, so on a
+    monkey-patched process the call runs in gevent's native thread pool instead.
+    Elsewhere it is a plain call.
+    """
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is None or not monkey.is_module_patched('socket'):
+        return fn(*args, **kwargs)
+    import gevent
+    return gevent.get_hub().threadpool.spawn(fn, *args, **kwargs).get()
@@ -0,0 +1,103 @@
+'''
+Ingestion worker: auto-refresh scheduling, refresh and AI analysis jobs, the event pipeline,
+daily digests and the Discord outbox, in a process of their own so the web tier only serves
+requests. Any number of workers (on one or more hosts sharing the database file) pull from
+the same lease-based job tables; one of them, elected through a lease in the database, runs
+the loops that must happen once.
+
+Usage: python worker.py [--refresh-workers 2] [--ai-workers 2]
+'''
+import sys
+import time
+import signal
+import argparse
+import threading
+from typing import Callable
+
+import database
+import ai_jobs
+import digest
+import jobs
+import leader
+import pipeline
+import scheduler
+from notifiers import outbox
+
+MAINTENANCE_SECONDS = 60
+
+_maintenance_wakeup = threading.Event()
+
+
+def maintenance_loop(refresh_scheduler: scheduler.RefreshScheduler, elector: leader.LeaderElector):
+    """
+    Feeds the refresh scheduler, sends due digests and prunes the logs, once a minute and
+    right after this process is elected; followers only wait for their turn.
+    """
+    print("Starting multi-user auto-refresh background thread...")
+    while True:
+        _maintenance_wakeup.wait(timeout=MAINTENANCE_SECONDS)
+        _maintenance_wakeup.clear()
+        try:
+            # Each step re-checks the lease: a stalled leader stops as soon as its term is over
+            steps = [
+                # Due times, intervals and new or removed watches; the scheduler queues the refreshes
+                lambda: refresh_scheduler.sync(database.get_active_searches()), # ALL active searches from ALL users
+                # Each user's digest at their digest hour, from the candidates kept by the pipeline
+                lambda: digest.send_due_digests(gate=elector.is_leader),
+                database.prune_ad_events,
+                database.prune_notification_outbox,
+                database.prune_notifications_sent,
+                database.prune_jobs,
+                database.prune_ai_progress,
+                database.prune_market_queries,
+            ]
+            for step in steps:
+                if not elector.is_leader():
+                    break
+                step()
+        except Exception as e:
+            print(f"Background refresh error: {e}")
+
+
+def start_services(refresh: Callable[[str, int], None], refresh_workers: int = None,
+                   ai_workers: int = None) -> scheduler.RefreshScheduler:
+    """
+    Starts everything a worker process runs; `refresh(name, user_id)` performs one watch
+    refresh. Job workers run in every process; the loops that must run once (scheduling,
+    digests, log consumers, outbox, pruning) only in the elected leader. Returns the refresh
+    scheduler.
+    """
+    jobs.register(jobs.REFRESH, lambda job: refresh(job['payload']['name'], job['user_id']))
+    jobs.JobWorkerPool([jobs.REFRESH], workers=refresh_workers or jobs.REFRESH_JOB_WORKERS).start()
+    ai_jobs.start_workers(ai_workers)
+
+    elector = leader.LeaderElector()
+    elector.on_elected(_maintenance_wakeup.set) # Resync the schedule at once on failover
+    pipeline.start(pipeline.WORKER_STAGES, gate=elector.is_leader, fence=elector.fence)
+    outbox.start(gate=elector.is_leader)
+    # Scheduled refreshes go through the job table, so whichever worker is free runs them
+    refresh_scheduler = scheduler.RefreshScheduler(
+        lambda name, user_id, due: jobs.run_refresh(name, user_id, scheduled_for=due), gate=elector.is_leader)
+    refresh_scheduler.start()
+    threading.Thread(target=maintenance_loop, args=(refresh_scheduler, elector), name="maintenance", daemon=True).start()
+    elector.start()
+    return refresh_scheduler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--refresh-workers', type=int, default=None)
+    parser.add_argument('--ai-workers', type=int, default=None)
+    args = parser.parse_args()
+
+    # docker stop sends SIGTERM: exit cleanly so the leader lease is released at once
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    import app # refresh_search and its helpers; the Flask server is not started
+    start_services(app.refresh_in_background, refresh_workers=args.refresh_workers, ai_workers=args.ai_workers)
+    print(f"Worker {jobs.WORKER_ID} ready.")
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+'''
+Production entry point: gunicorn -c gunicorn.conf.py wsgi:app
+Each gunicorn worker imports this module once and starts its own web-side background threads
+(live feed). The gevent workers never host the ingestion worker: its SQLite write-lock waits
+would block every request of the worker. With EMBEDDED_WORKER on, gunicorn.conf.py runs
+worker.py as a separate process instead.
+'''
+from app import app, start_background
+
+start_background(embedded_worker=False)